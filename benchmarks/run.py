@@ -0,0 +1,240 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic_data import generate_dataset, observations, calibration_pairs
+from data_preparation.radar import prepare_radar_data
+from data_preparation.DM_analysis import get_DM_curves_data
+from event_selection import select_all_events
+from calibration import calibrate
+from percipitation import generate_percipitation_maps
+
+# Problem size per scale
+scales = {
+    'small': {'stations': 30, 'days': 2, 'resolution': 400, 'dm_stations': 50, 'dm_days': 60, 'event_stations': 50, 'event_days': 30, 'pairs': 10000},
+    'medium': {'stations': 60, 'days': 7, 'resolution': 800, 'dm_stations': 200, 'dm_days': 180, 'event_stations': 200, 'event_days': 90, 'pairs': 100000},
+    'large': {'stations': 120, 'days': 28, 'resolution': 800, 'dm_stations': 500, 'dm_days': 365, 'event_stations': 500, 'event_days': 365, 'pairs': 1000000},
+}
+
+# Year and wet month of the synthetic data
+year = 2022
+month = '09'
+
+
+def measure(func, repeat=3):
+    '''
+    Method to time a function, hiding what it prints.
+
+    @param func function: Function without arguments to time.
+    @param repeat int: Number of runs.
+
+    @return seconds list[float]: Wall time of every run.
+    @return result any: Result of the last run.
+    '''
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            seconds.append(time.perf_counter() - start)
+
+    return seconds, result
+
+
+def record(benchmark, scale, size, seconds, amount, unit):
+    '''
+    Method to store the result of a benchmark, with the throughput of the fastest run.
+
+    @param benchmark str: Name of the benchmark.
+    @param scale str: Name of the scale.
+    @param size dict: Problem size.
+    @param seconds list[float]: Wall time of every run.
+    @param amount float: Amount of work done per run (e.g. number of scans).
+    @param unit str: Unit of the throughput (e.g. scans/s).
+
+    @return result dict: Result of the benchmark.
+    '''
+    return {'benchmark': benchmark, 'scale': scale, 'size': size, 'seconds': seconds, 'best_s': min(seconds), \
+            'throughput': amount / min(seconds) if min(seconds) > 0 else float('inf'), 'unit': unit}
+
+
+def dataset_for_scale(scale, data_path, seed=0):
+    '''
+    Method to write the synthetic files of a scale, reused if they exist with the same settings.
+    '''
+    size = scales[scale]
+    return generate_dataset(data_path + '/' + scale, years=[year], months=[month], days=['%02d' % day for day in range(1, size['days'] + 1)], \
+                            n_stations=size['stations'], resolution=size['resolution'], seed=seed)
+
+
+def benchmark_prepare_radar_data(scale, data_path, workers=1, repeat=3, seed=0):
+    '''
+    Method to benchmark the extraction of the station values from the png files, without cache, in scans/s.
+    '''
+    dataset = dataset_for_scale(scale, data_path, seed)
+    seconds, _ = measure(lambda: prepare_radar_data(dataset['radar_data_path'], year, 15, 53, workers=workers), repeat)
+
+    size = {'stations': scales[scale]['stations'], 'days': dataset['n_days'], 'scans': dataset['n_scans'], 'workers': workers}
+    return record('prepare_radar_data', scale, size, seconds, dataset['n_scans'], 'scans/s')
+
+
+def benchmark_generate_percipitation_maps(scale, data_path, workers=1, repeat=3, seed=0):
+    '''
+    Method to benchmark the computation of the hourly percipitation maps, in scans/s.
+    '''
+    dataset = dataset_for_scale(scale, data_path, seed)
+    save_path = tempfile.mkdtemp(dir=data_path)
+    try:
+        seconds, _ = measure(lambda: generate_percipitation_maps(dataset['radar_data_path'], year, 200, 1.6, save_path, \
+                                                                 resolution=scales[scale]['resolution'], workers=workers), repeat)
+    finally:
+        shutil.rmtree(save_path)
+
+    size = {'resolution': scales[scale]['resolution'], 'days': dataset['n_days'], 'scans': dataset['n_scans'], 'workers': workers}
+    return record('generate_percipitation_maps', scale, size, seconds, dataset['n_scans'], 'scans/s')
+
+
+def benchmark_get_DM_curves_data(scale, repeat=3, seed=0):
+    '''
+    Method to benchmark the DM analysis, in station pairs/s.
+    '''
+    size = scales[scale]
+    dates = pd.date_range(str(year) + '-' + month + '-01', periods=size['dm_days'], freq='D')
+    rain_df, _, location_HII, location_EWS = observations(size['dm_stations'], dates, grid_size=32, measurements_per_hour=1, seed=seed)
+    seconds, _ = measure(lambda: get_DM_curves_data(rain_df, location_HII, location_EWS), repeat)
+
+    n_pairs = size['dm_stations'] * (size['dm_stations'] - 1) // 2
+    return record('get_DM_curves_data', scale, {'stations': size['dm_stations'], 'days': size['dm_days'], 'pairs': n_pairs}, seconds, n_pairs, 'station-pairs/s')
+
+
+def benchmark_select_all_events(scale, repeat=3, seed=0):
+    '''
+    Method to benchmark the event selection, in single-station events/s.
+    '''
+    size = scales[scale]
+    dates = pd.date_range(str(year) + '-' + month + '-01', periods=size['event_days'], freq='D')
+    rain_df, radar_df, _, _ = observations(size['event_stations'], dates, grid_size=32, missing_fraction=0.01, seed=seed)
+    seconds, (events, Z, R) = measure(lambda: select_all_events(rain_df, radar_df, 3), repeat)
+
+    n_events = len(events.station_ids)
+    size = {'stations': size['event_stations'], 'days': size['event_days'], 'events': n_events, 'merged_events': len(events), 'pairs': len(R)}
+    return record('select_all_events', scale, size, seconds, n_events, 'events/s')
+
+
+def benchmark_calibrate(scale, method='gradient', repeat=3, seed=0):
+    '''
+    Method to benchmark the calibration with a given method, in pairs of Z and R per second.
+    '''
+    n_pairs = scales[scale]['pairs']
+    Z, R = calibration_pairs(n_pairs, seed=seed)
+    seconds, _ = measure(lambda: calibrate(Z, R, method=method), repeat)
+
+    return record('calibrate[' + method + ']', scale, {'pairs': n_pairs, 'method': method}, seconds, n_pairs, 'pairs/s')
+
+
+def run_benchmarks(benchmarks, scale_names, data_path, workers=1, repeat=3, seed=0):
+    '''
+    Method to run benchmarks at several scales.
+
+    @param benchmarks list[str]: Names of the benchmarks to run.
+    @param scale_names list[str]: Names of the scales to run them at.
+    @param data_path str: Directory where the synthetic files are written.
+    @param workers int: Number of processes of the benchmarks that support them.
+    @param repeat int: Number of runs per benchmark.
+    @param seed int: Seed of the synthetic data.
+
+    @return results list[dict]: Result per benchmark and scale.
+    '''
+    runs = {
+        'prepare_radar_data': lambda scale: [benchmark_prepare_radar_data(scale, data_path, workers, repeat, seed)],
+        'get_DM_curves_data': lambda scale: [benchmark_get_DM_curves_data(scale, repeat, seed)],
+        'select_all_events': lambda scale: [benchmark_select_all_events(scale, repeat, seed)],
+        'calibrate': lambda scale: [benchmark_calibrate(scale, method, repeat, seed) for method in ['finite_difference', 'gradient', 'profile']],
+        'generate_percipitation_maps': lambda scale: [benchmark_generate_percipitation_maps(scale, data_path, workers, repeat, seed)],
+    }
+
+    results = []
+    for scale in scale_names:
+        for benchmark in benchmarks:
+            for result in runs[benchmark](scale):
+                print('%-32s %-7s %12.1f %-16s (best of %d: %.3f s)' % (result['benchmark'], scale, result['throughput'], result['unit'], repeat, result['best_s']))
+                results.append(result)
+
+    return results
+
+
+def environment_info():
+    '''
+    Method to describe the machine and code the benchmarks ran on.
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {'time': pd.Timestamp.now().isoformat(), 'commit': commit or None, 'python': platform.python_version(), 'numpy': np.__version__, \
+            'pandas': pd.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+
+def compare_results(baseline_path, results_path):
+    '''
+    Method to compare the throughput of two benchmark runs.
+
+    @param baseline_path str: Path of the json file of the earlier run.
+    @param results_path str: Path of the json file of the later run.
+
+    @return comparison DataFrame: Throughput of both runs and the speedup per benchmark and scale.
+    '''
+    frames = []
+    for path in [baseline_path, results_path]:
+        with open(path) as file:
+            frames.append(pd.DataFrame(json.load(file)['results'])[['benchmark', 'scale', 'unit', 'throughput']])
+
+    comparison = frames[0].merge(frames[1], on=['benchmark', 'scale', 'unit'], suffixes=('_baseline', '_new'))
+    comparison['speedup'] = comparison['throughput_new'] / comparison['throughput_baseline']
+
+    return comparison
+
+
+if __name__ == '__main__':
+    benchmark_names = ['prepare_radar_data', 'get_DM_curves_data', 'select_all_events', 'calibrate', 'generate_percipitation_maps']
+
+    # Define arguments
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic radar and rain gauge data.')
+    parser.add_argument('--benchmarks', nargs='+', default=benchmark_names, choices=benchmark_names, help='Benchmarks to run.')
+    parser.add_argument('--scales', nargs='+', default=['small'], choices=list(scales), help='Problem sizes to run the benchmarks at.')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='Path of the json file to store the results in.')
+    parser.add_argument('--compare', type=str, default=None, help='Path of the json file of an earlier run to compare the throughput with.')
+    parser.add_argument('--data_path', type=str, default=None, help='Directory to keep the synthetic files in for later runs (temporary if not given).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes of the benchmarks that support them.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per benchmark, the fastest counts.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data.')
+    args = parser.parse_args()
+
+    # Run benchmarks, on temporary files unless a data path is given
+    data_path = args.data_path or tempfile.mkdtemp(prefix='benchmark_data_')
+    os.makedirs(data_path, exist_ok=True)
+    try:
+        results = run_benchmarks(args.benchmarks, args.scales, data_path, args.workers, args.repeat, args.seed)
+    finally:
+        if args.data_path is None:
+            shutil.rmtree(data_path)
+
+    # Store results
+    with open(args.output, 'w') as file:
+        json.dump({'run': {**environment_info(), 'argv': sys.argv, **vars(args)}, 'results': results}, file, indent=2)
+    print('Results written to: ', args.output)
+
+    # Compare with an earlier run
+    if args.compare is not None:
+        print(compare_results(args.compare, args.output).to_string(index=False))
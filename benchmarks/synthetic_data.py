@@ -0,0 +1,421 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+from PIL import Image
+from scipy.ndimage import gaussian_filter
+from scipy.signal import lfilter
+from scipy.stats import norm
+from data_preparation.radar import convert_to_reflectivity
+
+# Rain climatology of the synthetic data
+default_climatology = {
+    'wet_fraction': [0.02, 0.03, 0.04, 0.06, 0.12, 0.14, 0.14, 0.15, 0.18, 0.16, 0.08, 0.03], # Fraction of the area with rain per month
+    'intensity_scale': 4.0, # Rain intensity in mm/h per standard deviation above the rain threshold
+    'persistence': 0.97, # Correlation of the rain field between two consecutive scans
+    'correlation_length': 1.5, # Spatial correlation length in grid cells
+    'a': 200, # Parameter a of Z = aR^b relating radar and rain
+    'b': 1.6, # Parameter b of Z = aR^b relating radar and rain
+}
+
+# Geographic extent of the radar image: coordinates of the upper left corner and size of a pixel in degrees
+default_region = {'west': 99.0, 'north': 14.0, 'pixel_size': 0.0025}
+
+
+def scan_times(dates, measurements_per_hour=10):
+    '''
+    Method to get the times of all radar scans on the given days.
+
+    @param dates list[datetime]: Days to get the scan times of.
+    @param measurements_per_hour int: Number of scans per hour.
+
+    @return times DatetimeIndex: Scan times in order.
+    '''
+    per_day = [pd.date_range(pd.Timestamp(date).normalize(), periods=24*measurements_per_hour, freq=str(60 // measurements_per_hour) + 'min') for date in dates]
+    if len(per_day) == 0:
+        return pd.DatetimeIndex([])
+    return per_day[0].append(per_day[1:])
+
+
+def rain_field(times, grid_size=16, climatology=None, seed=0):
+    '''
+    Method to simulate rain intensity on a coarse grid, correlated in space and time.
+    A smoothed gaussian field evolving as an AR(1) process rains where it exceeds the threshold that gives the wet fraction of the month.
+
+    @param times DatetimeIndex: Times of the scans.
+    @param grid_size int: Number of grid cells along each axis.
+    @param climatology dict: Climatology as in default_climatology, default if None.
+    @param seed int: Seed of the random generator.
+
+    @return rain array[float32]: Rain intensity in mm/h of shape (scans, grid_size, grid_size).
+    '''
+    climatology = {**default_climatology, **(climatology or {})}
+    rng = np.random.default_rng(seed)
+
+    # Spatially correlated noise with unit variance
+    field = rng.standard_normal((len(times), grid_size, grid_size), dtype=np.float32)
+    field = gaussian_filter(field, sigma=(0, climatology['correlation_length'], climatology['correlation_length']), mode='wrap')
+    field /= max(field.std(), 1e-12)
+
+    # Correlate in time, starting in the stationary state
+    phi = climatology['persistence']
+    if len(times) > 0:
+        b0 = np.sqrt(1 - phi**2)
+        field = lfilter([b0], [1, -phi], field, axis=0, zi=((1 - b0) * field[:1]))[0].astype(np.float32)
+
+    # Rain where the field exceeds the threshold of the month
+    wet_fraction = climatology['wet_fraction']
+    if np.ndim(wet_fraction) == 0:
+        wet_fraction = [wet_fraction] * 12
+    threshold = norm.ppf(1 - np.asarray(wet_fraction)[np.asarray(times.month) - 1]).astype(np.float32)
+    rain = climatology['intensity_scale'] * np.maximum(field - threshold[:, np.newaxis, np.newaxis], 0)
+
+    return rain.astype(np.float32)
+
+
+def reflectivity_dbz(rain, a=200, b=1.6, noise=0.0, rng=None):
+    '''
+    Method to convert rain intensity to radar values in dBZ as stored in the png files.
+
+    @param rain array[float]: Rain intensity in mm/h.
+    @param a float: Parameter a of Z = aR^b.
+    @param b float: Parameter b of Z = aR^b.
+    @param noise float: Standard deviation of the measurement noise in dBZ.
+    @param rng Generator: Random generator for the noise.
+
+    @return dbz array[uint8]: Radar values, 0 where there is no rain.
+    '''
+    with np.errstate(divide='ignore'):
+        dbz = 10 * np.log10(a * rain.astype(np.float64)**b)
+
+    # Add measurement noise
+    if noise > 0:
+        dbz = dbz + rng.normal(0, noise, dbz.shape)
+
+    return np.where(rain > 0, np.clip(np.round(dbz), 0, 70), 0).astype(np.uint8)
+
+
+def place_stations(n_stations, resolution=800, hii_fraction=0.5, outside_fraction=0.05, region=None, seed=0):
+    '''
+    Method to place rain gauge stations at random pixels of the radar image.
+
+    @param n_stations int: Number of stations.
+    @param resolution int: Resolution of the radar image.
+    @param hii_fraction float: Fraction of HII stations, the others are EWS stations.
+    @param outside_fraction float: Fraction of stations outside the radar region (negative pixels).
+    @param region dict: Geographic extent as in default_region, default if None.
+    @param seed int: Seed of the random generator.
+
+    @return stations DataFrame: Network, pixel_y, pixel_x, lat and long per station id.
+    '''
+    region = {**default_region, **(region or {})}
+    rng = np.random.default_rng(seed)
+
+    # Name stations by network
+    n_hii = int(round(n_stations * hii_fraction))
+    network = np.array(['HII'] * n_hii + ['EWS'] * (n_stations - n_hii))
+    ids = ['HII%04d' % k for k in range(n_hii)] + ['EWS%04d' % k for k in range(n_stations - n_hii)]
+
+    # Random pixels and their coordinates
+    pixel_y = rng.integers(0, resolution, n_stations)
+    pixel_x = rng.integers(0, resolution, n_stations)
+    lat = region['north'] - (pixel_y + 0.5) * region['pixel_size']
+    lon = region['west'] + (pixel_x + 0.5) * region['pixel_size']
+
+    # Mark some stations as outside the radar region
+    outside = rng.random(n_stations) < outside_fraction
+    pixel_y[outside] = -1
+    pixel_x[outside] = -1
+
+    return pd.DataFrame({'network': network, 'pixel_y': pixel_y, 'pixel_x': pixel_x, 'lat': lat, 'long': lon}, index=pd.Index(ids, name='STN_ID'))
+
+
+def station_rain(rain, stations, resolution=800):
+    '''
+    Method to get the rain intensity at the pixel of every station.
+
+    @param rain array[float]: Rain intensity on the grid of shape (scans, grid_size, grid_size).
+    @param stations DataFrame: Stations from place_stations.
+    @param resolution int: Resolution of the radar image.
+
+    @return intensity array[float32]: Rain intensity in mm/h of shape (scans, stations), stations outside the region take the nearest cell.
+    '''
+    cell_size = -(-resolution // rain.shape[1])
+    rows = np.clip(stations['pixel_y'].to_numpy(), 0, resolution - 1) // cell_size
+    cols = np.clip(stations['pixel_x'].to_numpy(), 0, resolution - 1) // cell_size
+    return rain[:, rows, cols]
+
+
+def gauge_totals(intensity, times, minutes, measurements_per_hour=10, noise=0.1, gauge_resolution=0.1, missing_fraction=0.0, rng=None):
+    '''
+    Method to accumulate rain intensity per scan to rain gauge totals per interval.
+
+    @param intensity array[float]: Rain intensity in mm/h of shape (scans, stations), scans covering whole days.
+    @param times DatetimeIndex: Times of the scans.
+    @param minutes int: Length of the interval of the gauge in minutes.
+    @param measurements_per_hour int: Number of scans per hour.
+    @param noise float: Standard deviation of the multiplicative gauge error (log scale).
+    @param gauge_resolution float: Resolution of the gauge in mm.
+    @param missing_fraction float: Fraction of totals that are missing.
+    @param rng Generator: Random generator for noise and missing totals.
+
+    @return totals array[float32]: Rain in mm per interval of shape (intervals, stations).
+    @return interval_times DatetimeIndex: Start of every interval.
+    '''
+    if rng is None:
+        rng = np.random.default_rng(0)
+
+    # Rain per minute, then summed per interval
+    scan_minutes = 60 // measurements_per_hour
+    per_minute = np.repeat(intensity / 60, scan_minutes, axis=0)
+    totals = per_minute.reshape(-1, minutes, intensity.shape[1]).sum(axis=1)
+
+    # Gauge error, resolution and gaps
+    if noise > 0:
+        totals = totals * rng.lognormal(0, noise, totals.shape)
+    totals = np.round(totals / gauge_resolution) * gauge_resolution
+    totals[rng.random(totals.shape) < missing_fraction] = np.nan
+
+    # Start of every interval, following the days of the scans
+    days = pd.DatetimeIndex(times[::24*measurements_per_hour]).normalize()
+    interval_times = scan_times(days, 60 // minutes) if minutes <= 60 else pd.DatetimeIndex([])
+
+    return totals.astype(np.float32), interval_times
+
+
+def observations(n_stations, dates, grid_size=16, resolution=800, measurements_per_hour=10, noise_threshold=15, hail_threshold=53, climatology=None, \
+                 missing_fraction=0.0, seed=0):
+    '''
+    Method to simulate prepared rain gauge and radar data in memory, as returned by the data preparation.
+
+    @param n_stations int: Number of stations.
+    @param dates list[datetime]: Days to simulate.
+    @param grid_size int: Number of grid cells of the rain field along each axis.
+    @param resolution int: Resolution of the radar image.
+    @param measurements_per_hour int: Number of radar scans per hour.
+    @param noise_threshold float: Threshold underneath which is considered noise (in dBZ).
+    @param hail_threshold float: Threshold above which is considered hail (in dBZ).
+    @param climatology dict: Climatology as in default_climatology, default if None.
+    @param missing_fraction float: Fraction of hourly rain gauge values that are missing.
+    @param seed int: Seed of the random generator.
+
+    @return rain_df DataFrame: Rain gauge data per hour in mm.
+    @return radar_df DataFrame: Radar data per scan in Z.
+    @return location_HII DataFrame: Locations of HII stations.
+    @return location_EWS DataFrame: Locations of EWS stations.
+    '''
+    climatology = {**default_climatology, **(climatology or {})}
+    rng = np.random.default_rng(seed)
+
+    # Simulate rain at the stations
+    times = scan_times(dates, measurements_per_hour)
+    stations = place_stations(n_stations, resolution, outside_fraction=0, seed=seed)
+    intensity = station_rain(rain_field(times, grid_size, climatology, seed), stations, resolution)
+
+    # Rain gauge data per hour
+    hourly, hours = gauge_totals(intensity, times, 60, measurements_per_hour, missing_fraction=missing_fraction, rng=rng)
+    rain_df = pd.DataFrame(hourly, index=pd.Index(hours, name='Datetime'), columns=stations.index.tolist())
+
+    # Radar data per scan in Z
+    dbz = reflectivity_dbz(intensity, climatology['a'], climatology['b'], noise=1.0, rng=rng)
+    radar_values = convert_to_reflectivity(dbz.astype(float), noise_threshold, hail_threshold)
+    radar_df = pd.DataFrame(radar_values, index=pd.Index(times, name='Datetime'), columns=stations.index.tolist())
+
+    # Locations as in the location sheets
+    location_HII, location_EWS = location_sheets(stations)
+
+    return rain_df, radar_df, location_HII, location_EWS
+
+
+def location_sheets(stations):
+    '''
+    Method to split the stations into HII and EWS location sheets.
+
+    @param stations DataFrame: Stations from place_stations.
+
+    @return location_HII DataFrame: Locations of HII stations with columns lat and long.
+    @return location_EWS DataFrame: Locations of EWS stations with columns LAT and LONG.
+    '''
+    hii = stations[stations['network'] == 'HII']
+    ews = stations[stations['network'] == 'EWS']
+
+    location_HII = pd.DataFrame({'lat': hii['lat'].to_numpy(), 'long': hii['long'].to_numpy()}, index=pd.Index(hii.index, name='tele_stati'))
+    location_EWS = pd.DataFrame({'LAT': ews['lat'].to_numpy(), 'LONG': ews['long'].to_numpy()}, index=pd.Index(ews.index, name='STN_ID'))
+
+    return location_HII, location_EWS
+
+
+def calibration_pairs(n_pairs, climatology=None, noise=0.2, seed=0):
+    '''
+    Method to simulate pairs of radar reflectivity per scan and rain per hour, as used for calibration.
+
+    @param n_pairs int: Number of hours.
+    @param climatology dict: Climatology as in default_climatology, default if None.
+    @param noise float: Standard deviation of the error of the radar rain (log scale).
+    @param seed int: Seed of the random generator.
+
+    @return Z array[float]: Reflectivity of shape (n_pairs, 10).
+    @return R array[float]: Rain in mm per hour of shape (n_pairs,).
+    '''
+    climatology = {**default_climatology, **(climatology or {})}
+    rng = np.random.default_rng(seed)
+
+    # Rain per hour and the rain seen by the radar in every scan of the hour
+    R = np.round(rng.gamma(0.7, 3.0, n_pairs), 1) + 0.1
+    radar_rain = R[:, np.newaxis] * rng.lognormal(0, noise, (n_pairs, 10))
+    Z = climatology['a'] * radar_rain**climatology['b']
+
+    return Z, R
+
+
+def write_radar_tree(radar_data_path, stations, rain, times, resolution=800, climatology=None, missing_scan_fraction=0.0, region=None, seed=0):
+    '''
+    Method to write a radar archive in the layout radar_png/<year>/<month>/<day>/YYYYMMDDHHMMSS.png,
+    with the pixel table extract_radarpixel/raingauge_coordinate.xlsx and the raster extract_radarpixel/raster_radar_sattahip.tif.
+
+    @param radar_data_path str: Directory to write the radar data to.
+    @param stations DataFrame: Stations from place_stations.
+    @param rain array[float]: Rain intensity on the grid of shape (scans, grid_size, grid_size).
+    @param times DatetimeIndex: Times of the scans.
+    @param resolution int: Resolution of the radar image.
+    @param climatology dict: Climatology as in default_climatology, default if None.
+    @param missing_scan_fraction float: Fraction of scans without a file.
+    @param region dict: Geographic extent as in default_region, default if None.
+    @param seed int: Seed of the random generator.
+
+    @return n_scans int: Number of png files written.
+    '''
+    climatology = {**default_climatology, **(climatology or {})}
+    region = {**default_region, **(region or {})}
+    rng = np.random.default_rng(seed)
+
+    # Write pixel table
+    os.makedirs(radar_data_path + '/extract_radarpixel', exist_ok=True)
+    pixel_table = pd.DataFrame({'STN_ID': stations.index, 'pixel_y': stations['pixel_y'].to_numpy(), 'pixel_x': stations['pixel_x'].to_numpy()})
+    pixel_table.to_excel(radar_data_path + '/extract_radarpixel/raingauge_coordinate.xlsx', sheet_name='Sheet1', index=False)
+
+    # Write raster with the geographic transform of the radar image
+    transform = Affine(region['pixel_size'], 0, region['west'], 0, -region['pixel_size'], region['north'])
+    with rasterio.open(radar_data_path + '/extract_radarpixel/raster_radar_sattahip.tif', 'w', driver='GTiff', width=resolution, height=resolution, \
+                       count=1, dtype='uint8', crs='EPSG:4326', transform=transform) as raster:
+        raster.write(np.zeros((1, resolution, resolution), dtype=np.uint8))
+
+    # Convert all scans to dBZ at once
+    dbz = reflectivity_dbz(rain, climatology['a'], climatology['b'])
+    cell_size = -(-resolution // rain.shape[1])
+
+    # Loop over scans, skipping missing ones
+    n_scans = 0
+    keep = rng.random(len(times)) >= missing_scan_fraction
+    for time, scan, kept in zip(times, dbz, keep):
+        if not kept:
+            continue
+
+        # Scale grid up to the image
+        image = np.repeat(np.repeat(scan, cell_size, axis=0), cell_size, axis=1)[:resolution, :resolution]
+
+        day_path = radar_data_path + time.strftime('/radar_png/%Y/%m/%d')
+        os.makedirs(day_path, exist_ok=True)
+        Image.fromarray(image).save(day_path + time.strftime('/%Y%m%d%H%M%S.png'))
+        n_scans += 1
+
+    return n_scans
+
+
+def write_rain_gauge_tree(rain_gauge_data_path, stations, intensity, times, measurements_per_hour=10, missing_fraction=0.0, seed=0):
+    '''
+    Method to write rain gauge data in the layout read by load_rain_gauge_data: HII totals per 10 min as excel, EWS totals per 15 min as csv
+    and the location sheets HII_Location.xlsx and EWS_Location.xlsx.
+
+    @param rain_gauge_data_path str: Directory to write the rain gauge data to.
+    @param stations DataFrame: Stations from place_stations.
+    @param intensity array[float]: Rain intensity at the stations of shape (scans, stations).
+    @param times DatetimeIndex: Times of the scans.
+    @param measurements_per_hour int: Number of scans per hour.
+    @param missing_fraction float: Fraction of totals that are missing.
+    @param seed int: Seed of the random generator.
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(rain_gauge_data_path + '/HII_10min', exist_ok=True)
+    os.makedirs(rain_gauge_data_path + '/EWS_15min', exist_ok=True)
+    hii = (stations['network'] == 'HII').to_numpy()
+
+    # Loop over years
+    for year in np.unique(times.year):
+        in_year = np.asarray(times.year == year)
+
+        # Write HII totals per 10 min
+        totals, interval_times = gauge_totals(intensity[in_year][:, hii], times[in_year], 10, measurements_per_hour, missing_fraction=missing_fraction, rng=rng)
+        rain_HII = pd.DataFrame(totals, index=pd.Index(interval_times, name='Datetime'), columns=stations.index[hii])
+        rain_HII.to_excel(rain_gauge_data_path + '/HII_10min/raingauge_HII_Phetchaburi_10min_' + str(year) + '.xlsx')
+
+        # Write EWS totals per 15 min
+        totals, interval_times = gauge_totals(intensity[in_year][:, ~hii], times[in_year], 15, measurements_per_hour, missing_fraction=missing_fraction, rng=rng)
+        rain_EWS = pd.DataFrame(totals, columns=stations.index[~hii])
+        rain_EWS.insert(0, 'Datetime', interval_times.strftime('%d/%m/%Y %H:%M'))
+        rain_EWS.to_csv(rain_gauge_data_path + '/EWS_15min/EWS_station_phetchaburi_project_15m_' + str(year) + '.csv', index=False)
+
+    # Write location sheets
+    location_HII, location_EWS = location_sheets(stations)
+    location_HII.to_excel(rain_gauge_data_path + '/HII_Location.xlsx')
+    location_EWS.to_excel(rain_gauge_data_path + '/EWS_Location.xlsx')
+
+
+def generate_dataset(root_path, years=(2022,), months=('01',), days=('01', '02'), n_stations=30, hii_fraction=0.5, resolution=800, grid_size=16, \
+                     climatology=None, outside_fraction=0.05, missing_fraction=0.01, missing_scan_fraction=0.02, seed=0):
+    '''
+    Method to write a synthetic dataset with radar data in root_path/radar and rain gauge data in root_path/rain_gauge.
+    The settings are stored in root_path/dataset.json, an existing dataset with the same settings is reused.
+
+    @param root_path str: Directory to write the dataset to.
+    @param years list[int]: Years to simulate.
+    @param months list[str]: Months to simulate (e.g. '01').
+    @param days list[str]: Days of the month to simulate (e.g. '01'), days that do not exist in a month are skipped.
+    @param n_stations int: Number of rain gauge stations.
+    @param hii_fraction float: Fraction of HII stations, the others are EWS stations.
+    @param resolution int: Resolution of the radar image.
+    @param grid_size int: Number of grid cells of the rain field along each axis.
+    @param climatology dict: Climatology as in default_climatology, default if None.
+    @param outside_fraction float: Fraction of stations outside the radar region.
+    @param missing_fraction float: Fraction of rain gauge totals that are missing.
+    @param missing_scan_fraction float: Fraction of radar scans without a file.
+    @param seed int: Seed of the random generator.
+
+    @return dataset dict: Settings, paths of the radar and rain gauge data and the number of scans written.
+    '''
+    settings = {'years': [int(year) for year in years], 'months': list(months), 'days': list(days), 'n_stations': n_stations, 'hii_fraction': hii_fraction, \
+                'resolution': resolution, 'grid_size': grid_size, 'climatology': {**default_climatology, **(climatology or {})}, \
+                'outside_fraction': outside_fraction, 'missing_fraction': missing_fraction, 'missing_scan_fraction': missing_scan_fraction, 'seed': seed}
+
+    # Reuse existing dataset with the same settings
+    if os.path.exists(root_path + '/dataset.json'):
+        with open(root_path + '/dataset.json') as file:
+            dataset = json.load(file)
+        if dataset['settings'] == settings:
+            return dataset
+
+    # Get the days that exist
+    dates = pd.to_datetime([str(year) + month + day for year in settings['years'] for month in months for day in days], format='%Y%m%d', errors='coerce')
+    dates = dates[dates.notna()].sort_values()
+
+    # Simulate rain on the grid and at the stations
+    times = scan_times(dates)
+    stations = place_stations(n_stations, resolution, hii_fraction, outside_fraction, seed=seed)
+    rain = rain_field(times, grid_size, settings['climatology'], seed)
+    intensity = station_rain(rain, stations, resolution)
+
+    # Write data
+    radar_data_path = root_path + '/radar'
+    rain_gauge_data_path = root_path + '/rain_gauge'
+    n_scans = write_radar_tree(radar_data_path, stations, rain, times, resolution, settings['climatology'], missing_scan_fraction, seed=seed)
+    write_rain_gauge_tree(rain_gauge_data_path, stations, intensity, times, missing_fraction=missing_fraction, seed=seed)
+
+    # Store settings last, so they mark a complete dataset
+    dataset = {'settings': settings, 'radar_data_path': radar_data_path, 'rain_gauge_data_path': rain_gauge_data_path, 'n_scans': n_scans, \
+               'n_days': len(dates)}
+    with open(root_path + '/dataset.json', 'w') as file:
+        json.dump(dataset, file, indent=2)
+
+    return dataset
@@ -1,5 +1,15 @@
+import os
 import numpy as np
-from scipy.optimize import minimize
+import pandas as pd
+from itertools import repeat
+from multiprocessing import shared_memory
+from scipy.optimize import minimize, minimize_scalar
+from parallel import ordered_map
+from profiling import profile_stage
+
+# Minimum number of pairs of Z and R to calibrate on
+min_pairs = 2
+
 
 def objective(params, Z, R):
     '''
@@ -24,7 +34,125 @@ def objective(params, Z, R):
     return MSE
 
 
-def calibrate(Z, R, a_guess=400, b_guess=1.6, b_lb=1.5, b_ub=1.6):
+def objective_and_gradient(params, log_Z, R, buffers=None):
+    '''
+    Method to compute the objective together with its exact gradient.
+
+    @param params tuple[float]: Parameters a and b.
+    @param log_Z array[float]: Natural logarithm of the reflectivity values of all events.
+    @param R array[float]: Vector of rainfall values of all events.
+    @param buffers tuple[array]: Two arrays of the shape of log_Z to compute in, allocated if None.
+
+    @return MSE float: Mean Squared Error to be minimized.
+    @return gradient array[float]: Derivatives of the MSE to a and b.
+    '''
+    # Extract parameters
+    a, b = params
+    if buffers is None:
+        buffers = (np.empty_like(log_Z), np.empty_like(log_Z))
+    log_ratio, radar_rain = buffers
+
+    # Compute radar rain (Z/a)**(1/b) as a single exponential
+    np.subtract(log_Z, np.log(a), out=log_ratio)
+    np.multiply(log_ratio, 1/b, out=radar_rain)
+    np.exp(radar_rain, out=radar_rain)
+    # Convert from 6min to 60min
+    radar_rain_hour = np.mean(radar_rain, axis=1)
+    # Compute Mean Squared Error
+    error = radar_rain_hour - R
+    MSE = np.mean(error**2)
+
+    # Derivatives of the hourly radar rain to a and b
+    d_hour_d_a = -radar_rain_hour / (a*b)
+    # Zero reflectivity gives 0*log(0) = nan, whose limit is 0
+    with np.errstate(invalid='ignore'):
+        np.multiply(radar_rain, log_ratio, out=log_ratio)
+    log_ratio[radar_rain == 0] = 0
+    d_hour_d_b = -np.mean(log_ratio, axis=1) / b**2
+
+    # Chain rule
+    gradient = np.array([2*np.mean(error*d_hour_d_a), 2*np.mean(error*d_hour_d_b)])
+
+    return MSE, gradient
+
+
+def profile_objective(b, log_Z, R):
+    '''
+    Method to compute the objective for fixed b, with the optimal a solved in closed form.
+    For fixed b the radar rain is a**(-1/b) * mean(Z**(1/b)), so the MSE is quadratic in a**(-1/b).
+
+    @param b float: Parameter b.
+    @param log_Z array[float]: Natural logarithm of the reflectivity values of all events.
+    @param R array[float]: Vector of rainfall values of all events.
+
+    @return MSE float: Mean Squared Error for the optimal a.
+    @return a float: Optimal a for this b.
+    '''
+    # Hourly mean of Z**(1/b) as a single exponential
+    radar_moment = np.mean(np.exp(log_Z / b), axis=1)
+
+    # Least squares scale and corresponding a
+    scale = np.dot(radar_moment, R) / np.dot(radar_moment, radar_moment)
+    a = scale**(-b)
+
+    MSE = np.mean((scale*radar_moment - R)**2)
+
+    return MSE, a
+
+
+def minimize_objective(Z, R, a_guess=400, b_guess=1.6, b_lb=1.5, b_ub=1.6, method='gradient'):
+    '''
+    Method which minimizes the objective with the given method and counts the evaluations.
+    With fewer than min_pairs pairs a and b are nan.
+
+    @param method str: 'gradient' for L-BFGS-B with the exact gradient, 'profile' for a 1-D search over b
+                       with a solved in closed form, or 'finite_difference' for L-BFGS-B with a numerical gradient.
+
+    @return a float: Value for a that minimizes objective function.
+    @return b float: Value for b that minimizes objective function.
+    @return nfev int: Number of evaluations, each a full pass over Z.
+    '''
+    Z = np.asarray(Z, dtype=float)
+    R = np.asarray(R, dtype=float)
+
+    # Fitting two parameters needs at least two pairs, do not report the initial guess as a fit
+    if len(R) < min_pairs:
+        print('Warning: unable to calibrate on ' + str(len(R)) + ' pairs of Z and R, a and b set to nan.')
+        return np.nan, np.nan, 0
+
+    if method == 'finite_difference':
+        with profile_stage('minimize'):
+            result = minimize(objective, [a_guess, b_guess], args=(Z, R), bounds=((None, None), (b_lb, b_ub)))
+        a, b = result.x
+        return a, b, result.nfev
+
+    # Precompute logarithm once
+    with np.errstate(divide='ignore'):
+        log_Z = np.log(Z)
+
+    if method == 'gradient':
+        buffers = (np.empty_like(log_Z), np.empty_like(log_Z))
+        with profile_stage('minimize'):
+            result = minimize(objective_and_gradient, [a_guess, b_guess], args=(log_Z, R, buffers), jac=True, bounds=((None, None), (b_lb, b_ub)))
+        a, b = result.x
+        return a, b, result.nfev
+
+    if method == 'profile':
+        # Only a single b is allowed
+        if b_lb == b_ub:
+            _, a = profile_objective(b_lb, log_Z, R)
+            return a, b_lb, 1
+        with profile_stage('minimize'):
+            result = minimize_scalar(lambda b: profile_objective(b, log_Z, R)[0], bounds=(b_lb, b_ub), method='bounded')
+        b = result.x
+        _, a = profile_objective(b, log_Z, R)
+        return a, b, result.nfev + 1
+
+    raise Exception("Unknown calibration method: " + str(method))
+
+
+@profile_stage('calibrate')
+def calibrate(Z, R, a_guess=400, b_guess=1.6, b_lb=1.5, b_ub=1.6, method='gradient'):
     '''
     Method which learns the parameters a and b in the relationship Z = aR^b.
 
@@ -34,21 +162,362 @@ def calibrate(Z, R, a_guess=400, b_guess=1.6, b_lb=1.5, b_ub=1.6):
     @param b_guess float: Initial guess for parameter b.
     @param b_lb float: Lower bound for parameter b.
     @param b_ub float: Upper bound for parameter b.
+    @param method str: 'gradient', 'profile' or 'finite_difference', see minimize_objective.
 
     @return a float: Value for a that minimizes objective function.
     @return b float: Value for b that minimizes objective function.
     '''
+    a, b, _ = minimize_objective(Z, R, a_guess, b_guess, b_lb, b_ub, method)
+
+    return a, b
+
+
+def compare_calibration_methods(Z, R, a_guess=400, b_guess=1.6, b_lb=1.5, b_ub=1.6):
+    '''
+    Method to report the result and number of evaluations of each calibration method.
+
+    @return report DataFrame: Per method a, b, MSE, evaluations and evaluations saved compared with finite differences.
+    '''
+    rows = []
+    for method in ['finite_difference', 'gradient', 'profile']:
+        a, b, nfev = minimize_objective(Z, R, a_guess, b_guess, b_lb, b_ub, method)
+        rows.append({'method': method, 'a': a, 'b': b, 'MSE': objective((a, b), Z, R), 'nfev': nfev})
+
+    report = pd.DataFrame(rows)
+    report['nfev_saved'] = report['nfev'].iloc[0] - report['nfev']
+
+    return report
+
+
+def save_calibration_data(path, Z, R):
+    '''
+    Method to save Z and R as .npy files that can be streamed with memory mapping.
+
+    @param path str: Directory to save Z.npy and R.npy in.
+    @param Z array[float]: Matrix of reflectivity values of all events (one row per hour).
+    @param R array[float]: Vector of rainfall values of all events.
+    '''
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'Z.npy'), np.asarray(Z, dtype=float))
+    np.save(os.path.join(path, 'R.npy'), np.asarray(R, dtype=float))
+
+
+def iter_calibration_chunks(source, chunk_size=100000):
+    '''
+    Method to iterate once over a chunked source of hourly Z blocks and R values.
+
+    @param source: One of
+        - function returning an iterable of (Z_hour_block, R) pairs, called again for every pass,
+        - tuple (Z, R) of (memory-mapped) arrays, sliced into chunks,
+        - directory with Z.npy and R.npy (see save_calibration_data), memory-mapped,
+        - .parquet file with one column per scan in the hour followed by a column R, read per row batch.
+    @param chunk_size int: Number of hours per chunk, for sources that are not chunked already.
+
+    @return chunks generator: (Z_hour_block, R) pairs.
+    '''
+    if callable(source):
+        yield from source()
+        return
+
+    if isinstance(source, str) and source.endswith('.parquet'):
+        # Optional dependency, only needed for Parquet sources
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size):
+            block = batch.to_pandas().to_numpy(dtype=float)
+            yield block[:, :-1], block[:, -1]
+        return
+
+    if isinstance(source, str):
+        Z = np.load(os.path.join(source, 'Z.npy'), mmap_mode='r')
+        R = np.load(os.path.join(source, 'R.npy'), mmap_mode='r')
+    else:
+        Z, R = source
+
+    for start in range(0, len(R), chunk_size):
+        yield np.asarray(Z[start:start+chunk_size], dtype=float), np.asarray(R[start:start+chunk_size], dtype=float)
+
+
+def count_calibration_pairs(source, chunk_size=100000):
+    '''
+    Method to count the pairs of Z and R in a chunked source, from the metadata where possible.
+
+    @param source: Chunked source of Z and R, see iter_calibration_chunks.
+    @param chunk_size int: Number of hours per chunk.
+
+    @return n int: Number of pairs.
+    '''
+    if isinstance(source, str) and source.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(source).metadata.num_rows
+
+    if isinstance(source, str):
+        return len(np.load(os.path.join(source, 'R.npy'), mmap_mode='r'))
+
+    if not callable(source):
+        return len(source[1])
+
+    return sum(len(R_block) for _, R_block in iter_calibration_chunks(source, chunk_size))
+
+
+def streaming_objective(params, source, chunk_size=100000):
+    '''
+    Method to compute the objective as a sum over chunks, so memory is bounded by the chunk size.
+
+    @return MSE float: Mean Squared Error to be minimized.
+    '''
+    n = 0
+    squared_error = 0.0
+    for Z_block, R_block in iter_calibration_chunks(source, chunk_size):
+        if len(R_block) == 0:
+            continue
+
+        # Weigh chunk means by their number of hours
+        n += len(R_block)
+        squared_error += objective(params, Z_block, R_block) * len(R_block)
+
+    if n == 0:
+        return np.nan
+
+    return squared_error / n
+
+
+def streaming_objective_and_gradient(params, source, chunk_size=100000):
+    '''
+    Method to compute the objective and its gradient as sums over chunks, so memory is bounded by the chunk size.
+
+    @return MSE float: Mean Squared Error to be minimized.
+    @return gradient array[float]: Derivatives of the MSE to a and b.
+    '''
+    n = 0
+    squared_error = 0.0
+    gradient = np.zeros(2)
+    for Z_block, R_block in iter_calibration_chunks(source, chunk_size):
+        if len(R_block) == 0:
+            continue
+        with np.errstate(divide='ignore'):
+            log_Z = np.log(Z_block)
+        MSE_block, gradient_block = objective_and_gradient(params, log_Z, R_block)
+
+        # Weigh chunk means by their number of hours
+        n += len(R_block)
+        squared_error += MSE_block * len(R_block)
+        gradient += gradient_block * len(R_block)
+
+    if n == 0:
+        return np.nan, np.full(2, np.nan)
+
+    return squared_error / n, gradient / n
+
+
+def streaming_profile_objective(b, source, chunk_size=100000):
+    '''
+    Method to compute the profile objective for fixed b from sums over chunks.
+
+    @return MSE float: Mean Squared Error for the optimal a.
+    @return a float: Optimal a for this b.
+    '''
+    n = 0
+    moment_R = 0.0
+    moment_moment = 0.0
+    R_R = 0.0
+    for Z_block, R_block in iter_calibration_chunks(source, chunk_size):
+        with np.errstate(divide='ignore'):
+            radar_moment = np.mean(np.exp(np.log(Z_block) / b), axis=1)
+        n += len(R_block)
+        moment_R += np.dot(radar_moment, R_block)
+        moment_moment += np.dot(radar_moment, radar_moment)
+        R_R += np.dot(R_block, R_block)
+
+    if n == 0:
+        return np.nan, np.nan
+
+    # Least squares scale, MSE expanded in the sums
+    scale = moment_R / moment_moment
+    MSE = (R_R - 2*scale*moment_R + scale**2*moment_moment) / n
+
+    return MSE, scale**(-b)
+
+
+@profile_stage('calibrate_streaming')
+def calibrate_streaming(source, chunk_size=100000, a_guess=400, b_guess=1.6, b_lb=1.5, b_ub=1.6, method='gradient'):
+    '''
+    Method which learns a and b out-of-core, passing over a chunked source once per evaluation.
+
+    @param source: Chunked source of Z and R, see iter_calibration_chunks.
+    @param chunk_size int: Number of hours per chunk.
+    @param method str: 'gradient', 'profile' or 'finite_difference', see minimize_objective.
+
+    @return a float: Value for a that minimizes objective function, nan with fewer than min_pairs pairs.
+    @return b float: Value for b that minimizes objective function, nan with fewer than min_pairs pairs.
+    '''
+    # Fitting two parameters needs at least two pairs, do not report the initial guess as a fit
+    n_pairs = count_calibration_pairs(source, chunk_size)
+    if n_pairs < min_pairs:
+        print('Warning: unable to calibrate on ' + str(n_pairs) + ' pairs of Z and R, a and b set to nan.')
+        return np.nan, np.nan
+
+    if method == 'finite_difference':
+        with profile_stage('minimize'):
+            result = minimize(streaming_objective, [a_guess, b_guess], args=(source, chunk_size), bounds=((None, None), (b_lb, b_ub)))
+        a, b = result.x
+        return a, b
+
+    if method == 'gradient':
+        with profile_stage('minimize'):
+            result = minimize(streaming_objective_and_gradient, [a_guess, b_guess], args=(source, chunk_size), jac=True, bounds=((None, None), (b_lb, b_ub)))
+        a, b = result.x
+        return a, b
+
+    if method == 'profile':
+        if b_lb == b_ub:
+            _, a = streaming_profile_objective(b_lb, source, chunk_size)
+            return a, b_lb
+        with profile_stage('minimize'):
+            result = minimize_scalar(lambda b: streaming_profile_objective(b, source, chunk_size)[0], bounds=(b_lb, b_ub), method='bounded')
+        _, a = streaming_profile_objective(result.x, source, chunk_size)
+        return a, result.x
+
+    raise Exception("Unknown streaming calibration method: " + str(method))
+
+
+# Views on the shared Z and R arrays in each worker process
+shared_arrays = {}
+
+
+def attach_shared_arrays(specs):
+    '''
+    Method to attach to shared memory blocks and store views on them, called once per worker process.
+
+    @param specs dict{str: tuple}: Per array its shared memory name, shape and dtype.
+    '''
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        # Keep the block alive together with the view
+        shared_arrays[key] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+
+def fit_subset(subset, indices, a_guess, b_guess, b_lb, b_ub, method):
+    '''
+    Method to calibrate on a subset of the shared Z and R arrays.
+
+    @param subset str: Name of the subset.
+    @param indices array[int]: Rows of Z and R in the subset.
+
+    @return fit dict: Subset name, number of rows, a, b and MSE, nan if the subset has fewer than min_pairs rows.
+    '''
+    # Skip subsets too small to fit, calibrate_batch reports them
+    if len(indices) < min_pairs:
+        return {'subset': subset, 'n': len(indices), 'a': np.nan, 'b': np.nan, 'MSE': np.nan}
+
+    Z = shared_arrays['Z'][1][indices]
+    R = shared_arrays['R'][1][indices]
+
+    # Calibrate and evaluate
+    a, b = calibrate(Z, R, a_guess, b_guess, b_lb, b_ub, method)
+    MSE = objective((a, b), Z, R)
+
+    return {'subset': subset, 'n': len(indices), 'a': a, 'b': b, 'MSE': MSE}
+
+
+@profile_stage('calibrate_batch')
+def calibrate_batch(Z, R, subsets, workers=1, a_guess=400, b_guess=1.6, b_lb=1.5, b_ub=1.6, method='gradient'):
+    '''
+    Method which learns a and b for many subsets of the data, in parallel if requested.
+    The workers read Z and R from shared memory, so only the row indices are sent to them.
+
+    @param Z array[float]: Vector of reflectivity values of all events.
+    @param R array[float]: Vector of rainfall values of all events.
+    @param subsets dict{str: array[int]}: Rows of Z and R per subset to calibrate on.
+    @param workers int: Number of processes.
+
+    @return fits DataFrame: Subset name, number of rows, a, b and MSE per subset, nan for subsets with fewer than min_pairs rows.
+    '''
+    # Report subsets too small to fit
+    skipped = [name for name, indices in subsets.items() if len(indices) < min_pairs]
+    if len(skipped) > 0:
+        print('Warning: skipping ' + str(len(skipped)) + ' subsets with fewer than ' + str(min_pairs) + ' pairs of Z and R: ' + ', '.join(skipped))
+
+    blocks = []
+    specs = {}
+    try:
+        # Copy Z and R into shared memory once
+        for key, array in (('Z', np.ascontiguousarray(Z, dtype=float)), ('R', np.ascontiguousarray(R, dtype=float))):
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            blocks.append(block)
+            specs[key] = (block.name, array.shape, array.dtype.str)
+
+        # Calibrate all subsets
+        names = list(subsets.keys())
+        fits = list(ordered_map(fit_subset, names, [subsets[name] for name in names], repeat(a_guess), repeat(b_guess), repeat(b_lb), repeat(b_ub), repeat(method), \
+                                workers=workers, initializer=attach_shared_arrays, initargs=(specs,)))
+    finally:
+        # Release shared memory
+        shared_arrays.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return pd.DataFrame(fits, columns=['subset', 'n', 'a', 'b', 'MSE'])
+
+
+def bootstrap_subsets(groups, n_resamples=200, seed=0):
+    '''
+    Method to create bootstrap resamples of whole groups (e.g. events) of rows.
+
+    @param groups array: Group label per row.
+    @param n_resamples int: Number of resamples.
+    @param seed int: Seed of the random generator.
+
+    @return subsets dict{str: array[int]}: Rows per resample.
+    '''
+    # Get the rows of each group
+    labels, group_idx = np.unique(np.asarray(groups), return_inverse=True)
+    order = np.argsort(group_idx, kind='stable')
+    rows_per_group = np.split(order, np.cumsum(np.bincount(group_idx, minlength=len(labels)))[:-1])
+
+    # Draw groups with replacement
+    rng = np.random.default_rng(seed)
+    subsets = {}
+    for i in range(n_resamples):
+        drawn = rng.integers(0, len(labels), len(labels))
+        subsets['bootstrap_' + str(i)] = np.concatenate([rows_per_group[g] for g in drawn])
+
+    return subsets
+
+
+def leave_one_out_subsets(labels):
+    '''
+    Method to create subsets leaving out all rows of one label (e.g. station) at a time.
 
-    # Initial guess for a and b
-    init_guess = [a_guess, b_guess]
+    @param labels array: Label per row.
 
-    # Bounds
-    bounds = ((None, None), (b_lb, b_ub))
+    @return subsets dict{str: array[int]}: Rows per left out label.
+    '''
+    labels = np.asarray(labels)
+    return {'without_' + str(label): np.nonzero(labels != label)[0] for label in np.unique(labels)}
+
+
+def group_subsets(labels):
+    '''
+    Method to create a subset per label (e.g. month).
+
+    @param labels array: Label per row.
+
+    @return subsets dict{str: array[int]}: Rows per label.
+    '''
+    labels = np.asarray(labels)
+    return {str(label): np.nonzero(labels == label)[0] for label in np.unique(labels)}
 
-    # Minimize objective
-    result = minimize(objective, init_guess, args=(Z, R), bounds=bounds)
 
-    # Extract optimal a and b
-    a, b = result.x
+def bootstrap_interval(fits, level=0.95):
+    '''
+    Method to compute percentile confidence intervals of a and b from bootstrap fits.
 
-    return a, b
\ No newline at end of file
+    @param fits DataFrame: Result of calibrate_batch including the bootstrap subsets.
+    @param level float: Confidence level.
+
+    @return interval DataFrame: Lower and upper bound of a and b, over the bootstrap fits that succeeded.
+    '''
+    bootstrap = fits[fits['subset'].str.startswith('bootstrap_')].dropna(subset=['a', 'b'])
+    return bootstrap[['a', 'b']].quantile([(1 - level) / 2, (1 + level) / 2]).set_axis(['lower', 'upper'])
@@ -1,33 +1,125 @@
 import numpy as np
 import pandas as pd
 import geopy.distance
-import matplotlib # For plot
-import matplotlib.pyplot as plt
 from scipy.signal import correlate
-import tkinter as tk
-from tkinter import *
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
 import random
+from profiling import profile_stage
+from diagnostics import submit_kagan, submit_DM_curves, period_name, diagnostics_enabled
 
 
-def compute_station_distances(location_filtered):
-    # Init empty distance matrix
-    empty_gauges = np.zeros((len(location_filtered), len(location_filtered)))
+# Mean earth radius and WGS-84 ellipsoid (in km)
+EARTH_RADIUS = 6371.0088
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
 
-    # Loop over stations
-    for i in range(len(location_filtered)):
-        # Retrieve its coordinates
-        coordinate_1 = (location_filtered['LAT'].iloc[i], location_filtered['LONG'].iloc[i])
-        # Loop over remaining stations
-        for j in range(i, len(location_filtered)):
-            # Retrieve its coordinates
-            coordinate_2 = (location_filtered['LAT'].iloc[j], location_filtered['LONG'].iloc[j])
-            # Compute distance between stations
-            empty_gauges[i, j] = geopy.distance.geodesic(coordinate_1, coordinate_2).km
+
+def haversine_distances(lat, lon):
+    '''
+    Method to compute the great-circle distances between all pairs of coordinates on a sphere.
+
+    @param lat array[float]: Latitudes in degrees.
+    @param lon array[float]: Longitudes in degrees.
+
+    @return distances array[float]: Symmetric matrix of distances in km (within 0.6% of the geodesic distance).
+    '''
+    # Convert to radians and broadcast into all pairs
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    dlat = lat[None, :] - lat[:, None]
+    dlon = lon[None, :] - lon[:, None]
+
+    # Haversine formula
+    h = np.sin(dlat / 2)**2 + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin(dlon / 2)**2
+    distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+    return distances
+
+
+def vincenty_distances(lat, lon, tol=1e-12, max_iter=200):
+    '''
+    Method to compute the geodesic distances between all pairs of coordinates on the WGS-84 ellipsoid.
+    Agrees with geopy.distance.geodesic within 1 mm; pairs for which the iteration does not converge
+    (nearly antipodal points) are computed with geopy instead.
+
+    @param lat array[float]: Latitudes in degrees.
+    @param lon array[float]: Longitudes in degrees.
+    @param tol float: Convergence tolerance of the longitude on the auxiliary sphere (in radians).
+    @param max_iter int: Maximum number of iterations.
+
+    @return distances array[float]: Symmetric matrix of distances in km.
+    '''
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    b = (1 - WGS84_F) * WGS84_A
+
+    # Reduced latitudes and longitude differences of all pairs
+    U = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat)))
+    sinU1, cosU1 = np.sin(U)[:, None], np.cos(U)[:, None]
+    sinU2, cosU2 = np.sin(U)[None, :], np.cos(U)[None, :]
+    L = np.radians(lon[None, :] - lon[:, None])
+
+    # Iterate the longitude on the auxiliary sphere for all pairs at once
+    lam = L
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cosU2 * sin_lam)**2 + (cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)**2)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0, cosU1 * cosU2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha)
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2)))
+            converged = np.abs(lam - lam_prev) < tol
+            if converged.all():
+                break
+
+    # Distance from the converged solution
+    u2 = cos2_alpha * (WGS84_A**2 - b**2) / b**2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m**2) - \
+                  B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sigma_m**2)))
+    distances = b * A * (sigma - delta_sigma)
+
+    # Fall back to geopy for pairs that did not converge
+    for i, j in zip(*np.nonzero(~converged | np.isnan(distances))):
+        distances[i, j] = geopy.distance.geodesic((lat[i], lon[i]), (lat[j], lon[j])).km
+
+    return distances
+
+
+@profile_stage('compute_station_distances')
+def compute_station_distances(location_filtered, method='vincenty'):
+    '''
+    Method to compute the distances between all stations.
+
+    @param location_filtered DataFrame: Coordinates (LAT, LONG) of the stations under investigation.
+    @param method str: 'vincenty' for ellipsoidal distances (within 1 mm of geopy) or 'haversine' for faster spherical distances.
+
+    @return distances_gauges DataFrame: Symmetric matrix of distances between stations in km.
+    @return index_distances_1 Index: Stations in the order of the matrix.
+    '''
+    # Retrieve coordinates
+    lat = location_filtered['LAT'].to_numpy(dtype=float)
+    lon = location_filtered['LONG'].to_numpy(dtype=float)
+
+    # Compute distances between all stations at once
+    if method == 'vincenty':
+        distances = vincenty_distances(lat, lon)
+    elif method == 'haversine':
+        distances = haversine_distances(lat, lon)
+    else:
+        raise Exception("Unknown distance method: " + str(method))
 
     # Convert distance matrix into DataFrame
     index_distances_1 = location_filtered.index
-    distances_gauges = pd.DataFrame(data=empty_gauges, index=index_distances_1, columns=index_distances_1)
+    distances_gauges = pd.DataFrame(data=distances, index=index_distances_1, columns=index_distances_1)
 
     return distances_gauges, index_distances_1
 
@@ -47,20 +139,83 @@ def correl(station_1, station_2):
     return correlation[0,1]
 
 
-def compute_correlations(location_filtered, rain_data_daily, index_distances_1):
+def correlation_matrix(data, nan_policy='strict', dtype=np.float64, block_size=None):
+    '''
+    Method to calculate the correlations between all columns of a matrix at once.
+
+    @param data array[float]: Matrix with a column per station and a row per timestep.
+    @param nan_policy str: 'strict' gives nan for every pair involving a station with missing values (as np.corrcoef),
+                           'pairwise' uses only the timesteps where both stations have values (as DataFrame.corr).
+    @param dtype type: Floating point type to compute in, float32 halves the memory use.
+    @param block_size int: Number of stations to correlate at once with all others, all at once if None.
+
+    @return correlations array[float]: Symmetric correlation matrix.
+    '''
+    data = np.asarray(data, dtype=dtype)
+    n_stations = data.shape[1]
+    if block_size is None:
+        block_size = max(n_stations, 1)
+
     # Init correlation matrix
-    corr_empty = np.empty((len(location_filtered), len(location_filtered)))
-
-    # Loop over stations
-    for i in range(len(location_filtered)):
-        # Get rain data of station
-        array_filtered_1 = rain_data_daily.iloc[:, i]
-        # Loop over remaining stations
-        for j in range(len(location_filtered)):
-            # Get rain data of station
-            array_filtered_2 = rain_data_daily.iloc[:, j]
-            # Compute and store correlation between stations
-            corr_empty[i, j] = correl(array_filtered_1, array_filtered_2)
+    correlations = np.empty((n_stations, n_stations), dtype=dtype)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if nan_policy == 'strict':
+            # Center and normalize each column, so correlations are inner products
+            centered = data - data.mean(axis=0)
+            normalized = centered / np.sqrt((centered**2).sum(axis=0))
+
+            # Correlate block of stations with all stations
+            for start in range(0, n_stations, block_size):
+                correlations[start:start+block_size] = normalized[:, start:start+block_size].T @ normalized
+
+        elif nan_policy == 'pairwise':
+            # Center on column means to keep the sums small, and mask missing values
+            valid = ~np.isnan(data)
+            centered = np.where(valid, data - np.nanmean(data, axis=0), 0).astype(dtype)
+            valid = valid.astype(dtype)
+            squared = centered**2
+
+            # Compute sums over the timesteps where both stations have values, per block of stations
+            for start in range(0, n_stations, block_size):
+                block = slice(start, start+block_size)
+                count = valid[:, block].T @ valid
+                sum_x = centered[:, block].T @ valid
+                sum_y = valid[:, block].T @ centered
+                sum_xx = squared[:, block].T @ valid
+                sum_yy = valid[:, block].T @ squared
+                sum_xy = centered[:, block].T @ centered
+
+                covariance = sum_xy - sum_x * sum_y / count
+                variance_x = sum_xx - sum_x**2 / count
+                variance_y = sum_yy - sum_y**2 / count
+                correlations[block] = covariance / np.sqrt(variance_x * variance_y)
+
+        else:
+            raise Exception("Unknown nan policy: " + str(nan_policy))
+
+    # Clip rounding errors, as np.corrcoef does
+    np.clip(correlations, -1, 1, out=correlations)
+
+    return correlations
+
+
+@profile_stage('compute_correlations')
+def compute_correlations(location_filtered, rain_data_daily, index_distances_1, nan_policy='strict', dtype=np.float64, block_size=None):
+    '''
+    Method to compute the correlations between all stations.
+
+    @param location_filtered DataFrame: Coordinates of the stations under investigation.
+    @param rain_data_daily DataFrame: Daily rain data per station.
+    @param index_distances_1 Index: Stations in the order of the distance matrix.
+    @param nan_policy str: 'strict' or 'pairwise' handling of missing values, see correlation_matrix.
+    @param dtype type: Floating point type to compute in.
+    @param block_size int: Number of stations to correlate at once, all at once if None.
+
+    @return corr_matrix DataFrame: Upper triangular correlation matrix.
+    '''
+    # Compute correlations of the stations in the order of the distance matrix
+    corr_empty = correlation_matrix(rain_data_daily[index_distances_1].to_numpy(), nan_policy, dtype, block_size)
 
     # Convert correlation matrix to DataFrame
     corr_matrix = pd.DataFrame(data=corr_empty, index=index_distances_1, columns=index_distances_1)
@@ -70,6 +225,40 @@ def compute_correlations(location_filtered, rain_data_daily, index_distances_1):
     return corr_matrix
 
 
+@profile_stage('kagan_analysis')
+def kagan_analysis(distances, correlations, min_correlation=0.6, max_error=0.1, max_radius_lim=50):
+    '''
+    Method to find the maximum radius in which two stations have a high enough correlation.
+
+    @param distances array[float]: Distances between stations, only the upper triangle is used.
+    @param correlations array[float]: Correlations between stations, only the upper triangle is used.
+    @param min_correlation float: Minimum required acceptable correlation.
+    @param max_error float: Amount of which the correlation of the pair found can deviate from min_correlation.
+    @param max_radius_lim float: Realistic upper limit for the maximum radius.
+
+    @return max_radius float: Largest distance of a pair within the correlation band, limited by max_radius_lim.
+    @return max_distance_stations tuple[int]: Matrix indices (i, j) of that pair, None if no pair is within the band.
+    '''
+    distances = np.asarray(distances, dtype=float)
+    correlations = np.asarray(correlations, dtype=float)
+
+    # Select the pairs in the upper triangle with a correlation inside the band
+    with np.errstate(invalid='ignore'):
+        band = (correlations >= min_correlation) & (np.abs(correlations - min_correlation) <= max_error)
+    band = np.triu(band, k=1) & ~np.isnan(distances)
+
+    # No pair inside the band
+    if not band.any():
+        return min(float('inf'), max_radius_lim), None
+
+    # Take the first pair with the largest distance
+    k = np.argmax(np.where(band, distances, -np.inf))
+    i, j = np.unravel_index(k, distances.shape)
+    max_radius = min(distances[i, j], max_radius_lim)
+
+    return max_radius, (int(i), int(j))
+
+
 def maximum_radius(distance_df, correlation_df, min_correlation, max_error, max_radius_lim):
     """
     maximum radius in which 2 stations have a high enough correlation. It has the following input parameters:
@@ -80,86 +269,149 @@ def maximum_radius(distance_df, correlation_df, min_correlation, max_error, max_
     (max_error = 0.10 means that a correlation value of 0.70 can be found because the radius is higher at this point)
     max_radius_lim = realistic value for maximum radius. If max_radius goes to 600 this is probably not realistic
     """
-    stations = [int(i) for i in range(0, len(distance_df))]
-    max_distance = -1
-    max_distance_stations = None
-    max_radius = float('inf')
+    max_radius, _ = kagan_analysis(distance_df.to_numpy(), correlation_df.to_numpy(), min_correlation, max_error, max_radius_lim)
 
-    for i in range(len(distance_df)):
-        for j in range(i+1, len(distance_df)):
-            distance = distance_df.iloc[i, j]
-            correlation = correlation_df.iloc[i, j]
-
-            if correlation >= min_correlation and abs(correlation - min_correlation) <= max_error:
-                if distance > max_distance:
-                    max_distance = distance
-                    max_distance_stations = (stations[i], stations[j])
-                    max_radius = distance_df.iloc[max_distance_stations[0], max_distance_stations[1]]
+    return max_radius
 
-    max_radius = min(max_radius, max_radius_lim)
 
-    return max_radius
+def distance_correlation_curve(distances, correlations, bins=25, quantiles=(0.1, 0.5, 0.9)):
+    '''
+    Method to summarize the decay of the correlation with distance per distance bin.
 
+    @param distances array[float]: Distances between stations, only the upper triangle is used.
+    @param correlations array[float]: Correlations between stations, only the upper triangle is used.
+    @param bins int or array[float]: Number of equally wide distance bins, or the bin edges.
+    @param quantiles tuple[float]: Quantiles of the correlation to compute per bin.
 
-def plot_kagan(distances_gauges, corr_matrix, max_radius, save_path=None):
+    @return curve DataFrame: Per bin its center, number of pairs, mean correlation and quantiles.
     '''
-    Method to plot and store the Kagan analysis.
+    distances = np.asarray(distances, dtype=float)
+    correlations = np.asarray(correlations, dtype=float)
+
+    # Get all pairs in the upper triangle with both values
+    i, j = np.triu_indices(len(distances), k=1)
+    pair_distances = distances[i, j]
+    pair_correlations = correlations[i, j]
+    valid = ~np.isnan(pair_distances) & ~np.isnan(pair_correlations)
+    pair_distances = pair_distances[valid]
+    pair_correlations = pair_correlations[valid]
+
+    # Assign each pair to a distance bin
+    if np.isscalar(bins):
+        upper = pair_distances.max() if len(pair_distances) > 0 else 1
+        bins = np.linspace(0, upper, bins + 1)
+    bins = np.asarray(bins, dtype=float)
+    bin_index = np.clip(np.searchsorted(bins, pair_distances, side='right') - 1, 0, len(bins) - 2)
+
+    # Aggregate the correlations per bin
+    grouped = pd.Series(pair_correlations).groupby(bin_index)
+    curve = pd.DataFrame({'count': grouped.size(), 'mean': grouped.mean()})
+    for q in quantiles:
+        curve['q' + str(int(round(q * 100)))] = grouped.quantile(q)
+
+    # Include empty bins and their centers
+    curve = curve.reindex(np.arange(len(bins) - 1))
+    curve['count'] = curve['count'].fillna(0).astype(int)
+    curve.insert(loc=0, column='distance', value=(bins[:-1] + bins[1:]) / 2)
+
+    return curve
+
+
+def find_neighbour_pairs(distance_df, max_radius, location_filtered=None, margin=0.01):
     '''
+    Method to find all pairs of stations closer to each other than the maximum radius.
 
-    plt.scatter(distances_gauges, corr_matrix, s=0.1)
-    plt.xlabel('Distance [km]')
-    plt.ylabel('Correlation [-]')
-    plt.axhline(0.6, c = 'r', ls ='--')
-    plt.axvline(max_radius, c = 'r', ls = '--')
-    plt.title('Kagan analysis')
-    plt.show()
+    @param distance_df DataFrame: Distances between stations in km.
+    @param max_radius float: Maximum distance between neighbouring stations in km.
+    @param location_filtered DataFrame: Coordinates (LAT, LONG) in the order of distance_df, to query a KD-tree instead of scanning all pairs.
+    @param margin float: Relative margin on the radius of the KD-tree query, covering the difference between spherical and ellipsoidal distances.
 
-    if save_path is not None:
-        plt.savefig(save_path)
+    @return pairs array[int]: Matrix indices (i, j) with i < j of all neighbouring stations.
+    '''
+    distances = distance_df.to_numpy()
 
+    if location_filtered is None:
+        # Check all pairs in the upper triangle at once
+        pairs = np.argwhere(np.triu(distances < max_radius, k=1))
+    else:
+        # Project the stations on the unit sphere
+        lat = np.radians(location_filtered['LAT'].to_numpy(dtype=float))
+        lon = np.radians(location_filtered['LONG'].to_numpy(dtype=float))
+        points = np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
 
-def compute_DM_data(distance_df, correlation_df, rain_gauge_df):
-    max_radius = maximum_radius(distance_df, correlation_df, 0.6, 0.10, 50)
-    
-    stations_dict = {}
-    
-    for index in distance_df.index:
-        stations_dict[index] = []
-    
-    for i in range(len(distance_df)):
-        for j in range(i+1, len(distance_df)):
-            distance = distance_df.iloc[i, j]
-            
-            if distance < max_radius:
-                station_i = distance_df.index[i]
-                station_j = distance_df.index[j]
-                
-                stations_dict[station_i].append(station_j)
-                stations_dict[station_j].append(station_i)
-            
-    cumulative_rainfall_dict = {}   
-    
-    # Iterate through the keys (row indices) in stations_dict
-    for index, stations in stations_dict.items():
-        # Filter relevant columns based on the station's stations_dict entry
-        relevant_columns = [station for station in stations if station in rain_gauge_df.columns]
-        relevant_data = rain_gauge_df[relevant_columns]
-        
-        # Calculate the cumulative sum for each column separately
-        cumulative_sums = relevant_data.cumsum()
-        
-        # Calculate the average cumulative sum across relevant columns (including the key column)
-        average_cumulative_sum = cumulative_sums.mean(axis=1)
-        
+        # Query candidate pairs within the chord length of the (slightly enlarged) radius
+        angle = min(max_radius * (1 + margin) / EARTH_RADIUS, np.pi)
+        pairs = cKDTree(points).query_pairs(2 * np.sin(angle / 2), output_type='ndarray')
+
+        # Keep the candidates that are within the radius according to the distance matrix
+        if len(pairs) > 0:
+            pairs = pairs[distances[pairs[:, 0], pairs[:, 1]] < max_radius]
+            pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    return pairs.reshape(-1, 2)
+
+
+@profile_stage('compute_DM_data')
+def compute_DM_data(distance_df, correlation_df, rain_gauge_df, location_filtered=None, max_radius=None):
+    '''
+    Method to compute the cumulative rainfall of each station and the average of its neighbours.
+
+    @param distance_df DataFrame: Distances between stations in km.
+    @param correlation_df DataFrame: Correlations between stations.
+    @param rain_gauge_df DataFrame: Rain data per station.
+    @param location_filtered DataFrame: Coordinates (LAT, LONG) in the order of distance_df, to find neighbours with a KD-tree.
+    @param max_radius float: Maximum distance between neighbouring stations from the Kagan analysis, computed with default settings if None.
+
+    @return cumulative_rainfall_dict dict: Per station the average cumulative rainfall of its neighbours and its own cumulative rainfall.
+    @return stations_dict dict: Per station the list of neighbouring stations.
+    '''
+    # Run the Kagan analysis if no radius is given
+    if max_radius is None:
+        max_radius, _ = kagan_analysis(distance_df.to_numpy(), correlation_df.to_numpy(), 0.6, 0.10, 50)
+
+    # Find neighbouring pairs in both directions, sorted by station and then by neighbour
+    pairs = find_neighbour_pairs(distance_df, max_radius, location_filtered)
+    source = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    target = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    order = np.lexsort((target, source))
+    source = source[order]
+    target = target[order]
+
+    # Split the neighbours per station
+    stations = distance_df.index
+    splits = np.searchsorted(source, np.arange(1, len(stations)))
+    stations_dict = {station: list(stations[neighbours]) for station, neighbours in zip(stations, np.split(target, splits))}
+
+    # Compute the cumulative sum of all columns once
+    cumulative_sums = rain_gauge_df.cumsum()
+    valid = cumulative_sums.notna().to_numpy(dtype=float)
+    cumulative_values = np.nan_to_num(cumulative_sums.to_numpy(dtype=float))
+
+    # Build sparse matrix selecting the neighbours (in rain_gauge_df) of each station
+    column_positions = pd.Series(np.arange(rain_gauge_df.shape[1]), index=rain_gauge_df.columns)
+    neighbour_columns = column_positions.reindex(stations[target]).to_numpy()
+    in_columns = ~np.isnan(neighbour_columns)
+    weights = csr_matrix((np.ones(in_columns.sum()), (neighbour_columns[in_columns].astype(int), source[in_columns])), \
+                         shape=(rain_gauge_df.shape[1], len(stations)))
+
+    # Average the cumulative sums of the neighbours of all stations in one product
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average_cum_sums = (weights.T @ cumulative_values.T).T / (weights.T @ valid.T).T
+
+    cumulative_rainfall_dict = {}
+
+    # Iterate through the stations
+    for k, index in enumerate(stations):
         # Store the average cumulative sum and the cumulative sum of the key column
         cumulative_rainfall_dict[index] = {
-            'average_cum_sum': average_cumulative_sum,
-            'key_column_cum_sum': rain_gauge_df[index].cumsum()  # Assuming index is the key column
+            'average_cum_sum': pd.Series(average_cum_sums[:, k], index=rain_gauge_df.index),
+            'key_column_cum_sum': cumulative_sums[index]  # Assuming index is the key column
         }
     
     return cumulative_rainfall_dict, stations_dict
 
 
+@profile_stage('dm_analysis')
 def get_DM_curves_data(rain_df, location_HII, location_EWS, min_correlation=0.6, max_error=0.1, max_radius_limit=50):
     '''
     Method to analyse DM curves.
@@ -191,13 +443,18 @@ def get_DM_curves_data(rain_df, location_HII, location_EWS, min_correlation=0.6,
     corr_matrix = compute_correlations(location_filtered, rain_data_daily, index_distances_1)
 
     # Compute the maximum radius to consider as neighbouring stations by Kagan analysis
-    max_radius = maximum_radius(distances_gauges, corr_matrix, min_correlation, max_error, max_radius_limit)
+    max_radius, _ = kagan_analysis(distances_gauges.to_numpy(), corr_matrix.to_numpy(), min_correlation, max_error, max_radius_limit)
 
-    # Plot the Kagan analysis
-    plot_kagan(distances_gauges, corr_matrix, max_radius)
+    # Plot the Kagan analysis with the binned decay curve over all pairs in the background, if figures are requested
+    if diagnostics_enabled():
+        curve = distance_correlation_curve(distances_gauges.to_numpy(), corr_matrix.to_numpy())
+        submit_kagan(distances_gauges.to_numpy(), corr_matrix.to_numpy(), max_radius, period_name('kagan', rain_data_daily.index), min_correlation, curve=curve)
 
     # Compute data for the DM curves
-    results, surrounding_stations = compute_DM_data(distances_gauges, corr_matrix, rain_data_daily)
+    results, surrounding_stations = compute_DM_data(distances_gauges, corr_matrix, rain_data_daily, location_filtered, max_radius)
+
+    # Plot the DM curves in the background, if figures are requested
+    submit_DM_curves(results, surrounding_stations, period_name('DM_curves', rain_data_daily.index))
 
     return results, surrounding_stations
 
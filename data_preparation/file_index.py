@@ -0,0 +1,209 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def select_days(times, months=None, days=None):
+    '''
+    Method to get the distinct days of a set of times, optionally only in the given months and days of the month.
+
+    @param times array[datetime64]: Times to get the days of.
+    @param months list[str]: Months to keep (e.g. '01'), all if None.
+    @param days list[str]: Days of the month to keep (e.g. '01'), all if None.
+
+    @return days DatetimeIndex: Sorted days.
+    '''
+    result = pd.DatetimeIndex(np.unique(np.asarray(times).astype('datetime64[D]')))
+    if months is not None:
+        result = result[result.month.isin([int(month) for month in months])]
+    if days is not None:
+        result = result[result.day.isin([int(day) for day in days])]
+    return result
+
+
+class FileIndex:
+    '''
+    Files in a directory tree sorted on the time in their name (YYYYMMDDHHMM...), answering time queries with binary search.
+    With a cache_path the listing is stored on disk and only directories that changed since are listed again.
+    '''
+
+    def __init__(self, root_path, extension='.png', measurements_per_hour=10, cache_path=None):
+
+        self.root_path = root_path
+        self.extension = extension
+        self.measurements_per_hour = measurements_per_hour
+
+        # Set the file storing the listing of this tree
+        self.index_file = None
+        if cache_path is not None:
+            key = hashlib.sha1((os.path.abspath(root_path) + extension).encode()).hexdigest()[:16]
+            self.index_file = cache_path + '/file_index/' + key + '.json'
+
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Method to list the tree again, reusing the stored listing of directories that did not change.
+        '''
+        # Load stored listing, per directory its modification time, files and subdirectories
+        stored = {}
+        if self.index_file is not None and os.path.exists(self.index_file):
+            with open(self.index_file) as file:
+                stored = json.load(file)
+
+        # Walk the tree from the root
+        listing = {}
+        pending = ['']
+        while pending:
+            directory = pending.pop()
+            path = self.root_path + directory
+            mtime = os.stat(path).st_mtime_ns
+
+            if directory in stored and stored[directory][0] == mtime:
+                files, subdirectories = stored[directory][1:]
+            else:
+                files = []
+                subdirectories = []
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirectories.append(entry.name)
+                        elif entry.name.endswith(self.extension):
+                            files.append(entry.name)
+
+            listing[directory] = [mtime, files, subdirectories]
+            pending.extend(directory + '/' + subdirectory for subdirectory in subdirectories)
+
+        # Store listing if it changed
+        if self.index_file is not None and listing != stored:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            with open(self.index_file + '.tmp', 'w') as file:
+                json.dump(listing, file)
+            os.replace(self.index_file + '.tmp', self.index_file)
+
+        # Parse time from all file names at once, skipping names that are no valid time
+        names = pd.Series([file for _, files, _ in listing.values() for file in files], dtype=object)
+        paths = pd.Series([self.root_path + directory + '/' + file for directory, (_, files, _) in listing.items() for file in files], dtype=object)
+        directories = pd.Series([directory for directory, (_, files, _) in listing.items() for file in files], dtype=object)
+        times = pd.to_datetime(names.str[:12], format='%Y%m%d%H%M', errors='coerce')
+        valid = times.notna().to_numpy()
+
+        # Sort on time, then on path
+        times = times[valid].to_numpy().astype('datetime64[m]')
+        paths = paths[valid].to_numpy()
+        directories = directories[valid].to_numpy()
+        order = np.lexsort((paths, times))
+
+        self.times = times[order]
+        self.paths = paths[order]
+        self.directories = directories[order]
+
+    def __len__(self):
+        return len(self.times)
+
+    def between(self, start=None, end=None):
+        '''
+        Method to find the files within a time window with binary search.
+
+        @param start datetime: First time to include, from the first file if None.
+        @param end datetime: First time to exclude, until the last file if None.
+
+        @return positions slice: Positions of the files in the window.
+        '''
+        first = 0 if start is None else np.searchsorted(self.times, np.datetime64(pd.Timestamp(start), 'm'), side='left')
+        last = len(self) if end is None else np.searchsorted(self.times, np.datetime64(pd.Timestamp(end), 'm'), side='left')
+        return slice(int(first), int(last))
+
+    def files_between(self, start=None, end=None):
+        '''
+        Method to get the paths of the files within a time window.
+        '''
+        return self.paths[self.between(start, end)]
+
+    def files_in_hour(self, hour):
+        '''
+        Method to get the paths of the files within an hour.
+
+        @param hour datetime: Start of the hour.
+        '''
+        hour = pd.Timestamp(hour)
+        return self.files_between(hour, hour + pd.Timedelta(hours=1))
+
+    def hour_bounds(self, day):
+        '''
+        Method to find the files of every hour of a day: the files of hour h are paths[bounds[h]:bounds[h+1]].
+
+        @param day datetime: Day to find the files of.
+
+        @return bounds array[int]: Position of the first file at or after each hour, 25 positions.
+        '''
+        hours = np.datetime64(pd.Timestamp(day).normalize(), 'm') + np.arange(25) * np.timedelta64(60, 'm')
+        return np.searchsorted(self.times, hours, side='left')
+
+    def days(self, months=None, days=None):
+        '''
+        Method to get the days with files, optionally only in the given months and days of the month.
+
+        @param months list[str]: Months to keep (e.g. '01'), all if None.
+        @param days list[str]: Days of the month to keep (e.g. '01'), all if None.
+
+        @return days DatetimeIndex: Sorted days.
+        '''
+        return select_days(self.times, months, days)
+
+    def day_directories(self, months=None, days=None):
+        '''
+        Method to get the directories holding files of the given days, as listed, whatever their names.
+
+        @param months list[str]: Months to keep (e.g. '01'), all if None.
+        @param days list[str]: Days of the month to keep (e.g. '01'), all if None.
+
+        @return directories list[str]: Paths of the directories relative to the root (e.g. '/09/01'), sorted.
+        '''
+        selected = np.isin(self.times.astype('datetime64[D]'), select_days(self.times, months, days).to_numpy().astype('datetime64[D]'))
+        return sorted(set(self.directories[selected]))
+
+    def missing_scans(self, start, end):
+        '''
+        Method to get the expected scan times without a file in a time window.
+
+        @param start datetime: First time to include.
+        @param end datetime: First time to exclude.
+
+        @return missing DatetimeIndex: Scan times without a file.
+        '''
+        expected = pd.date_range(start, end, freq=str(60 // self.measurements_per_hour) + 'min', inclusive='left')
+        expected_times = expected.to_numpy().astype('datetime64[m]')
+
+        if len(self) == 0:
+            return expected
+
+        # Look up each expected time with binary search
+        positions = np.minimum(np.searchsorted(self.times, expected_times, side='left'), len(self) - 1)
+
+        return expected[self.times[positions] != expected_times]
+
+    def completeness_per_day(self, start=None, end=None):
+        '''
+        Method to compute the fraction of expected scans with a file per day.
+
+        @param start datetime: First day to include, from the first file if None.
+        @param end datetime: First day to exclude, until the last file if None.
+
+        @return completeness Series: Number of distinct scan times divided by the expected number, per day.
+        '''
+        if len(self) == 0:
+            return pd.Series(dtype=float)
+
+        # Days in the window
+        start = pd.Timestamp(self.times[0]).normalize() if start is None else pd.Timestamp(start).normalize()
+        end = pd.Timestamp(self.times[-1]).normalize() + pd.Timedelta(days=1) if end is None else pd.Timestamp(end).normalize()
+        days = pd.date_range(start, end, freq='D', inclusive='left')
+
+        # Count distinct times between the day boundaries
+        distinct = self.times[np.r_[True, self.times[1:] != self.times[:-1]]]
+        bounds = np.searchsorted(distinct, np.r_[days.to_numpy(), end.to_datetime64()].astype('datetime64[m]'), side='left')
+
+        return pd.Series(np.diff(bounds) / (24 * self.measurements_per_hour), index=days)
@@ -1,13 +1,227 @@
 import pandas as pd
 import numpy as np
-from PIL import Image
 import os
-from datetime import datetime
+import io
+import json
+import hashlib
+from itertools import repeat
+from parallel import ordered_map
+from data_preparation.file_index import FileIndex
+from data_preparation.radar_archive import RadarArchive
 import warnings
+from profiling import profile_stage
 warnings.filterwarnings("ignore")
 
 
-def prepare_radar_data(radar_data_path, year, noise_threshold, hail_threshold, save_path, months=None, days=None):
+def load_station_pixels(radar_data_path):
+    '''
+    Method to load the radar pixel of each station inside the radar region.
+
+    @param radar_data_path str: Directory where the radar data is stored.
+
+    @return station_ids list[str]: Identifiers of the stations inside the radar region.
+    @return pixel_y array[int]: Row of the radar pixel per station.
+    @return pixel_x array[int]: Column of the radar pixel per station.
+    '''
+    # Get the pixels corresponding to each station
+    station_loc = pd.read_excel(radar_data_path + '/extract_radarpixel/raingauge_coordinate.xlsx', sheet_name='Sheet1')
+    subset = station_loc[['STN_ID', 'pixel_y','pixel_x']]
+
+    # Filter out negative pixels (outside radar region)
+    subset = subset[(subset['pixel_y'] >= 0) & (subset['pixel_x'] >= 0)]
+
+    # Store as index arrays, so all stations can be gathered from a scan at once
+    station_ids = subset['STN_ID'].tolist()
+    pixel_y = subset['pixel_y'].to_numpy().astype(int)
+    pixel_x = subset['pixel_x'].to_numpy().astype(int)
+
+    return station_ids, pixel_y, pixel_x
+
+
+@profile_stage('extract_station_values')
+def extract_station_values(filepaths, pixel_y, pixel_x):
+    '''
+    Method to extract the radar values at the station pixels from a list of png files.
+
+    @param filepaths list[str]: Paths of png files of form YYYYMMDDHHMMSS.png
+    @param pixel_y array[int]: Row of the radar pixel per station.
+    @param pixel_x array[int]: Column of the radar pixel per station.
+
+    @return datetimes array[datetime64]: Time of each opened file.
+    @return values array[float]: Radar values of shape (n_files, n_stations), only opened files.
+    @return opened array[bool]: Whether each file could be opened.
+    '''
+    # Decode the files as archive, gathering the pixels of all stations from each scan
+    archive = RadarArchive.from_files(filepaths)
+    values, opened = archive.read(slice(None), pixel_y, pixel_x, out=np.zeros((len(filepaths), len(pixel_y)), dtype=np.uint8))
+
+    return archive.times[opened], values[opened].astype(float), opened
+
+
+def scan_day_files(radar_png_day_path):
+    '''
+    Method to list the files of one day together with their modification time and size.
+
+    @param radar_png_day_path str: Directory with the png files of one day.
+
+    @return files dict{str: list[int]}: Modification time (in ns) and size per file name, sorted on name.
+    '''
+    files = {}
+    with os.scandir(radar_png_day_path) as entries:
+        for entry in entries:
+            stat = entry.stat()
+            files[entry.name] = [stat.st_mtime_ns, stat.st_size]
+
+    return dict(sorted(files.items()))
+
+
+def convert_to_reflectivity(values, noise_threshold, hail_threshold):
+    '''
+    Method to filter noise and hail from radar values and convert them from dBZ to Z.
+
+    @param values array[float]: Radar values in dBZ.
+    @param noise_threshold float: Threshold underneath which is considered noise (in dBZ).
+    @param hail_threshold float: Threshold above which is considered hail (in dBZ).
+
+    @return values array[float]: Reflectivity values in Z.
+    '''
+    # Filter noise and hail
+    values = values.copy()
+    values[values < noise_threshold] = 0
+    values[values > hail_threshold] = hail_threshold
+
+    # Convert dBZ to Z
+    values = 10**(values/10)
+    values[values == 1] = 0
+
+    return values
+
+
+def radar_cache_key(station_ids, pixel_y, pixel_x, noise_threshold, hail_threshold):
+    '''
+    Method to compute the key of the radar cache, which changes whenever the station pixels or thresholds change.
+
+    @param station_ids list[str]: Identifiers of the stations inside the radar region.
+    @param pixel_y array[int]: Row of the radar pixel per station.
+    @param pixel_x array[int]: Column of the radar pixel per station.
+    @param noise_threshold float: Threshold underneath which is considered noise (in dBZ).
+    @param hail_threshold float: Threshold above which is considered hail (in dBZ).
+
+    @return key str: Hash of the settings the cached values depend on.
+    '''
+    settings = [[str(id) for id in station_ids], pixel_y.tolist(), pixel_x.tolist(), float(noise_threshold), float(hail_threshold)]
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:16]
+
+
+@profile_stage('load_cached_day')
+def load_cached_day(cache_day_path):
+    '''
+    Method to load the reflectivity of one day from the radar cache.
+
+    @param cache_day_path str: Path prefix of the cache files of this day.
+
+    @return datetimes array[datetime64]: Time of each scan, None if day not cached.
+    @return values array[float]: Reflectivity values of shape (n_scans, n_stations), None if day not cached.
+    @return manifest dict: Station columns of values and per processed file its modification time, size and row in values (-1 if unopened), None if not available.
+    '''
+    # The datetimes are written last, so they mark a complete entry
+    if not os.path.exists(cache_day_path + '_datetimes.npy'):
+        return None, None, None
+
+    datetimes = np.load(cache_day_path + '_datetimes.npy', mmap_mode='r')
+    values = np.load(cache_day_path + '_values.npy', mmap_mode='r')
+
+    # Load the manifest of processed files
+    manifest = None
+    if os.path.exists(cache_day_path + '_manifest.json'):
+        with open(cache_day_path + '_manifest.json') as file:
+            manifest = json.load(file)
+
+    return datetimes, values, manifest
+
+
+def save_cached_day(cache_day_path, datetimes, values, manifest):
+    '''
+    Method to store the reflectivity of one day in the radar cache.
+
+    @param cache_day_path str: Path prefix of the cache files of this day.
+    @param datetimes array[datetime64]: Time of each scan.
+    @param values array[float]: Reflectivity values of shape (n_scans, n_stations).
+    @param manifest dict: Station columns of values and per processed file its modification time, size and row in values (-1 if unopened).
+    '''
+    # Create cache directory if it does not exist yet
+    os.makedirs(os.path.dirname(cache_day_path), exist_ok=True)
+
+    # Write the manifest of processed files
+    with open(cache_day_path + '_manifest.json.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(cache_day_path + '_manifest.json.tmp', cache_day_path + '_manifest.json')
+
+    # Write to temporary files first, so an interrupted run never leaves a partial entry
+    for suffix, array in (('_values.npy', values), ('_datetimes.npy', datetimes)):
+        with open(cache_day_path + suffix + '.tmp', 'wb') as file:
+            np.save(file, array)
+        os.replace(cache_day_path + suffix + '.tmp', cache_day_path + suffix)
+
+
+def replace_csv_rows(save_path, df, start=None):
+    '''
+    Method to replace the rows of a csv file with a datetime index by those of df, from the given time onward.
+    Only rows within the time range of df per month are replaced, the other rows of the file are kept.
+
+    @param save_path str: Path of the csv file, with rows sorted on time.
+    @param df DataFrame: New rows, with a datetime index.
+    @param start datetime: First time to replace, the whole file is read and rewritten if None.
+    '''
+    cutoff = b'' if start is None else str(pd.Timestamp(start)).encode()
+
+    with open(save_path, 'r+b') as file:
+        # Skip header
+        header = file.readline()
+
+        # Find the first row at or after the cutoff
+        while True:
+            offset = file.tell()
+            line = file.readline()
+            if len(line) == 0 or line[:len(cutoff)] >= cutoff:
+                break
+
+        # Read the rows from there, then remove them
+        file.seek(offset)
+        tail = file.read()
+        file.truncate(offset if start is not None else 0)
+
+    old_df = pd.read_csv(io.BytesIO(header + tail), index_col=0, parse_dates=True, float_precision='round_trip')
+    new_df = df if start is None else df[df.index >= pd.Timestamp(start)]
+
+    # Keep the old rows outside the time range of the new rows of each month
+    kept = np.ones(len(old_df), dtype=bool)
+    months = new_df.index.to_period('M')
+    for month in months.unique():
+        month_index = new_df.index[months == month]
+        kept &= ~((old_df.index >= month_index.min()) & (old_df.index <= month_index.max()))
+    old_df = old_df[kept].set_axis([str(column) for column in old_df.columns], axis=1).reindex(columns=[str(column) for column in df.columns])
+    old_df.columns = df.columns
+    old_df.index.name = df.index.name
+
+    # Write the rows in time order, with the header if the whole file is rewritten
+    rows = pd.concat([new_df, old_df]).sort_index(kind='stable')
+    rows.to_csv(save_path, mode='a', index=True, header=start is None)
+
+
+def csv_columns(save_path):
+    '''
+    Method to read the header of a csv file.
+
+    @param save_path str: Path of the csv file.
+
+    @return columns list[str]: Names of the columns, including the index.
+    '''
+    return [str(column) for column in pd.read_csv(save_path, nrows=0).columns]
+
+
+@profile_stage('radar')
+def prepare_radar_data(radar_data_path, year, noise_threshold, hail_threshold, save_path=None, months=None, days=None, workers=1, cache_path=None, incremental=False):
     '''
     Method to load radar data from csv files.
 
@@ -15,130 +229,167 @@ def prepare_radar_data(radar_data_path, year, noise_threshold, hail_threshold, s
     @param year int: Year to analyse the data from.
     @param noise_threshold float: Threshold underneath which is considered noise (in dBZ).
     @param hail_threshold float: Threshold above which is considered hail (in dBZ).
+    @param save_path str: Path of the csv file to write the result to (not written if None).
+    @param months list[str]: Months to load (e.g. '09') by the time in the file names, all months with files if None.
+    @param days list[str]: Days of the month to load by the time in the file names, all days with files if None.
+    @param workers int: Number of processes decoding the directories in parallel.
+    @param cache_path str: Directory where the reflectivity per directory of png files is cached (no caching if None).
+    @param incremental bool: Only decode new or changed files of cached directories, and only rewrite the rows of the csv file from the first changed day onward.
 
     @return df DataFrame: Reflectivity over time for all stations.
     '''
+    if incremental and cache_path is None:
+        raise Exception("Incremental radar preparation requires a cache_path to keep track of processed files.")
 
-    # Get the pixels corresponding to each station
-    station_loc = pd.read_excel(radar_data_path + '/extract_radarpixel/raingauge_coordinate.xlsx', sheet_name='Sheet1')
-    subset = station_loc[['STN_ID', 'pixel_y','pixel_x']]
-    location_list = [tuple(x) for x in subset.to_numpy()]
-
-    # Filter out negative pixels (outside radar region)
-    location_list_filtered = []
-    # Loop over stations and pixel coordinates
-    for (id, pixel_y, pixel_x) in location_list:
-        # Check if both pixels inside region
-        if pixel_y >= 0 and pixel_x >= 0:
-            # Store stations inside region
-            location_list_filtered.append((id, pixel_y, pixel_x))
-    # Update location list
-    location_list = location_list_filtered
+    # Get the pixels corresponding to each station inside the radar region
+    station_ids, pixel_y, pixel_x = load_station_pixels(radar_data_path)
 
     # Set the root path of the year under investigation
     radar_png_path = radar_data_path + '/radar_png/' + str(year)
 
-    # Init columns
-    columns = [x[0] for x in location_list]
-    # Init csv file
+    # Set the cache directory of these stations and thresholds
+    if cache_path is not None:
+        cache_key_path = cache_path + '/radar/' + radar_cache_key(station_ids, pixel_y, pixel_x, noise_threshold, hail_threshold)
+
+    # Init columns, stored with every cached day
+    columns = station_ids
+    cache_columns = [str(column) for column in columns]
+    # Only rewrite the changed rows of an existing csv file when incremental
+    update_csv = incremental and save_path is not None and os.path.exists(save_path)
     radar_df = pd.DataFrame(columns=columns)
     radar_df.insert(loc=0, column='Datetime', value=[])
     radar_df.set_index('Datetime', inplace=True)
-    radar_df.to_csv(save_path)
 
-    # If months not specified, derive from directory
-    if months is None:
-        months = os.listdir(radar_png_path)
-    months.sort()
+    # Index the files of this year by time, stored in the cache if given
+    file_index = FileIndex(radar_png_path, cache_path=cache_path)
 
-    # Check if days specified
-    if days is None:
-        days_specified = False
-    else:
-        days_specified = True
+    # Get the directories as listed that hold files of the requested days, all days with files if None
+    directories = file_index.day_directories(months, days)
+
+    # Load the directories that are already cached
+    directory_results = [(None, None, None)] * len(directories)
+    if cache_path is not None:
+        directory_results = [load_cached_day(cache_key_path + '/' + str(year) + directory) for directory in directories]
+
+    # Init lists of directories to process with their files and first day that changed
+    changed_directories = []
+    directory_files = []
+    decode_files = []
+    first_changed = None
+
+    # Loop over directories
+    for k, directory in enumerate(directories):
+        directory_datetimes, _, manifest = directory_results[k]
+
+        # Process the directory again if it was cached with other columns
+        if directory_datetimes is not None and (manifest is None or manifest.get('columns') != cache_columns):
+            directory_results[k] = (None, None, None)
+            directory_datetimes, manifest = None, None
+
+        # Find the files that are new or changed since they were processed
+        files = scan_day_files(radar_png_path + directory)
+        processed = {} if manifest is None else manifest['files']
+        new_files = [file for file in files if processed.get(file, [None, None])[:2] != files[file]]
+
+        # Use the cached directory if all its files were already processed
+        if directory_datetimes is not None and len(new_files) == 0 and len(processed) == len(files):
+            continue
+
+        # Unless incremental, a directory whose files changed is processed again from scratch
+        if directory_datetimes is not None and not incremental:
+            directory_results[k] = (None, None, None)
+            new_files = list(files)
+
+        changed_directories.append(k)
+        directory_files.append(files)
+        decode_files.append([radar_png_path + directory + '/' + file for file in new_files])
+
+    # Extract the station values of the new files, in parallel if requested
+    extracted = ordered_map(extract_station_values, decode_files, repeat(pixel_y), repeat(pixel_x), workers=workers)
+
+    # Loop over processed directories
+    for k, files, filepaths, (new_datetimes, new_values, opened) in zip(changed_directories, directory_files, decode_files, extracted):
+        print('Currently at: ', str(year) + directories[k])
+        cached_datetimes, cached_values, manifest = directory_results[k]
+
+        # Filter noise and hail and convert to Z
+        new_values = convert_to_reflectivity(new_values, noise_threshold, hail_threshold)
+
+        # Stack the cached and new rows, new rows start after the cached ones
+        if cached_datetimes is None:
+            cached_datetimes = np.empty(0, dtype='datetime64[m]')
+            cached_values = np.empty((0, len(columns)))
+            manifest = {'columns': cache_columns, 'files': {}}
+        all_datetimes = np.concatenate([cached_datetimes, new_datetimes])
+        all_values = np.concatenate([cached_values, new_values])
+        new_rows = np.where(opened, np.cumsum(opened) - 1 + len(cached_datetimes), -1)
+        new_rows = dict(zip([os.path.basename(path) for path in filepaths], new_rows.tolist()))
+
+        # Take the row of every file in file order, skipping unopened files
+        rows = [new_rows[file] if file in new_rows else manifest['files'][file][2] for file in files]
+        order = [row for row in rows if row >= 0]
+        directory_datetimes = all_datetimes[order]
+        directory_values = all_values[order]
+
+        # Update manifest to the rows in this directory
+        new_index = np.cumsum(np.array(rows) >= 0) - 1
+        manifest = {'columns': cache_columns, 'files': {file: files[file] + [int(new_index[i]) if rows[i] >= 0 else -1] for i, file in enumerate(files)}}
+
+        # Store in cache
+        if cache_path is not None:
+            save_cached_day(cache_key_path + '/' + str(year) + directories[k], directory_datetimes, directory_values, manifest)
+
+        directory_results[k] = (directory_datetimes, directory_values, manifest)
+
+        # Keep track of first day that changed, over the rows before and after and the indexed files of the directory
+        changed_times = np.concatenate([cached_datetimes, directory_datetimes, file_index.times[file_index.directories == directories[k]]]).astype('datetime64[m]')
+        if len(changed_times) > 0:
+            changed_day = changed_times.min().astype('datetime64[D]')
+            first_changed = changed_day if first_changed is None else min(first_changed, changed_day)
+
+    # Merge the directories in timestamp order, keeping only the requested days
+    DateTime = np.concatenate([np.empty(0, dtype='datetime64[m]')] + [directory_datetimes for directory_datetimes, _, _ in directory_results])
+    extract_data = np.concatenate([np.empty((0, len(columns)))] + [directory_values for _, directory_values, _ in directory_results])
+    selected = np.isin(DateTime.astype('datetime64[D]'), file_index.days(months, days).to_numpy().astype('datetime64[D]'))
+    DateTime = DateTime[selected]
+    extract_data = extract_data[selected]
 
     # Loop over months
-    for month in months:
-        # Init DataFrame
-        radar_df = pd.DataFrame(columns=columns)
-        # Init datetime column
-        DateTime = []
-
-        # Set path for this month
-        radar_png_month_path = radar_png_path + '/' + month
-
-        # If days not specified, derive from directory
-        if not days_specified:
-            days = os.listdir(radar_png_month_path)
-        days.sort()
-
-        # Loop over days
-        for day in days:
-            print('Currently at: ', day, '/', month, '/', year)
-            # Set path for this day
-            radar_png_day_path = radar_png_month_path + '/' + day
-            # Get list of files and count
-            filelist = os.listdir(radar_png_day_path)
-
-            # Loop over all radar files
-            for file in filelist:
-                # Try to open the png file, otherwise print that it gave issues
-                try:
-                    # Get datetime from file name   
-                    Year = file[0:4]
-                    Month = file[4:6]
-                    Day = file[6:8]
-                    Hour = file[8:10]
-                    Minute = file[10:12]
-
-                    # Load radar data from file
-                    data_png = Image.open(radar_png_day_path + '/' + file)
-                    data_png_numpy = np.array(data_png)
-                    df_data = pd.DataFrame(data_png_numpy)
-
-                    # Init row
-                    extract_data = np.arange(len(location_list), dtype=float)
-
-                    # Loop over locations of stations
-                    for location in location_list:
-                        # Get the data corresponding to the pixel locations
-                        pixel_x = int(location[2])
-                        pixel_y = int(location[1])
-                        value = df_data.iloc[pixel_y, pixel_x]
-                        extract_data[location_list.index(location)] = value
-
-                    # Store in dataframe
-                    radar_df.loc[len(radar_df)] = extract_data
-
-                    # Format and store datetime
-                    Date = Year + "-" + Month + "-" + Day + ' ' + Hour + ':' + Minute
-                    DateTime.append(datetime.strptime(Date, "%Y-%m-%d %H:%M"))
-
-                except:
-                    print("Unable to open: " + radar_png_day_path + '/' + file)
+    month_dfs = []
+    month_of_scans = DateTime.astype('datetime64[M]')
+    for month in np.unique(month_of_scans):
+        in_month = month_of_scans == month
 
+        radar_df = pd.DataFrame(data=extract_data[in_month], columns=columns)
         # Set datetime as index column
-        radar_df.insert(loc=0, column='Datetime', value=DateTime)
+        radar_df.insert(loc=0, column='Datetime', value=pd.DatetimeIndex(DateTime[in_month]))
         radar_df.set_index('Datetime', inplace=True)
+        radar_df = radar_df.sort_index()
         radar_df = radar_df.sort_index(axis=1)
 
-        # Filter noise and hail
-        radar_df[radar_df < noise_threshold] = 0
-        radar_df[radar_df > hail_threshold] = hail_threshold
-
-        # Convert dBZ to Z
-        radar_df = 10**(radar_df/10)
-        radar_df = radar_df.replace(1,0)
-
         # Average over hours
         radar_df = radar_df.resample('6min').mean()
 
         # Remove duplicates
         radar_df = radar_df.loc[:,~radar_df.columns.duplicated()].copy()
 
-        # Write to csv
-        radar_df.to_csv(save_path, mode='a', index=True, header=False)
-        
-        # Clear DataFrame and Datetime
-        radar_df = None
-        DateTime = []
\ No newline at end of file
+        # Store result of this month
+        month_dfs.append(radar_df)
+
+    # Combine all months
+    if len(month_dfs) > 0:
+        radar_df = pd.concat(month_dfs)
+    else:
+        radar_df = radar_df.sort_index(axis=1)
+        radar_df = radar_df.loc[:,~radar_df.columns.duplicated()]
+
+    # Write to csv with the header of the sorted columns, when updating the whole file if its columns changed and otherwise only the rows from the first changed day onward
+    # Rows of days outside the requested months and days are kept when updating
+    if update_csv and csv_columns(save_path) != [str(column) for column in [radar_df.index.name] + list(radar_df.columns)]:
+        replace_csv_rows(save_path, radar_df)
+    elif update_csv and first_changed is not None:
+        replace_csv_rows(save_path, radar_df, first_changed)
+    elif save_path is not None and not update_csv:
+        radar_df.to_csv(save_path)
+
+    return radar_df
@@ -0,0 +1,250 @@
+import os
+import numpy as np
+import pandas as pd
+from PIL import Image
+from parallel import ordered_map
+from data_preparation.file_index import FileIndex, select_days
+
+
+def decode_scan(path):
+    '''
+    Method to decode one radar png file.
+
+    @param path str: Path of the png file.
+
+    @return scan array[uint8]: Radar values in dBZ, None if unable to open.
+    '''
+    try:
+        with Image.open(path) as data_png:
+            return np.asarray(data_png)
+    except:
+        print("Unable to open: " + path)
+        return None
+
+
+class RadarArchive:
+    '''
+    Lazy (time, y, x) array of uint8 radar values over the png archive.
+    Indexing decodes only the selected scans, e.g. archive[archive.time_slice(start, end), pixel_y, pixel_x]
+    for the pixels of the stations or archive[t, 100:200, 300:400] for a bounding box.
+    After to_cube all reads come from a memory-mapped uint8 cube instead of the png files.
+    Archives are sent to worker processes without the cube, which each process maps again.
+    '''
+
+    def __init__(self, radar_data_path, years=None, cube_path=None, cache_path=None):
+
+        # Index the files by time, only the directories of the requested years if given, stored in the cache if given
+        if years is None:
+            indexes = [FileIndex(radar_data_path + '/radar_png', cache_path=cache_path)]
+        else:
+            indexes = [FileIndex(radar_data_path + '/radar_png/' + str(year), cache_path=cache_path) for year in sorted(set(int(year) for year in years))]
+        self.times = np.concatenate([index.times for index in indexes] + [np.empty(0, dtype='datetime64[m]')])
+        self.paths = np.concatenate([index.paths for index in indexes] + [np.empty(0, dtype=object)])
+
+        # Use the cube if it holds exactly the indexed scans
+        self.cube_path = cube_path
+        self.cube = None
+        self.cube_rows = None
+        self.cube_opened = None
+        self._frame_shape = None
+        if cube_path is not None and os.path.exists(cube_path + '/times.npy'):
+            cube_times = np.load(cube_path + '/times.npy')
+            if np.array_equal(cube_times, self.times):
+                self.cube_rows = np.arange(len(self))
+                self.cube_opened = np.load(cube_path + '/opened.npy')
+                self.cube = np.load(cube_path + '/cube.npy', mmap_mode='r')
+
+    @classmethod
+    def from_files(cls, paths):
+        '''
+        Method to view a list of png files as archive, in the given order, with the time parsed from their name.
+        Files whose name is no valid time are kept and reported as unopened when read.
+
+        @param paths list[str]: Paths of png files of form YYYYMMDDHHMMSS.png.
+
+        @return archive RadarArchive: Archive of the files.
+        '''
+        archive = cls.__new__(cls)
+        names = pd.Series([os.path.basename(path) for path in paths], dtype=object)
+        archive.times = pd.to_datetime(names.str[0:12], format='%Y%m%d%H%M', errors='coerce').to_numpy().astype('datetime64[m]')
+        archive.paths = np.asarray(paths, dtype=object)
+        archive.cube_path = None
+        archive.cube = None
+        archive.cube_rows = None
+        archive.cube_opened = None
+        archive._frame_shape = None
+        return archive
+
+    def __getstate__(self):
+        # Send the rows of the cube rather than its content
+        state = self.__dict__.copy()
+        state['cube'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cube_rows is not None:
+            self.cube = np.load(self.cube_path + '/cube.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def frame_shape(self):
+        '''
+        Shape (y, x) of a single scan, read from the header of the first file that opens.
+        '''
+        if self.cube is not None:
+            return self.cube.shape[1:]
+        if self._frame_shape is None:
+            self._frame_shape = (0, 0)
+            for path in self.paths:
+                try:
+                    with Image.open(path) as data_png:
+                        self._frame_shape = data_png.size[::-1]
+                        break
+                except:
+                    continue
+        return self._frame_shape
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.frame_shape)
+
+    def time_slice(self, start=None, end=None):
+        '''
+        Method to find the scans within a time window with binary search.
+
+        @param start datetime: First time to include, from the first scan if None.
+        @param end datetime: First time to exclude, until the last scan if None.
+
+        @return time_slice slice: Positions of the scans in the window.
+        '''
+        first = 0 if start is None else np.searchsorted(self.times, np.datetime64(pd.Timestamp(start), 'm'), side='left')
+        last = len(self) if end is None else np.searchsorted(self.times, np.datetime64(pd.Timestamp(end), 'm'), side='left')
+        return slice(int(first), int(last))
+
+    def days(self, months=None, days=None):
+        '''
+        Method to get the days with scans, optionally only in the given months and days of the month.
+        '''
+        return select_days(self.times[~np.isnat(self.times)], months, days)
+
+    def take(self, time_index):
+        '''
+        Method to select scans as a new archive, reading from the same files or cube.
+
+        @param time_index slice or array[int]: Positions of the scans.
+
+        @return archive RadarArchive: Archive of the selected scans.
+        '''
+        archive = RadarArchive.__new__(RadarArchive)
+        archive.__dict__.update(self.__dict__)
+        archive.times = self.times[time_index]
+        archive.paths = self.paths[time_index]
+        if self.cube_rows is not None:
+            archive.cube_rows = self.cube_rows[time_index]
+        return archive
+
+    def read(self, time_index=slice(None), rows=slice(None), cols=slice(None), out=None):
+        '''
+        Method to read a selection of pixels from a selection of scans, skipping scans that do not open.
+
+        @param time_index int, slice or array[int]: Positions of the scans.
+        @param rows int, slice or array[int]: Rows of the pixels, applied to every scan as scan[rows, cols].
+        @param cols int, slice or array[int]: Columns of the pixels.
+        @param out array[uint8]: Preallocated result to read into, allocated if None.
+
+        @return values array[uint8]: Selected pixels of shape (scans,) + scan[rows, cols].shape, zero for scans that did not open.
+        @return opened array[bool]: Whether each scan could be opened.
+        '''
+        positions = np.arange(len(self))[time_index]
+        single = np.ndim(positions) == 0
+        positions = np.atleast_1d(positions)
+
+        # Read from the cube, a view as long as the scans are consecutive and the pixels slices
+        if self.cube is not None:
+            cube_rows = self.cube_rows[positions]
+            if len(cube_rows) > 0 and np.array_equal(cube_rows, np.arange(cube_rows[0], cube_rows[0] + len(cube_rows))):
+                frames = self.cube[cube_rows[0]:cube_rows[0] + len(cube_rows)]
+            else:
+                frames = self.cube[cube_rows]
+            values = frames[:, rows, cols]
+            if out is not None:
+                out[...] = values
+                values = out
+            opened = self.cube_opened[cube_rows]
+
+        # Otherwise decode only the selected scans
+        else:
+            if out is None:
+                try:
+                    pixel_shape = np.empty(self.frame_shape, dtype=np.uint8)[rows, cols].shape
+                except IndexError:
+                    # Pixels outside the scans, the scans will be reported as unopened
+                    pixel_shape = np.broadcast(np.asarray(rows), np.asarray(cols)).shape
+                out = np.zeros((len(positions),) + pixel_shape, dtype=np.uint8)
+            values = out
+            opened = np.zeros(len(positions), dtype=bool)
+            for k, position in enumerate(positions):
+                # Skip files whose name is no valid time
+                if np.isnat(self.times[position]):
+                    print("Unable to open: " + self.paths[position])
+                    continue
+
+                scan = decode_scan(self.paths[position])
+                if scan is not None:
+                    try:
+                        values[k] = scan[rows, cols]
+                        opened[k] = True
+                    except:
+                        print("Unable to read pixels of: " + self.paths[position])
+
+        if single:
+            return values[0], opened[0]
+        return values, opened
+
+    def __getitem__(self, key):
+        '''
+        Method to index the archive as a (time, y, x) array, raising an error if a selected scan does not open.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+
+        values, opened = self.read(*key)
+        if not np.all(opened):
+            raise IOError("Unable to open all selected radar scans.")
+
+        return values
+
+    def to_cube(self, cube_path=None, workers=1):
+        '''
+        Method to decode all scans once into a memory-mapped uint8 cube, which is used for all later reads.
+
+        @param cube_path str: Directory to store the cube in, the one given at construction if None.
+        @param workers int: Number of processes decoding the scans in parallel.
+        '''
+        if cube_path is None:
+            cube_path = self.cube_path
+        os.makedirs(cube_path, exist_ok=True)
+
+        # Write to temporary files first, the times are written last so they mark a complete cube
+        cube = np.lib.format.open_memmap(cube_path + '/cube.npy.tmp', mode='w+', dtype=np.uint8, shape=self.shape)
+        opened = np.zeros(len(self), dtype=bool)
+        for k, scan in enumerate(ordered_map(decode_scan, self.paths, workers=workers)):
+            if scan is not None and scan.shape == cube.shape[1:] and not np.isnat(self.times[k]):
+                cube[k] = scan
+                opened[k] = True
+        cube.flush()
+        del cube
+
+        np.save(cube_path + '/opened.npy', opened)
+        os.replace(cube_path + '/cube.npy.tmp', cube_path + '/cube.npy')
+        np.save(cube_path + '/times.npy', self.times)
+
+        # Read from the cube from now on
+        self.cube_path = cube_path
+        self.cube_rows = np.arange(len(self))
+        self.cube_opened = opened
+        self.cube = np.load(cube_path + '/cube.npy', mmap_mode='r')
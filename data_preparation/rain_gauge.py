@@ -1,15 +1,85 @@
+import os
+import json
+import hashlib
+import numpy as np
 import pandas as pd
-from datetime import datetime
 from data_preparation.DM_analysis import get_DM_curves_data
+from profiling import profile_stage
 
-dateparse = lambda x: datetime.strptime(x, '%d/%m/%Y %H:%M')
 
-def load_rain_gauge_data(rain_gauge_data_path, year, nrows=None):
+def read_HII_rain(file_path):
+    '''
+    Method to read HII rain data from an excel file, with float32 rain columns.
+    '''
+    rain_HII = pd.read_excel(file_path, index_col=0, parse_dates=True)
+    return rain_HII.apply(pd.to_numeric, errors='coerce').astype('float32')
+
+
+def read_EWS_rain(file_path):
+    '''
+    Method to read EWS rain data from a csv file, parsing all datetimes at once, with float32 rain columns.
+    '''
+    rain_EWS = pd.read_csv(file_path, index_col=0)
+    rain_EWS.index = pd.to_datetime(rain_EWS.index, format='%d/%m/%Y %H:%M')
+    return rain_EWS.apply(pd.to_numeric, errors='coerce').astype('float32')
+
+
+def read_location(file_path):
+    '''
+    Method to read station locations from an excel file.
+    '''
+    return pd.read_excel(file_path, index_col=0)
+
+
+def load_cached_source(file_path, reader, cache_path=None):
+    '''
+    Method to read a source file once and reuse a Parquet copy of the result as long as the file does not change.
+
+    @param file_path str: Path of the source file.
+    @param reader function: Method reading the source file into a DataFrame.
+    @param cache_path str: Directory where the Parquet copies are stored (always read from source if None).
+
+    @return df DataFrame: Content of the source file.
+    '''
+    if cache_path is None:
+        return reader(file_path)
+
+    # Cache entry of this source file
+    cache_file = cache_path + '/rain_gauge/' + hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:16]
+    stat = os.stat(file_path)
+    source = [stat.st_mtime_ns, stat.st_size]
+
+    # Reuse the copy if the source did not change, the manifest is written last so it marks a complete entry
+    if os.path.exists(cache_file + '.json'):
+        with open(cache_file + '.json') as file:
+            manifest = json.load(file)
+        if manifest['source'] == source:
+            df = pd.read_parquet(cache_file + '.parquet')
+            # Parquet only stores string labels, restore the original ones
+            df.columns = pd.Index(manifest['columns'], name=df.columns.name)
+            return df
+
+    # Read source and store copy with string labels, through files unique to this process as years may share sources
+    df = reader(file_path)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp = '.' + str(os.getpid()) + '.tmp'
+    df.set_axis(df.columns.astype(str), axis=1).to_parquet(cache_file + '.parquet' + tmp)
+    os.replace(cache_file + '.parquet' + tmp, cache_file + '.parquet')
+    with open(cache_file + '.json' + tmp, 'w') as file:
+        json.dump({'source': source, 'columns': df.columns.tolist()}, file)
+    os.replace(cache_file + '.json' + tmp, cache_file + '.json')
+
+    return df
+
+
+@profile_stage('load_rain_gauge_data')
+def load_rain_gauge_data(rain_gauge_data_path, year, cache_path=None):
     '''
     Method to load data from excel files per year.
 
     @param rain_gauge_data_path str: Directory containing the rain gauge data.
     @param year int: Year to analyse the data from.
+    @param cache_path str: Directory where a Parquet copy of every source file is cached (no caching if None).
 
     @return rain_HII DataFrame: HII rain data sampled every 10 mins.
     @return location_HII DataFrame: Locations of HII stations.
@@ -18,17 +88,49 @@ def load_rain_gauge_data(rain_gauge_data_path, year, nrows=None):
     '''
 
     # Load HII data
-    rain_HII = pd.read_excel(rain_gauge_data_path + '/HII_10min/raingauge_HII_Phetchaburi_10min_' + str(year) + '.xlsx', index_col=0, parse_dates=True, nrows=nrows)
-    location_HII = pd.read_excel(rain_gauge_data_path + '/HII_Location.xlsx', index_col=0)
+    rain_HII = load_cached_source(rain_gauge_data_path + '/HII_10min/raingauge_HII_Phetchaburi_10min_' + str(year) + '.xlsx', read_HII_rain, cache_path)
+    location_HII = load_cached_source(rain_gauge_data_path + '/HII_Location.xlsx', read_location, cache_path)
 
     # Load EWS data
-    # rain_EWS = pd.read_csv(rain_gauge_data_path + '/EWS_15min/EWS_station_phetchaburi_project_15m_' + str(year) + '.csv', index_col=0, parse_dates=['Datetime'], date_format='%d/%m/%Y %H:%M', nrows=NROWS)
-    rain_EWS = pd.read_csv(rain_gauge_data_path + '/EWS_15min/EWS_station_phetchaburi_project_15m_' + str(year) + '.csv', index_col=0, parse_dates=['Datetime'], date_parser=dateparse, nrows=nrows)
-    location_EWS = pd.read_excel(rain_gauge_data_path + '/EWS_Location.xlsx', index_col=0)
+    rain_EWS = load_cached_source(rain_gauge_data_path + '/EWS_15min/EWS_station_phetchaburi_project_15m_' + str(year) + '.csv', read_EWS_rain, cache_path)
+    location_EWS = load_cached_source(rain_gauge_data_path + '/EWS_Location.xlsx', read_location, cache_path)
 
     return rain_HII, location_HII, rain_EWS, location_EWS
 
 
+def resample_hourly(rain_df):
+    '''
+    Method to sum rain data per hour for all stations at once, in a single pass over the samples.
+
+    @param rain_df DataFrame: Rain data of all stations with a datetime index.
+
+    @return rain_hourly DataFrame: Rain per hour, nan if any sample within the hour is missing.
+    @return complete_hours Series: Number of hours without missing samples per station.
+    '''
+    if len(rain_df) == 0:
+        return rain_df.resample('H').sum(), pd.Series(0, index=rain_df.columns)
+    if not rain_df.index.is_monotonic_increasing:
+        rain_df = rain_df.sort_index(kind='stable')
+
+    # Hour of every sample and the first sample of every hour
+    sample_hours = rain_df.index.floor('H')
+    hours = pd.date_range(sample_hours[0], sample_hours[-1], freq='H', name=rain_df.index.name)
+    sizes = np.bincount((sample_hours - hours[0]) // pd.Timedelta(hours=1), minlength=len(hours))
+    starts = np.r_[0, np.cumsum(sizes)[:-1]][sizes > 0]
+
+    # Sum the samples of all stations per hour, a missing sample makes the sum of its hour nan, hours without samples sum to 0
+    values = rain_df.to_numpy()
+    sums = np.zeros((len(hours), values.shape[1]), dtype=values.dtype)
+    sums[sizes > 0] = np.add.reduceat(values, starts, axis=0)
+    rain_hourly = pd.DataFrame(sums, index=hours, columns=rain_df.columns)
+
+    # Count the complete hours per station
+    complete = ~np.isnan(sums)
+
+    return rain_hourly, pd.Series(complete.sum(axis=0), index=rain_df.columns)
+
+
+@profile_stage('convert_and_merge')
 def convert_and_merge(rain_HII_10min, rain_EWS_15min):
     '''
     Method to convert HII and EWS dataframes to hours and merge them.
@@ -37,68 +139,55 @@ def convert_and_merge(rain_HII_10min, rain_EWS_15min):
     @param rain_EWS_15min DataFrame: EWS rain data sampled every 15 mins.
 
     @return rain_merged_60min DataFrame: Combined data sampled every 60 mins.
+    @return complete_hours Series: Number of hours without missing samples per station.
     '''
 
-    # Convert HII to hours
-    rain_HII_60min = rain_HII_10min.resample('H').agg(pd.Series.sum, skipna=False)
-    rain_HII_60min.reset_index(inplace=True)
+    # Convert HII and EWS to hours
+    rain_HII_60min, complete_HII = resample_hourly(rain_HII_10min)
+    rain_EWS_60min, complete_EWS = resample_hourly(rain_EWS_15min)
 
-    # Convert EWS to hours
-    rain_EWS_60min = rain_EWS_15min.resample('H').agg(pd.Series.sum, skipna=False)
-    rain_EWS_60min.reset_index(inplace=True)
+    # Place side by side on the union of their hours
+    rain_merged_60min = pd.concat([rain_HII_60min, rain_EWS_60min], axis=1)
+    rain_merged_60min.index.name = 'Datetime'
 
-    # Merge
-    rain_merged_60min = pd.merge(rain_HII_60min, rain_EWS_60min, on='Datetime', how='outer')
-    rain_merged_60min.set_index('Datetime', inplace=True)
+    return rain_merged_60min, pd.concat([complete_HII, complete_EWS])
 
-    return rain_merged_60min
 
-
-def percentage_station_filter(df, threshold):
+@profile_stage('percentage_station_filter')
+def percentage_station_filter(df, threshold, complete_hours=None):
     '''
     Method to filter out all stations with too much missing data.
 
     @param df DataFrame: Rain data to be filtered.
     @param threshold Float: Minimum percentage of values captured by station.
+    @param complete_hours Series: Number of hours without missing samples per station from resample_hourly, counted in df if None.
 
     @return df DataFrame: Rain data without stations with too much missing data.
     '''
+    if complete_hours is None:
+        complete_hours = df.notna().sum(axis=0)
 
-    # Count number of columns
-    n_col = df.shape[1]
-    # Init bad stations list
-    bad_st = []
-
-    # Loop over columns
-    for i in range(n_col):
-        # Get column and count values
-        col = df.iloc[:,i]
-        total_values = len(col)
-        nan_values = col.isna().sum()
-
-        # Compute percentage
-        if total_values > 0:
-            percentage = 100 - (nan_values / total_values) * 100
-        else:
-            percentage = 100    # Avoid division by zero if column is empty
-
-        # Bad station if too many missing values 
-        if percentage < threshold:
-            bad_st.append(col.name)
+    # Compute percentage of values captured per station, 100 if empty to avoid division by zero
+    if len(df) > 0:
+        percentage = complete_hours.to_numpy() / len(df) * 100
+    else:
+        percentage = np.full(df.shape[1], 100.0)
 
     # Remove all bad stations
-    df.drop(columns=bad_st, inplace=True)
+    df.drop(columns=df.columns[percentage < threshold], inplace=True)
 
     return df
 
 
-def prepare_rain_gauge_data(rain_gauge_data_path, year, station_threshold, nrows=None):
+@profile_stage('rain_gauge')
+def prepare_rain_gauge_data(rain_gauge_data_path, year, station_threshold, cache_path=None):
     '''
     Method to prepare rain gauge data entirely.
 
     @param rain_gauge_data_path str: Directory containing the rain gauge data.
     @param year int: Year to analyse the data from.
     @param station_threshold: Minimum percentage of values captured by station.
+    @param cache_path str: Directory where a Parquet copy of every source file is cached (no caching if None).
 
     @return rain_filtered DataFrame: Rain gauge data filtered only on values captured.
     @return dm_results Dictionary: Station as key together with values.
@@ -106,13 +195,13 @@ def prepare_rain_gauge_data(rain_gauge_data_path, year, station_threshold, nrows
     '''
 
     # Load HII and EWS data from files
-    rain_HII_10min, location_HII, rain_EWS_15min, location_EWS = load_rain_gauge_data(rain_gauge_data_path, year, nrows=nrows)
+    rain_HII_10min, location_HII, rain_EWS_15min, location_EWS = load_rain_gauge_data(rain_gauge_data_path, year, cache_path=cache_path)
 
     # Convert data to hours and merge HII and EWS
-    rain_merged_60min = convert_and_merge(rain_HII_10min, rain_EWS_15min)
+    rain_merged_60min, complete_hours = convert_and_merge(rain_HII_10min, rain_EWS_15min)
 
-    # Filter out stations based when too much missing data
-    rain_filtered = percentage_station_filter(rain_merged_60min, station_threshold)
+    # Filter out stations based when too much missing data, from the hours complete per station
+    rain_filtered = percentage_station_filter(rain_merged_60min, station_threshold, complete_hours)
 
     # Get the data to plot the DM curves
     dm_results, surrounding_stations = get_DM_curves_data(rain_filtered, location_HII, location_EWS)
@@ -0,0 +1,310 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+# Figure settings of this process, no figures are made until enable_diagnostics is called
+settings = {'save_path': None, 'max_points': 20000, 'dpi': 100, 'format': 'png', 'seed': 0}
+# Background worker rendering the figures and the figures it was given
+worker = {'executor': None, 'futures': []}
+
+
+def enable_diagnostics(save_path, max_points=20000, dpi=100, format='png', seed=0):
+    '''
+    Method to render diagnostic figures to files from now on.
+    Matplotlib is only imported by the background worker, with the Agg backend, so nothing is shown or blocks.
+
+    @param save_path str: Directory to write the figures to.
+    @param max_points int: Maximum number of points of a scatter plot, a random sample is plotted beyond that.
+    @param dpi int: Resolution of the figures.
+    @param format str: File format of the figures (e.g. png, pdf).
+    @param seed int: Seed of the random sample of the scatter plots.
+    '''
+    os.makedirs(save_path, exist_ok=True)
+    settings.update({'save_path': save_path, 'max_points': max_points, 'dpi': dpi, 'format': format, 'seed': seed})
+
+
+def diagnostics_enabled():
+    return settings['save_path'] is not None
+
+
+def submit_figure(name, plot, *args, **kwargs):
+    '''
+    Method to render a figure on the background worker, does nothing unless diagnostics are enabled.
+
+    @param name str: Name of the file, without extension.
+    @param plot function: Method drawing the figure, called as plot(*args, save_path=path, **kwargs).
+
+    @return future Future: Result of the rendering, None if diagnostics are not enabled.
+    '''
+    if not diagnostics_enabled():
+        return None
+
+    # Start worker on first use, a single thread so figures never render concurrently
+    if worker['executor'] is None:
+        worker['executor'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='diagnostics')
+
+    path = settings['save_path'] + '/' + name + '.' + settings['format']
+    future = worker['executor'].submit(plot, *args, save_path=path, **kwargs)
+    worker['futures'].append((path, future))
+
+    return future
+
+
+def wait_for_figures():
+    '''
+    Method to wait until all submitted figures are written, reporting figures that failed.
+    The background thread is stopped as well, so processes can be forked safely, it is started again by the next figure.
+
+    @return paths list[str]: Paths of the figures written.
+    '''
+    paths = []
+    for path, future in worker['futures']:
+        try:
+            future.result()
+            paths.append(path)
+        except Exception as error:
+            print('Unable to render ' + path + ': ' + repr(error))
+    worker['futures'] = []
+
+    if worker['executor'] is not None:
+        worker['executor'].shutdown(wait=True)
+        worker['executor'] = None
+
+    return paths
+
+
+def period_name(name, index):
+    '''
+    Method to name a figure after the period of the data, e.g. kagan_20220101-20221231.
+
+    @param name str: Name of the figure.
+    @param index DatetimeIndex: Times of the data.
+    '''
+    if len(index) == 0:
+        return name
+    return name + '_' + index[0].strftime('%Y%m%d') + '-' + index[-1].strftime('%Y%m%d')
+
+
+def sample_pairs(distances, correlations, max_points=None, seed=None):
+    '''
+    Method to take a random sample of the station pairs in the upper triangle, without enumerating all n^2 pairs.
+
+    @param distances array[float]: Distances between stations.
+    @param correlations array[float]: Correlations between stations.
+    @param max_points int: Maximum number of pairs, the setting of enable_diagnostics if None.
+    @param seed int: Seed of the sample, the setting of enable_diagnostics if None.
+
+    @return pair_distances array[float]: Distances of the sampled pairs with both values.
+    @return pair_correlations array[float]: Correlations of the sampled pairs with both values.
+    '''
+    distances = np.asarray(distances, dtype=float)
+    correlations = np.asarray(correlations, dtype=float)
+    max_points = settings['max_points'] if max_points is None else max_points
+    seed = settings['seed'] if seed is None else seed
+
+    # Take all pairs, or a sample of their positions in the upper triangle
+    n = len(distances)
+    n_pairs = n * (n - 1) // 2
+    if n_pairs <= max_points:
+        i, j = np.triu_indices(n, k=1)
+    else:
+        k = np.sort(np.random.default_rng(seed).choice(n_pairs, max_points, replace=False))
+        # Convert positions in the upper triangle, row by row, to rows and columns
+        i = (n - 2 - np.floor(np.sqrt(-8 * k + 4 * n * (n - 1) - 7) / 2 - 0.5)).astype(int)
+        j = (k + i + 1 - n * (n - 1) // 2 + (n - i) * (n - i - 1) // 2).astype(int)
+
+    pair_distances = distances[i, j]
+    pair_correlations = correlations[i, j]
+    valid = ~np.isnan(pair_distances) & ~np.isnan(pair_correlations)
+
+    return pair_distances[valid], pair_correlations[valid]
+
+
+def new_figure(**kwargs):
+    '''
+    Method to create a figure on the Agg canvas, outside pyplot so no window is opened and nothing is kept alive.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(**kwargs)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def plot_kagan(distances, correlations, max_radius, save_path, min_correlation=0.6, curve=None):
+    '''
+    Method to plot and store the Kagan analysis.
+
+    @param distances array[float]: Distances of station pairs in km.
+    @param correlations array[float]: Correlations of the same station pairs.
+    @param max_radius float: Maximum radius of neighbouring stations in km.
+    @param save_path str: Path to write the figure to.
+    @param min_correlation float: Minimum correlation of neighbouring stations.
+    @param curve DataFrame: Binned decay curve from distance_correlation_curve, plotted over the pairs if given.
+    '''
+    figure = new_figure()
+    ax = figure.add_subplot()
+
+    ax.scatter(distances, correlations, s=0.1)
+    if curve is not None:
+        ax.plot(curve['distance'], curve['mean'], c='k', label='Mean')
+        quantile_columns = [column for column in curve.columns if column.startswith('q')]
+        if len(quantile_columns) >= 2:
+            ax.fill_between(curve['distance'], curve[quantile_columns[0]], curve[quantile_columns[-1]], color='k', alpha=0.2, \
+                            label=quantile_columns[0] + ' - ' + quantile_columns[-1])
+        ax.legend()
+    ax.set_xlabel('Distance [km]')
+    ax.set_ylabel('Correlation [-]')
+    ax.axhline(min_correlation, c='r', ls='--')
+    ax.axvline(max_radius, c='r', ls='--')
+    ax.set_title('Kagan analysis')
+
+    figure.savefig(save_path, dpi=settings['dpi'])
+
+
+def plot_DM_curves(cumulative_rainfall_dict, stations_dict, save_path, max_stations=16):
+    '''
+    Method to plot and store the double mass curves: cumulative rainfall of a station against the average of its neighbours.
+
+    @param cumulative_rainfall_dict dict: Per station the average cumulative rainfall of its neighbours and its own, from compute_DM_data.
+    @param stations_dict dict: Per station the list of neighbouring stations.
+    @param save_path str: Path to write the figure to.
+    @param max_stations int: Maximum number of stations to plot, the first stations with neighbours.
+    '''
+    stations = [station for station in cumulative_rainfall_dict if len(stations_dict.get(station, [])) > 0][:max_stations]
+    columns = int(np.ceil(np.sqrt(max(len(stations), 1))))
+    rows = int(np.ceil(max(len(stations), 1) / columns))
+    figure = new_figure(figsize=(3 * columns, 3 * rows))
+
+    # Plot a curve per station
+    for k, station in enumerate(stations):
+        ax = figure.add_subplot(rows, columns, k + 1)
+        curves = cumulative_rainfall_dict[station]
+        ax.plot(curves['average_cum_sum'].to_numpy(), curves['key_column_cum_sum'].to_numpy())
+        upper = np.nanmax([np.nanmax(curves['average_cum_sum'].to_numpy(), initial=0), np.nanmax(curves['key_column_cum_sum'].to_numpy(), initial=0)])
+        ax.plot([0, upper], [0, upper], c='r', ls='--', lw=0.5)
+        ax.set_title(str(station) + ' (' + str(len(stations_dict[station])) + ' neighbours)', fontsize=8)
+        ax.tick_params(labelsize=6)
+
+    figure.supxlabel('Cumulative rainfall of neighbours [mm]')
+    figure.supylabel('Cumulative rainfall of station [mm]')
+    figure.tight_layout()
+    figure.savefig(save_path, dpi=settings['dpi'])
+
+
+def plot_single_events(start_time, end_time, save_path, max_events=100):
+    '''
+    Method to plot the first events as bars on a timeline.
+
+    @param start_time array[datetime64]: Start time of the events, sorted.
+    @param end_time array[datetime64]: End time of the events.
+    @param save_path str: Path to write the figure to.
+    @param max_events int: Maximum number of events to plot.
+    '''
+    import matplotlib.dates as mdates
+
+    n = min(max_events, len(start_time))
+    figure = new_figure()
+    ax = figure.add_subplot()
+
+    # Plot a bar per event from start to end
+    start = mdates.date2num(pd.DatetimeIndex(start_time[:n]))
+    end = mdates.date2num(pd.DatetimeIndex(end_time[:n]))
+    ax.barh(n - np.arange(n), end - start, left=start, height=0.8)
+
+    # Assign date locator / formatter to the x-axis to get proper labels
+    locator = mdates.AutoDateLocator(minticks=3)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%m%d %H:%M'))
+    ax.tick_params(axis='x', labelrotation=60)
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Event')
+    ax.set_yticklabels([])
+    ax.set_title('First ' + str(n) + ' events sorted on start time')
+
+    figure.tight_layout()
+    figure.savefig(save_path, dpi=settings['dpi'])
+
+
+def plot_peak_over_threshold(datetime, values, station, save_path, threshold=0.5):
+    '''
+    Method to visualize the peak over threshold method for one station.
+
+    @param datetime DatetimeIndex: Times of the values.
+    @param values array[float]: Rain gauge data of the station.
+    @param station str: Name of the station.
+    @param save_path str: Path to write the figure to.
+    @param threshold float: Rainfall threshold.
+    '''
+    figure = new_figure()
+    ax = figure.add_subplot()
+
+    ax.bar(datetime, values, width=1/24, color='C0')
+    ax.xaxis_date()
+    ax.axhline(y=threshold, color='r', linestyle='dashed', label='Threshold')
+
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Rain [mm]')
+    ax.set_title('Rain gauge data from station: ' + str(station))
+    ax.legend()
+
+    figure.savefig(save_path, dpi=settings['dpi'])
+
+
+def submit_kagan(distances, correlations, max_radius, name='kagan', min_correlation=0.6, curve=None):
+    '''
+    Method to render the Kagan analysis in the background on a sample of the station pairs, does nothing unless diagnostics are enabled.
+    The sample is taken right away, so the worker does not hold on to the n^2 matrices.
+
+    @param distances array[float]: Distances between stations.
+    @param correlations array[float]: Correlations between stations.
+    '''
+    if not diagnostics_enabled():
+        return None
+
+    pair_distances, pair_correlations = sample_pairs(distances, correlations)
+    return submit_figure(name, plot_kagan, pair_distances, pair_correlations, max_radius, min_correlation=min_correlation, curve=curve)
+
+
+def submit_DM_curves(cumulative_rainfall_dict, stations_dict, name='DM_curves', max_stations=16):
+    '''
+    Method to render the double mass curves in the background, does nothing unless diagnostics are enabled.
+    '''
+    if not diagnostics_enabled():
+        return None
+
+    # Pass only the stations that are plotted
+    stations = [station for station in cumulative_rainfall_dict if len(stations_dict.get(station, [])) > 0][:max_stations]
+    return submit_figure(name, plot_DM_curves, {station: cumulative_rainfall_dict[station] for station in stations}, \
+                         {station: stations_dict[station] for station in stations}, max_stations=max_stations)
+
+
+def submit_single_events(events, name='events', max_events=100):
+    '''
+    Method to render the timeline of the first events in the background, does nothing unless diagnostics are enabled.
+
+    @param events EventTable: Events to plot.
+    '''
+    if not diagnostics_enabled():
+        return None
+
+    # Copy the times of the first events only
+    order = np.argsort(events.start_time, kind='stable')[:max_events]
+    return submit_figure(name, plot_single_events, np.asarray(events.start_time)[order], np.asarray(events.end_time)[order], max_events=max_events)
+
+
+def submit_peak_over_threshold(rain_df, name='peak_over_threshold', threshold=0.5, station=None):
+    '''
+    Method to render the peak over threshold method for one station in the background, does nothing unless diagnostics are enabled.
+
+    @param rain_df DataFrame: Rain gauge data.
+    @param station str: Station to plot, the second column if None.
+    '''
+    if not diagnostics_enabled():
+        return None
+
+    if station is None:
+        station = rain_df.columns[1]
+    return submit_figure(name, plot_peak_over_threshold, rain_df.index, rain_df[station].to_numpy(copy=True), station, threshold=threshold)
@@ -1,16 +1,15 @@
 import numpy as np
 import pandas as pd
-import math
-from statistics import mean
-from datetime import datetime, timedelta
-from matplotlib.patches import Rectangle
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from datetime import datetime
+from profiling import profile_stage
 
 class Event:
     '''
     Rainfall event class
     '''
+    __slots__ = ('start_time', 'end_time', 'duration', 'stations', 'num_stations', \
+                 'reflect_min', 'reflect_avg', 'reflect_max', \
+                 'rain_intens_min', 'rain_intens_avg', 'rain_intens_max', 'rain_cum_avg', 'type')
     
     def __init__(self, start_time, end_time, stations, reflect_min, reflect_avg, reflect_max, rain_intens_min, rain_intens_avg, rain_intens_max):
         
@@ -61,239 +60,360 @@ class Event:
         )
 
 
-def select_events_single_station(station, vals, datetime, radar_df, max_no_rain, min_rain_threshold=0.1):
+def classify_events(rain_intens_avg):
     '''
-    Method to select events per station.
+    Method to classify events on their average rain intensity.
 
-    @param station str: Name of station
-    @param vals list[float]: Rain data of given station for one year
-    @param datetime list[date]: List of dates and times per hour for the entire year
-    @param radar_df DataFrame: Radar data for one year of all stations
-    @param max_no_rain float: Maximum number of hours without rain within one event
-    @param k float: Rainfall threshold
+    @param rain_intens_avg array[float]: Average rain intensity per event in mm/h.
 
-    @return events list[Event]: List of events at this station for the given year
-    @return Z list[float]: List of reflectivity values per hour within events at this station
-    @return R list[float]: List of rainfall values per hour within events at this station
+    @return type array[str]: Type per event (light, moderate, heavy or extreme).
     '''
-    events = []
-    Z = []
-    R = []
-
-    i = 0
-    while i < len(vals):
-        # Check if value is above threshold
-        if vals.iloc[i] >= min_rain_threshold:
-            # Init statistics for event
-            candidate_event = []
-            consecutive_hours_no_rain = 0
-
-            # Loop over remaining values
-            for j in range(i, len(vals)):
-                # Retrieve value
-                val = vals.iloc[j]
-                # Add to event
-                candidate_event.append(val)
-
-                # Check if value is above threshold
-                if val >= min_rain_threshold:
-                    # Reset statistic
-                    consecutive_hours_no_rain = 0
-                else:
-                    # Update statistic
-                    consecutive_hours_no_rain += 1
-                    # Check if max hours without rain is exceeded
-                    if consecutive_hours_no_rain > max_no_rain:
-                        # Set event time
-                        start_time = datetime[i]
-                        end_time = datetime[j - max_no_rain]
-
-                        # Set event reflectivity
-                        reflect_vals = list(radar_df.loc[start_time:end_time][station].values)[:-1]
-                        if len(reflect_vals) == 0:
-                            reflect_min = float('nan')
-                            reflect_avg = float('nan')
-                            reflect_max = float('nan')
-                        else:
-                            reflect_min = min(reflect_vals)
-                            reflect_avg = mean(reflect_vals)
-                            reflect_max = max(reflect_vals)
-
-                        # Set event rain
-                        rain_vals = candidate_event[:-consecutive_hours_no_rain]
-                        if len(rain_vals) == 0:
-                            rain_intens_min = float('nan')
-                            rain_intens_avg = float('nan')
-                            rain_intens_max = float('nan')
-                        else:
-                            rain_intens_min = min(rain_vals)
-                            rain_intens_avg = mean(rain_vals)
-                            rain_intens_max = max(rain_vals)
-
-                        # Check if no nan values in event, otherwise event is discarded
-                        if not math.isnan(rain_intens_avg):
-                            # Create new event
-                            new_event = Event(start_time, end_time, [station], reflect_min, reflect_avg, reflect_max, rain_intens_min, rain_intens_avg, rain_intens_max)
-
-                            # Add to events list
-                            events.append(new_event)
-
-                            # Store rain intensity values
-                            R += rain_vals
-
-                            # Check if 6min sampling vs 60min sampling is still correct
-                            if len(reflect_vals) != 10*len(rain_vals):
-                                raise Exception("Radar dataframe should be sampled per 6min and rain gauge dataframe per 60min. \
-                                                Please check if this is the case!\n \
-                                                The problem occured at station: ",  station, ", from: ", start_time, ", until: ", end_time)
-                            
-                            # Store reflectivity values
-                            Z += reflect_vals
-
-                        # Continue events selection after end of new event
-                        i = j + 1
-                        break
-            
-        # Go to next timestep
-        i += 1
-
-    return events, Z, R
+    rain_intens_avg = np.asarray(rain_intens_avg, dtype=float)
+    with np.errstate(invalid='ignore'):
+        conditions = [rain_intens_avg <= 5.0, rain_intens_avg <= 25.0, rain_intens_avg <= 50.0]
+    return np.select(conditions, ['light', 'moderate', 'heavy'], default='extreme').astype(object)
 
 
-def merge_overlapping_events(events):
+class EventTable:
     '''
-    Method to merge single-station events that overlap in time.
+    Rainfall events stored as columns, with the stations of each event stored as a compressed index:
+    the stations of event k are station_ids[station_ptr[k]:station_ptr[k+1]].
+    '''
+
+    def __init__(self, start_time, end_time, station_ptr, station_ids, reflect_min, reflect_avg, reflect_max, rain_intens_min, rain_intens_avg, rain_intens_max, \
+                 reflect_samples=None, rain_samples=None):
+
+        # Set time properties
+        self.start_time = np.asarray(start_time, dtype='datetime64[ns]')
+        self.end_time = np.asarray(end_time, dtype='datetime64[ns]')
+        self.duration = (self.end_time - self.start_time) // np.timedelta64(1, 'h')
+
+        # Set station properties
+        self.station_ptr = np.asarray(station_ptr, dtype=int)
+        self.station_ids = np.asarray(station_ids, dtype=object)
+        self.num_stations = np.diff(self.station_ptr)
+
+        # Set reflectivity properties
+        self.reflect_min = np.asarray(reflect_min, dtype=float)
+        self.reflect_avg = np.asarray(reflect_avg, dtype=float)
+        self.reflect_max = np.asarray(reflect_max, dtype=float)
+
+        # Set rain properties
+        self.rain_intens_min = np.asarray(rain_intens_min, dtype=float)
+        self.rain_intens_avg = np.asarray(rain_intens_avg, dtype=float)
+        self.rain_intens_max = np.asarray(rain_intens_max, dtype=float)
+        self.rain_cum_avg = self.rain_intens_avg * self.duration
 
-    @param events list[Event]: Events detected per station
+        # Set number of values the averages are based on (per 6min and per hour by default)
+        self.reflect_samples = 10 * self.duration if reflect_samples is None else np.asarray(reflect_samples, dtype=int)
+        self.rain_samples = self.duration.copy() if rain_samples is None else np.asarray(rain_samples, dtype=int)
 
-    @return result list[Event]: Events including multiple stations
+        # Set type
+        self.type = classify_events(self.rain_intens_avg)
+
+    @classmethod
+    def from_events(cls, events):
+        '''
+        Method to convert a list of events into a table.
+
+        @param events list[Event]: Events to convert.
+
+        @return table EventTable: Events as columns.
+        '''
+        station_ptr = np.r_[0, np.cumsum([e.num_stations for e in events])].astype(int)
+        station_ids = [station for e in events for station in e.stations]
+        columns = [[getattr(e, attr) for e in events] for attr in ('start_time', 'end_time', 'reflect_min', 'reflect_avg', 'reflect_max', \
+                                                                  'rain_intens_min', 'rain_intens_avg', 'rain_intens_max')]
+        start_time, end_time = pd.DatetimeIndex(columns[0]), pd.DatetimeIndex(columns[1])
+        return cls(start_time, end_time, station_ptr, station_ids, *columns[2:])
+
+    def __len__(self):
+        return len(self.start_time)
+
+    def __getitem__(self, k):
+        '''
+        Method to view a single event as Event object, created on access.
+        '''
+        if k < 0:
+            k += len(self)
+        return Event(pd.Timestamp(self.start_time[k]), pd.Timestamp(self.end_time[k]), self.stations(k), \
+                     self.reflect_min[k], self.reflect_avg[k], self.reflect_max[k], \
+                     self.rain_intens_min[k], self.rain_intens_avg[k], self.rain_intens_max[k])
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def stations(self, k):
+        '''
+        Method to get the stations of a single event.
+        '''
+        return list(self.station_ids[self.station_ptr[k]:self.station_ptr[k+1]])
+
+    def take(self, indices):
+        '''
+        Method to select and reorder events.
+
+        @param indices array[int]: Indices of the events to keep, in the new order.
+
+        @return table EventTable: Selected events.
+        '''
+        indices = np.asarray(indices, dtype=int)
+        station_idx = concat_ranges(self.station_ptr[indices], self.station_ptr[indices + 1])
+        station_ptr = np.r_[0, np.cumsum(self.num_stations[indices])]
+        return EventTable(self.start_time[indices], self.end_time[indices], station_ptr, self.station_ids[station_idx], \
+                          self.reflect_min[indices], self.reflect_avg[indices], self.reflect_max[indices], \
+                          self.rain_intens_min[indices], self.rain_intens_avg[indices], self.rain_intens_max[indices], \
+                          self.reflect_samples[indices], self.rain_samples[indices])
+
+    def to_frame(self):
+        '''
+        Method to convert the events into a DataFrame with a row per event.
+        '''
+        # Slice the lists of stations per event from the compressed index
+        station_ids = self.station_ids.tolist()
+        stations = [station_ids[start:end] for start, end in zip(self.station_ptr[:-1].tolist(), self.station_ptr[1:].tolist())]
+
+        return pd.DataFrame({
+            'start_time': self.start_time, 'end_time': self.end_time, 'duration': self.duration,
+            'stations': stations,
+            'num_stations': self.num_stations,
+            'reflect_min': self.reflect_min, 'reflect_avg': self.reflect_avg, 'reflect_max': self.reflect_max,
+            'rain_intens_min': self.rain_intens_min, 'rain_intens_avg': self.rain_intens_avg, 'rain_intens_max': self.rain_intens_max,
+            'rain_cum_avg': self.rain_cum_avg, 'type': self.type})
+
+
+def detect_events(rain_values, max_no_rain, min_rain_threshold=0.1):
     '''
-    # Sort the events on start time
-    events.sort(key=lambda e: e.start_time)
+    Method to detect the events of all stations at once from their wet and dry runs.
+    An event starts at an hour with rain and ends when more than max_no_rain hours without rain follow,
+    events that have not ended before the last hour are discarded.
 
-    # Plot single events sorted
-    plot_single_events(events)
+    @param rain_values array[float]: Rain data of shape (n_hours, n_stations), or a single station of shape (n_hours,).
+    @param max_no_rain int: Maximum number of hours without rain within one event
+    @param min_rain_threshold float: Rainfall threshold
 
-    # Init list to store the merged events and store first event
-    result = [events[0]]
+    @return station_idx array[int]: Column of the station per event, events are sorted on station and then on time.
+    @return start_idx array[int]: Index of the first hour per event.
+    @return end_idx array[int]: Index of the hour after the last hour with rain per event.
+    '''
+    rain_values = np.asarray(rain_values, dtype=float)
+    if rain_values.ndim == 1:
+        rain_values = rain_values[:, None]
+    n_hours, n_stations = rain_values.shape
+
+    # Threshold all values at once, missing values count as hours without rain
+    with np.errstate(invalid='ignore'):
+        wet = rain_values >= min_rain_threshold
+
+    # Find the wet runs of all stations, sorted on station and then on time
+    padded = np.zeros((n_stations, n_hours + 2), dtype=np.int8)
+    padded[:, 1:-1] = wet.T
+    change = np.diff(padded, axis=1)
+    run_station, run_start = np.nonzero(change == 1)
+    _, run_end = np.nonzero(change == -1)
+
+    # Runs separated by more than max_no_rain dry hours belong to different events
+    first_of_station = np.r_[True, run_station[1:] != run_station[:-1]]
+    gap = run_start - np.r_[0, run_end[:-1]]
+    head = first_of_station | (gap > max_no_rain)
+    heads = np.nonzero(head)[0]
+    tails = np.r_[heads[1:], len(run_start)][:len(heads)] - 1
+
+    # An event only ends if its dry hours fit before the last hour
+    ended = run_end[tails] + max_no_rain <= n_hours - 1
+
+    # Selection resumes two hours after the end of an event, so the first hour of the next event is
+    # skipped if exactly max_no_rain + 1 dry hours separate them
+    after_gap = ~first_of_station[heads] & (gap[heads] == max_no_rain + 1)
+    # An event consisting of a single hour with rain is then skipped entirely, so no hour is skipped after it
+    single_hour = (heads == tails) & (run_end[heads] - run_start[heads] == 1)
+    chain = after_gap & single_hour
+    # Within consecutive skipped single-hour events only every other one is skipped
+    position = np.arange(len(heads))
+    chain_head = chain & ~np.r_[False, chain[:-1]]
+    chain_position = position - np.maximum.accumulate(np.where(chain_head, position, 0))
+    started = ~chain | (chain_position % 2 == 1)
+    skip = after_gap & np.r_[True, started[:-1]]
+
+    # Set the first hour of each event, moving one hour (or to the next run) when skipped
+    start_idx = run_start[heads].copy()
+    second_run = np.minimum(heads + 1, len(run_start) - 1)
+    start_idx[skip] = np.where(run_end[heads] - run_start[heads] > 1, run_start[heads] + 1, run_start[second_run])[skip]
+
+    # Keep events that started and ended
+    keep = ended & started
+    station_idx = run_station[heads][keep]
+    end_idx = run_end[tails][keep]
+    start_idx = start_idx[keep]
+
+    return station_idx, start_idx, end_idx
+
+
+def concat_ranges(starts, ends):
+    '''
+    Method to concatenate the integer ranges [start, end) without a loop.
 
-    # Loop over events (and skip the first)
-    for e in events[1:]:
-        # Check if current event and last merged event overlap
-        if e.start_time <= result[-1].end_time:
-            # Merge events and overwrite last one in result
-            result[-1] = merge_two_events(result[-1], e)
-        else:
-            # If event is later than last merged, add event to the result
-            result.append(e)
+    @param starts array[int]: First value of each range.
+    @param ends array[int]: Value after the last value of each range.
 
-    return result
+    @return values array[int]: All values of the ranges, one range after the other.
+    '''
+    lengths = np.maximum(ends - starts, 0)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
 
 
-def merge_two_events(e1, e2):
+@profile_stage('select_events_all_stations')
+def select_events_all_stations(rain_df, radar_df, max_no_rain, min_rain_threshold=0.1):
     '''
-    Method to merge two events.
+    Method to select the single-station events of all stations at once.
 
-    @param e1 Event: Event to be merged.
-    @param e2 Event: Event to be merged.
+    @param rain_df DataFrame: Rain data per 60min for one year of all stations
+    @param radar_df DataFrame: Radar data per 6min for one year of all stations
+    @param max_no_rain int: Maximum number of hours without rain within one event
+    @param min_rain_threshold float: Rainfall threshold
 
-    @return merged_event Event: Merged event.
+    @return events EventTable: Table of events, sorted on station and then on time
+    @return Z array[float]: Vector of reflectivity values per 6min within all events
+    @return R array[float]: Vector of rainfall values per hour within all events
     '''
-    # Pick earliest start time
-    start_time = min(e1.start_time, e2.start_time)
-    # Pick latest end time
-    end_time = max(e1.end_time, e2.end_time)
-    # Concat lists of stations
-    stations = e1.stations + e2.stations
+    rain_values = rain_df.to_numpy(dtype=float)
+    radar_values = radar_df[rain_df.columns].to_numpy(dtype=float)
+    datetime = rain_df.index
 
-    # Recompute reflectivity
-    reflect_min = min(e1.reflect_min, e2.reflect_min)
-    reflect_avg = (e1.reflect_avg * e1.duration + e2.reflect_avg * e2.duration) / (e1.duration + e2.duration)
-    reflect_max = max(e1.reflect_max, e2.reflect_max)
+    # Detect the events of all stations
+    station_idx, start_idx, end_idx = detect_events(rain_values, max_no_rain, min_rain_threshold)
+
+    # Gather the rain of all events and reduce per event
+    rain_lengths = end_idx - start_idx
+    rain_offsets = np.cumsum(rain_lengths) - rain_lengths
+    rain_vals = rain_values[concat_ranges(start_idx, end_idx), np.repeat(station_idx, rain_lengths)]
+    if len(rain_vals) > 0:
+        rain_intens_min = np.minimum.reduceat(rain_vals, rain_offsets)
+        rain_intens_avg = np.add.reduceat(rain_vals, rain_offsets) / rain_lengths
+        rain_intens_max = np.maximum.reduceat(rain_vals, rain_offsets)
+    else:
+        rain_intens_min = rain_intens_avg = rain_intens_max = np.empty(0)
+
+    # Discard events with nan values
+    valid = ~np.isnan(rain_intens_avg)
+
+    # Find the radar rows from start until (not including) end of each event
+    radar_start = radar_df.index.searchsorted(datetime[start_idx], side='left')
+    radar_end = np.maximum(radar_df.index.searchsorted(datetime[end_idx], side='right') - 1, radar_start)
+    reflect_lengths = radar_end - radar_start
+
+    # Check if 6min sampling vs 60min sampling is still correct
+    wrong = valid & (reflect_lengths != 10*rain_lengths)
+    if wrong.any():
+        k = np.argmax(wrong)
+        raise Exception("Radar dataframe should be sampled per 6min and rain gauge dataframe per 60min. \
+                        Please check if this is the case!\n \
+                        The problem occured at station: ",  rain_df.columns[station_idx[k]], ", from: ", datetime[start_idx[k]], ", until: ", datetime[end_idx[k]])
+
+    # Keep valid events only
+    station_idx, start_idx, end_idx = station_idx[valid], start_idx[valid], end_idx[valid]
+    rain_intens_min, rain_intens_avg, rain_intens_max = rain_intens_min[valid], rain_intens_avg[valid], rain_intens_max[valid]
+    radar_start, radar_end, reflect_lengths = radar_start[valid], radar_end[valid], reflect_lengths[valid]
+
+    # Gather the reflectivity of all events and reduce per event
+    reflect_offsets = np.cumsum(reflect_lengths) - reflect_lengths
+    Z = radar_values[concat_ranges(radar_start, radar_end), np.repeat(station_idx, reflect_lengths)]
+    R = rain_values[concat_ranges(start_idx, end_idx), np.repeat(station_idx, end_idx - start_idx)]
+    if len(Z) > 0:
+        reflect_min = np.minimum.reduceat(Z, reflect_offsets)
+        reflect_avg = np.add.reduceat(Z, reflect_offsets) / reflect_lengths
+        reflect_max = np.maximum.reduceat(Z, reflect_offsets)
+    else:
+        reflect_min = reflect_avg = reflect_max = np.empty(0)
+
+    # Create event table
+    events = EventTable(datetime[start_idx], datetime[end_idx], np.arange(len(station_idx) + 1), rain_df.columns[station_idx], \
+                        reflect_min, reflect_avg, reflect_max, rain_intens_min, rain_intens_avg, rain_intens_max, \
+                        reflect_lengths, end_idx - start_idx)
 
-    # Recompute rain intensity
-    rain_intens_min = min(e1.rain_intens_min, e2.rain_intens_min)
-    rain_intens_avg = (e1.rain_intens_avg * e1.duration + e2.rain_intens_avg * e2.duration) / (e1.duration + e2.duration)
-    rain_intens_max = max(e1.rain_intens_max, e2.rain_intens_max)
+    return events, Z, R
 
-    # Create new event
-    merged_event = Event(start_time, end_time, stations, reflect_min, reflect_avg, reflect_max, rain_intens_min, rain_intens_avg, rain_intens_max)
 
-    return merged_event
+@profile_stage('select_events_single_station')
+def select_events_single_station(station, vals, datetime, radar_df, max_no_rain, min_rain_threshold=0.1):
+    '''
+    Method to select events per station.
 
+    @param station str: Name of station
+    @param vals list[float]: Rain data of given station for one year
+    @param datetime list[date]: List of dates and times per hour for the entire year
+    @param radar_df DataFrame: Radar data for one year of all stations
+    @param max_no_rain float: Maximum number of hours without rain within one event
+    @param k float: Rainfall threshold
 
-def plot_peak_over_threshold(rain_df, threshold=0.5):
+    @return events list[Event]: List of events at this station for the given year
+    @return Z list[float]: List of reflectivity values per hour within events at this station
+    @return R list[float]: List of rainfall values per hour within events at this station
     '''
-    Method to visualize peak over threshold method.
+    rain_df = pd.DataFrame({station: np.asarray(vals, dtype=float)}, index=pd.DatetimeIndex(datetime))
+    events, Z, R = select_events_all_stations(rain_df, radar_df, max_no_rain, min_rain_threshold)
+
+    return list(events), list(Z), list(R)
 
-    @param rain_df DataFrame: Rain gauge data.
+
+def assign_clusters(start_time, end_time):
     '''
-    # Select a station
-    station = rain_df.columns[1]
-    vals = rain_df[station]
+    Method to assign events sorted on start time to clusters of events overlapping in time, in one sweep.
 
-    # Get time column
-    datetime = rain_df.index
+    @param start_time array[datetime64]: Start time per event, sorted.
+    @param end_time array[datetime64]: End time per event.
 
-    for i in range(len(vals)):
-        ax = plt.subplot()
-        ax.bar(datetime[i], vals[i], color='C0')
-    
-    ax.xaxis_date()
-    ax.axhline(y=threshold, color='r', linestyle='dashed', label='Threshold') 
+    @return cluster_id array[int]: Cluster per event, numbered in order of time.
+    '''
+    # A new cluster starts when an event starts after all previous events ended
+    new_cluster = np.ones(len(start_time), dtype=bool)
+    new_cluster[1:] = start_time[1:] > np.maximum.accumulate(end_time)[:-1]
 
-    ax.set_xlabel('Time')
-    ax.set_ylabel('Reflectivity (dBZ)')
-    ax.set_title('Rain gauge data from station: ' + station)
-    plt.legend()
-    plt.show()
+    return np.cumsum(new_cluster) - 1
 
 
-def plot_single_events(events):
+@profile_stage('merge_overlapping_events')
+def merge_overlapping_events(events):
     '''
-    Method to visualize all single events.
+    Method to merge single-station events that overlap in time.
+
+    @param events EventTable: Events detected per station
 
-    @param events list[Event]: List of events to plot.
+    @return result EventTable: Events including multiple stations
     '''
-    # Create new plot
-    fig = plt.figure()
-    ax = fig.add_subplot()
-
-    # Loop over events
-    for i in range(100):
-        # Retrieve event
-        e = events[i]
-
-        # Convert to matplotlib date representation
-        start = mdates.date2num(e.start_time)
-        end = mdates.date2num(e.end_time)
-        width = end - start
-
-        # Plot rectangle
-        rect = Rectangle((start, len(events)-i), width, 0.8)
-        ax.add_patch(rect)
-
-    # Assign date locator / formatter to the x-axis to get proper labels
-    locator = mdates.AutoDateLocator(minticks=3)
-    formatter = mdates.DateFormatter('%m%d %H:%M')
-    ax.xaxis.set_major_locator(locator)
-    ax.xaxis.set_major_formatter(formatter)
-
-    # Set configs
-    ax.set_aspect('auto')
-    ax.use_sticky_edges = False
-    ax.autoscale(enable=True, tight=False)
-    plt.xticks(rotation=60)
-    ax.set_xlabel('Time')
-    ax.set_ylabel('Event')
-    ax.set_yticklabels([])
-    ax.set_title('First 100 events sorted on start time')
-
-    # Show
-    plt.show()
-
-
-def select_all_events(rain_df, radar_df, max_no_rain, min_rain_threshold=0.1):
+    # Sort the events on start time
+    events = events.take(np.argsort(events.start_time, kind='stable'))
+
+    # Assign events to clusters, which are contiguous after sorting
+    cluster_id = assign_clusters(events.start_time, events.end_time)
+    heads = np.nonzero(np.r_[True, cluster_id[1:] != cluster_id[:-1]])[0]
+
+    # Pick earliest start time and latest end time
+    start_time = events.start_time[heads]
+    end_time = np.maximum.reduceat(events.end_time, heads)
+
+    # Concat stations of the events in each cluster
+    station_ptr = events.station_ptr[np.r_[heads, len(events)]]
+
+    # Combine statistics, weighting averages by the number of values of each event
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reflect_samples = np.add.reduceat(events.reflect_samples, heads)
+        reflect_avg = np.add.reduceat(events.reflect_avg * events.reflect_samples, heads) / reflect_samples
+        rain_samples = np.add.reduceat(events.rain_samples, heads)
+        rain_intens_avg = np.add.reduceat(events.rain_intens_avg * events.rain_samples, heads) / rain_samples
+
+    result = EventTable(start_time, end_time, station_ptr, events.station_ids, \
+                        np.minimum.reduceat(events.reflect_min, heads), reflect_avg, np.maximum.reduceat(events.reflect_max, heads), \
+                        np.minimum.reduceat(events.rain_intens_min, heads), rain_intens_avg, np.maximum.reduceat(events.rain_intens_max, heads), \
+                        reflect_samples, rain_samples)
+
+    return result
+
+
+@profile_stage('select_all_events')
+def select_all_events(rain_df, radar_df, max_no_rain, min_rain_threshold=0.1, return_metadata=False):
     '''
     Method that selects rain events from the rain gauge data.
 
@@ -301,35 +421,21 @@ def select_all_events(rain_df, radar_df, max_no_rain, min_rain_threshold=0.1):
     @param radar_df DataFrame: Radar data for one year of all stations
     @param max_no_rain int: Maximum number of hours without rain within one event
     @param k int: Rainfall threshold
+    @param return_metadata bool: Also return the time, station and event of each pair of Z and R
 
-    @return events list[Event]: List of events for the given year
+    @return events EventTable: Table of events for the given year
     @return Z array[float]: Vector of reflectivity values per hour per station within all events
     @return R array[float]: Vector of rainfall values per hour per station within all events
+    @return metadata DataFrame: Datetime, station and (merged) event per pair of Z and R, only if return_metadata
     '''
-    # Init event list
-    events = []
-    Z = []
-    R = []
-
-    # Get time column
-    datetime = rain_df.index
-
-    # Loop over stations and correspoding values
-    for (station, vals) in rain_df.items():
-        # Select events for single station
-        single_events, single_Z, single_R = select_events_single_station(station, vals, datetime, radar_df, max_no_rain, min_rain_threshold)
-        events += single_events
-        Z += single_Z
-        R += single_R
+    # Select events of all stations at once
+    single_events, Z, R = select_events_all_stations(rain_df, radar_df, max_no_rain, min_rain_threshold)
 
     # Merge single-station events that overlap in time
+    events = single_events
     if len(events) > 1:
         events = merge_overlapping_events(events)
 
-    # Convert lists to numpy arrays for convience in calibration
-    Z = np.array(Z)
-    R = np.array(R)
-
     # Reshape reflectivity to vectors of 10, so a vector of values per hour
     new_shape = (len(Z) // 10, 10)
     Z = Z.reshape(new_shape)
@@ -337,25 +443,26 @@ def select_all_events(rain_df, radar_df, max_no_rain, min_rain_threshold=0.1):
     # Throw exception if dimensions of Z and R do not correspond
     if len(Z) != len(R):
         raise Exception("Lengths of reflectivity vector Z and rainfall vector R not equal: " + str(len(Z)) + " != " + str(len(R)))
-    
-    # Filter out pairs where reflectivity is 0
-    non_zero_mask = np.all(Z != 0, axis=1)
-    R = R[non_zero_mask]
-    Z = Z[non_zero_mask]
-
-    # Filter out pairs where reflectivity is nan
-    non_nan_mask = np.all(~np.isnan(Z), axis=1)
-    R = R[non_nan_mask]
-    Z = Z[non_nan_mask]
-
-    # Filter out pairs where rain intensity is 0
-    Z = Z[R != 0]
-    R = R[R != 0]
-
-    # Filter out pairs where rain intensity is nan
-    Z = Z[~np.isnan(R)]
-    R = R[~np.isnan(R)]
 
+    # Keep pairs where reflectivity and rain intensity are neither 0 nor nan
+    with np.errstate(invalid='ignore'):
+        keep = np.all((Z != 0) & ~np.isnan(Z), axis=1) & (R != 0) & ~np.isnan(R)
+    Z = Z[keep]
+    R = R[keep]
+
+    if return_metadata:
+        # Store time, station and event of each hour within the events
+        order = np.argsort(single_events.start_time, kind='stable')
+        event_id = np.empty(len(single_events), dtype=int)
+        event_id[order] = assign_clusters(single_events.start_time[order], single_events.end_time[order])
+        hours = concat_ranges(np.zeros(len(single_events), dtype=int), single_events.rain_samples)
+        rows = np.nonzero(keep)[0]
+        pair_event = np.repeat(np.arange(len(single_events)), single_events.rain_samples)[rows]
+        metadata = pd.DataFrame({
+            'datetime': np.asarray(single_events.start_time)[pair_event] + hours[rows] * np.timedelta64(1, 'h'),
+            'station': np.asarray(single_events.station_ids)[pair_event],
+            'event': event_id[pair_event]})
+        return events, Z, R, metadata
     return events, Z, R
 
 
@@ -363,33 +470,23 @@ def write_events_to_excel(events, save_path):
     '''
     Method save events in excel file.
 
-    @param events list[Event]: List of events for the given year
+    @param events EventTable: Table of events for the given year (a list of Event objects is converted)
     @param save_path str: Path where file should be saved (including .xlsx extension)
     '''
+    # Convert list of events into table
+    if not isinstance(events, EventTable):
+        events = EventTable.from_events(events)
 
-    # Set column names
-    columns = ['start_time', 'end_time', 'duration', \
-                'stations', 'num_stations', \
-                'reflect_min_dBZ', 'reflect_avg_dBZ', 'reflect_max_dBZ', \
-                'rain_initens_min', 'rain_intens_avg', 'rain_intens_max', 'rain_cum_avg', \
-                'type']
-    
-    # Init empty DataFrame
-    events_df = pd.DataFrame(columns=columns)
-    # Init func for Z -> dBZ conversion
-    to_dBZ = lambda x : 0 if x == 0 else max(10*math.log10(x), 0)
-
-    # Loop over events
-    for e in events:
-        # Convert attributes from event into row
-        event_row = [e.start_time, e.end_time, e.duration, \
-                    e.stations, e.num_stations, \
-                    to_dBZ(e.reflect_min), to_dBZ(e.reflect_avg), to_dBZ(e.reflect_max), \
-                    e.rain_intens_min, e.rain_intens_avg, e.rain_intens_max, e.rain_cum_avg, \
-                    e.type]
-        
-        # Store in dataframe
-        events_df.loc[len(events_df)] = event_row
+    # Get all events as DataFrame at once
+    events_df = events.to_frame()
+
+    # Convert reflectivity from Z to dBZ
+    for column in ['reflect_min', 'reflect_avg', 'reflect_max']:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dBZ = np.where(events_df[column] == 0, 0, np.maximum(10*np.log10(events_df[column]), 0))
+        events_df[column] = dBZ
+    events_df = events_df.rename(columns={'reflect_min': 'reflect_min_dBZ', 'reflect_avg': 'reflect_avg_dBZ', 'reflect_max': 'reflect_max_dBZ', \
+                                          'rain_intens_min': 'rain_initens_min'})
 
     # Write DataFrame to excel
-    events_df.to_excel(save_path)
\ No newline at end of file
+    events_df.to_excel(save_path)
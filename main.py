@@ -1,8 +1,14 @@
+import os
+import sys
+import shutil
 import argparse
-from data_preparation.rain_gauge import prepare_rain_gauge_data
-from data_preparation.radar import prepare_radar_data
+import tempfile
+import numpy as np
+from multi_year import parse_years, prepare_years
+from profiling import profile_stage, enable_profiling, write_profile_report
+from diagnostics import enable_diagnostics, submit_single_events, wait_for_figures
 from event_selection import select_all_events
-from calibration import calibrate
+from calibration import calibrate, calibrate_streaming, save_calibration_data, calibrate_batch, bootstrap_subsets, leave_one_out_subsets, group_subsets, bootstrap_interval
 
 if __name__ == '__main__':
     # Parse command line arguments
@@ -10,57 +16,113 @@ if __name__ == '__main__':
     parser.add_argument('--rain_gauge_data_path', type=str, default="./data/rain_gauge")
     parser.add_argument('--radar_data_path', type=str, default="./data/radar")
     parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--years', type=str, default=None, help='Years to analyse together, e.g. 2013-2022 or 2013,2015 (overrides --year).')
+    parser.add_argument('--memory_per_year', type=float, default=2.0, help='Expected peak memory of preparing one year in GB, limits the number of years prepared at once.')
     parser.add_argument('--station_threshold', type=float, default=40, help='Threshold percentage of non-missing data per station')
     parser.add_argument('--noise_threshold', type=float, default=15, help='Threshold underneath which is considered noise (in dBZ).')
     parser.add_argument('--hail_threshold', type=float, default=53, help='Threshold above which is considered hail (in dBZ).')
     parser.add_argument('--max_no_rain', type=int, default=2, help='Maximum number of hours without rain within one event')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to prepare the years, decode the radar data and to calibrate in batch.')
+    parser.add_argument('--cache_path', type=str, default=None, help='Directory to cache the prepared radar and rain gauge data in (no caching if not given).')
+    parser.add_argument('--n_bootstrap', type=int, default=0, help='Number of bootstrap resamples of events to estimate the uncertainty of a and b (none if 0).')
+    parser.add_argument('--calibration_method', type=str, default='gradient', choices=['gradient', 'profile', 'finite_difference'], help='Optimization method used to calibrate a and b.')
+    parser.add_argument('--chunk_size', type=int, default=None, help='Number of hours per chunk to calibrate streamed from Z and R written to disk (all in memory if not given). Event selection still builds Z and R in memory first, so this does not lower the peak memory of a run.')
+    parser.add_argument('--calibration_data_path', type=str, default=None, help='Directory to write Z.npy and R.npy to with --chunk_size (a temporary directory if not given).')
+    parser.add_argument('--incremental', action='store_true', help='Only decode radar files that are new or changed since the last run (requires --cache_path).')
+    parser.add_argument('--profile', type=str, default=None, help='Path of a .json or .csv report with the time and memory of every stage (no profiling if not given).')
+    parser.add_argument('--cprofile_stage', type=str, default=None, help='Name of a stage (e.g. minimize) to dump cProfile statistics of next to the --profile report.')
+    parser.add_argument('--figures', type=str, default=None, help='Directory to write the diagnostic figures to, rendered in the background (no figures if not given).')
+    parser.add_argument('--max_scatter_points', type=int, default=20000, help='Maximum number of station pairs in the scatter plot of the Kagan analysis.')
     args = dict(vars(parser.parse_args()))
+
+    # Render diagnostic figures to files
+    if args['figures'] is not None:
+        enable_diagnostics(args['figures'], max_points=args['max_scatter_points'])
+
+    # Record time and memory of the stages
+    profile_path = args['profile']
+    if profile_path is not None:
+        cprofile_stage = args['cprofile_stage']
+        cprofile_path = None if cprofile_stage is None else os.path.splitext(profile_path)[0] + '_' + cprofile_stage + '.prof'
+        enable_profiling(cprofile_stage, cprofile_path)
     
     ########## DATA PREPARATION ###########
     # Initialize provided arguments
     rain_gauge_data_path = args['rain_gauge_data_path']
     radar_data_path = args['radar_data_path']
-    year = args['year']
+    years = [args['year']] if args['years'] is None else parse_years(args['years'])
     station_threshold = args['station_threshold']
     noise_threshold = args['noise_threshold']
     hail_threshold = args['hail_threshold']
+    workers = args['workers']
+    memory_per_year = args['memory_per_year'] * 1e9
+    cache_path = args['cache_path']
+    incremental = args['incremental']
 
-    # Prepare rain gauge data per hour in mm
-    print('Preparing rain gauge data...')
-    rain_gauge_data, dm_results, surrounding_stations = prepare_rain_gauge_data(rain_gauge_data_path, year, station_threshold, nrows=100)
-    print('Done')
-
-    # Prepare radar data in per hour in Z
-    print('Preparing radar data...')
+    # Prepare rain gauge data per hour in mm and radar data in Z, aligned on stations and time
+    print('Preparing rain gauge and radar data...')
     months = ['01']
     days = ['01', '02']
-    radar_data = prepare_radar_data(radar_data_path, year, noise_threshold, hail_threshold, months=months, days=days)
+    with profile_stage('preparation'):
+        rain_gauge_data, radar_data = prepare_years(years, rain_gauge_data_path, radar_data_path, station_threshold, noise_threshold, hail_threshold, \
+                                                    months=months, days=days, workers=workers, memory_per_year=memory_per_year, cache_path=cache_path, incremental=incremental)
     print('Done')
 
-    # Align rain gauge and radar data
-    # Discard stations outside radar region or defect
-    intersection_columns = [station for station in rain_gauge_data.columns if station in radar_data.columns]
-    radar_data = radar_data[intersection_columns]
-    rain_gauge_data = rain_gauge_data[intersection_columns]
-
-    # Align rain gauge to radar data regarding the time
-    start_date = max(radar_data.index[0], rain_gauge_data.index[0])
-    end_date = min(radar_data.index[-1], rain_gauge_data.index[-1]).replace(second=0, minute=0)
-    rain_gauge_data = rain_gauge_data[(rain_gauge_data.index >= start_date) & (rain_gauge_data.index < end_date)]
-    radar_data = radar_data[(radar_data.index >= start_date) & (radar_data.index < end_date)]
-
     ############ EVENT SELECTION ##########
     # Initialize provided arguments
     max_no_rain = args['max_no_rain']
 
     # Select events based on prepared data
     print('Selecting events...')
-    events, Z, R = select_all_events(rain_gauge_data, radar_data, max_no_rain)
+    with profile_stage('event_selection'):
+        events, Z, R, metadata = select_all_events(rain_gauge_data, radar_data, max_no_rain, return_metadata=True)
+    submit_single_events(events)
     print(Z)
     print(R)
 
     ########### CALIBRATION ###########
     print('Calibrating...')
-    a, b = calibrate(Z, R)
+    calibration_method = args['calibration_method']
+    chunk_size = args['chunk_size']
+    calibration_data_path = None
+    with profile_stage('calibration'):
+        if chunk_size is None:
+            a, b = calibrate(Z, R, method=calibration_method)
+        else:
+            # Write Z and R to disk and continue on memory-mapped copies, event selection already held them in memory so the peak memory stays the same
+            calibration_data_path = args['calibration_data_path'] or tempfile.mkdtemp(prefix='calibration_data_')
+            save_calibration_data(calibration_data_path, Z, R)
+            del Z, R
+            Z = np.load(calibration_data_path + '/Z.npy', mmap_mode='r')
+            R = np.load(calibration_data_path + '/R.npy', mmap_mode='r')
+            a, b = calibrate_streaming(calibration_data_path, chunk_size, method=calibration_method)
     print('Optimal a: ', a)
     print('Optimal b: ', b)
+
+    # Calibrate on bootstrap resamples of events, leaving out each station and per month
+    n_bootstrap = args['n_bootstrap']
+    if n_bootstrap > 0:
+        print('Estimating uncertainty...')
+        subsets = {}
+        subsets.update(bootstrap_subsets(metadata['event'], n_bootstrap))
+        subsets.update(leave_one_out_subsets(metadata['station']))
+        subsets.update(group_subsets(metadata['datetime'].dt.month))
+        with profile_stage('uncertainty'):
+            fits = calibrate_batch(Z, R, subsets, workers=workers, method=calibration_method)
+        print(fits)
+        print(bootstrap_interval(fits))
+
+    # Remove the temporary calibration data
+    if calibration_data_path is not None and args['calibration_data_path'] is None:
+        del Z, R
+        shutil.rmtree(calibration_data_path)
+
+    # Wait for the figures to be written
+    if args['figures'] is not None:
+        wait_for_figures()
+        print('Figures written to: ', args['figures'])
+
+    # Write the time and memory of the stages
+    if profile_path is not None:
+        write_profile_report(profile_path, {'argv': sys.argv, **args})
+        print('Profile written to: ', profile_path)
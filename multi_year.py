@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+from itertools import repeat
+from parallel import ordered_map, memory_limited_workers
+from data_preparation.rain_gauge import prepare_rain_gauge_data
+from data_preparation.radar import prepare_radar_data
+from profiling import profile_stage
+from diagnostics import wait_for_figures
+
+
+def parse_years(years):
+    '''
+    Method to parse the years to analyse.
+
+    @param years str: Range of years (2013-2022), comma separated years (2013,2015) or a combination.
+
+    @return years list[int]: Sorted years.
+    '''
+    result = set()
+    for part in str(years).split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            result.update(range(int(first), int(last) + 1))
+        else:
+            result.add(int(part))
+
+    return sorted(result)
+
+
+def align_data(rain_gauge_data, radar_data):
+    '''
+    Method to align rain gauge and radar data on their stations and time.
+
+    @param rain_gauge_data DataFrame: Rain gauge data per hour.
+    @param radar_data DataFrame: Radar data.
+
+    @return rain_gauge_data DataFrame: Rain gauge data of the common stations within the common time.
+    @return radar_data DataFrame: Radar data of the common stations within the common time.
+    '''
+    # Discard stations outside radar region or defect
+    intersection_columns = [station for station in rain_gauge_data.columns if station in radar_data.columns]
+    radar_data = radar_data[intersection_columns]
+    rain_gauge_data = rain_gauge_data[intersection_columns]
+
+    # Nothing to align without data
+    if len(radar_data) == 0 or len(rain_gauge_data) == 0:
+        return rain_gauge_data.iloc[:0], radar_data.iloc[:0]
+
+    # Align rain gauge to radar data regarding the time
+    start_date = max(radar_data.index[0], rain_gauge_data.index[0])
+    end_date = min(radar_data.index[-1], rain_gauge_data.index[-1]).replace(second=0, minute=0)
+    rain_gauge_data = rain_gauge_data[(rain_gauge_data.index >= start_date) & (rain_gauge_data.index < end_date)]
+    radar_data = radar_data[(radar_data.index >= start_date) & (radar_data.index < end_date)]
+
+    return rain_gauge_data, radar_data
+
+
+@profile_stage('prepare_year')
+def prepare_year(year, rain_gauge_data_path, radar_data_path, station_threshold, noise_threshold, hail_threshold, months=None, days=None, workers=1, cache_path=None, incremental=False):
+    '''
+    Method to prepare and align the rain gauge and radar data of one year.
+
+    @param year int: Year to prepare.
+    @param workers int: Number of processes decoding the radar days of this year.
+
+    @return rain_gauge_data DataFrame: Aligned rain gauge data per hour in mm.
+    @return radar_data DataFrame: Aligned radar data in Z.
+    '''
+    print('Preparing year ' + str(year) + '...')
+
+    # Prepare rain gauge data per hour in mm
+    rain_gauge_data, _, _ = prepare_rain_gauge_data(rain_gauge_data_path, year, station_threshold, cache_path=cache_path)
+
+    # Prepare radar data in Z, copy the lists as they are sorted in place
+    radar_data = prepare_radar_data(radar_data_path, year, noise_threshold, hail_threshold, months=None if months is None else list(months), \
+                                    days=None if days is None else list(days), workers=workers, cache_path=cache_path, incremental=incremental)
+
+    # Finish the figures of this year, a worker process may exit before its background thread does
+    wait_for_figures()
+
+    return align_data(rain_gauge_data, radar_data)
+
+
+def separate_years(df, step):
+    '''
+    Method to insert a row of nan after the last row of each year that is not directly followed by the next year.
+
+    @param df DataFrame: Data of several years with a datetime index, sorted on time.
+    @param step str: Time step of the data (e.g. 'H'), the separator is one step after the last row of a year.
+
+    @return df DataFrame: Data with the separator rows.
+    '''
+    # Find the last row of each year and the first row after it
+    boundary = np.flatnonzero(df.index.year[1:] != df.index.year[:-1])
+    separators = df.index[boundary] + pd.tseries.frequencies.to_offset(step)
+
+    # Only separate years with a gap between them
+    separators = separators[separators < df.index[boundary + 1]]
+    if len(separators) == 0:
+        return df
+
+    return pd.concat([df, pd.DataFrame(np.nan, index=separators, columns=df.columns)]).sort_index(kind='stable')
+
+
+def prepare_years(years, rain_gauge_data_path, radar_data_path, station_threshold, noise_threshold, hail_threshold, months=None, days=None, workers=1, \
+                  memory_per_year=2e9, cache_path=None, incremental=False):
+    '''
+    Method to prepare the years as independent tasks on a process pool and concatenate their aligned data.
+    Years already in the cache only load their cached radar values and rain gauge files.
+
+    @param years list[int]: Years to prepare.
+    @param workers int: Maximum number of processes.
+    @param memory_per_year float: Expected peak memory of preparing one year in bytes, limits the number of years prepared at once.
+
+    @return rain_gauge_data DataFrame: Rain gauge data per hour in mm of all years.
+    @return radar_data DataFrame: Radar data in Z of all years.
+    '''
+    # Run as many years at once as fit in memory, the remaining processes decode radar days within a year
+    year_workers = memory_limited_workers(min(workers, len(years)), memory_per_year)
+    day_workers = max(1, workers // year_workers)
+
+    # Prepare years in order
+    results = list(ordered_map(prepare_year, years, repeat(rain_gauge_data_path), repeat(radar_data_path), repeat(station_threshold), repeat(noise_threshold), \
+                               repeat(hail_threshold), repeat(months), repeat(days), repeat(day_workers), repeat(cache_path), repeat(incremental), workers=year_workers))
+
+    # Concatenate years, stations missing in a year are nan
+    rain_gauge_data = pd.concat([rain_gauge_year for rain_gauge_year, _ in results])
+    radar_data = pd.concat([radar_year for _, radar_year in results])
+
+    # Separate the years by a row of nan, so events never span the gap
+    if len(years) > 1 and len(rain_gauge_data) > 0 and len(radar_data) > 0:
+        rain_gauge_data = separate_years(rain_gauge_data, 'H')
+        radar_data = separate_years(radar_data, '6min')
+
+    return rain_gauge_data, radar_data
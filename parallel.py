@@ -0,0 +1,94 @@
+import os
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from profiling import settings as profiling_settings, stage_path, run_profiled, collect_profiled
+from diagnostics import wait_for_figures
+
+
+def ordered_map(func, *iterables, workers=1, max_pending=None, initializer=None, initargs=()):
+    '''
+    Method to apply a function to every item in a process pool, yielding the results in input order.
+
+    @param func function: Module-level function to apply, so it can be sent to the worker processes.
+    @param iterables iterable: Arguments of the function, as for the builtin map.
+    @param workers int: Number of processes, runs in the current process if 1 or less.
+    @param max_pending int: Maximum number of submitted tasks whose result is not yet yielded (default: 2 per worker).
+    @param initializer function: Module-level function called once in every process before the first task.
+    @param initargs tuple: Arguments of the initializer.
+
+    @return results generator: Results of the function in the same order as the arguments.
+    '''
+    # Run serially if no workers requested
+    if workers is None or workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(func, *iterables)
+        return
+
+    # Bound the number of results kept in memory
+    if max_pending is None:
+        max_pending = 2 * workers
+
+    # Record the stages of the tasks in the workers under the current stage of this process
+    collect = lambda output: output
+    if profiling_settings['enabled']:
+        func = partial(run_profiled, func, stage_path())
+        collect = collect_profiled
+
+    # Finish the figures rendering in the background first, forking while a thread renders can deadlock the workers
+    wait_for_figures()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+        # Init queue of submitted tasks
+        pending = deque()
+
+        # Loop over arguments
+        for args in zip(*iterables):
+            # Submit task
+            pending.append(pool.submit(func, *args))
+
+            # Yield oldest result when queue is full
+            if len(pending) >= max_pending:
+                yield collect(pending.popleft().result())
+
+        # Yield remaining results in order
+        while pending:
+            yield collect(pending.popleft().result())
+
+
+def available_memory():
+    '''
+    Method to get the memory available for new processes.
+
+    @return memory int: Available memory in bytes, None if unknown on this platform.
+    '''
+    # Prefer the kernel estimate that includes reclaimable cache
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def memory_limited_workers(workers, memory_per_task):
+    '''
+    Method to limit the number of processes so that the tasks running at the same time fit in the available memory.
+
+    @param workers int: Requested number of processes.
+    @param memory_per_task float: Expected peak memory of one task in bytes.
+
+    @return workers int: Number of processes, at least 1.
+    '''
+    memory = available_memory()
+    if memory is None or memory_per_task is None or memory_per_task <= 0:
+        return max(1, workers)
+
+    return max(1, min(workers, int(memory // memory_per_task)))
@@ -1,266 +1,287 @@
 import os
-from PIL import Image
 import numpy as np
 import pandas as pd
 import rasterio
-import csv
+import netCDF4
 import xarray as xr
+from itertools import repeat
+from parallel import ordered_map
+from data_preparation.file_index import FileIndex
+from data_preparation.radar_archive import RadarArchive
+from profiling import profile_stage
 
 
-def group_files_by_hours(filelist):
+def rain_lookup_table(a, b, noise_threshold=15, hail_threshold=53, dtype=np.float64):
     '''
-    Method to group files in a directory by hours.
+    Method to compute the rain intensity of every possible pixel value of a radar png.
 
-    @param filelist list[str]: List of png files in directory of form YYYYMMDDHHMMSS.png
+    @param a float: Calibrated parameter a.
+    @param b float: Calibrated parameter b.
+    @param dtype type: Float type of the table, float32 halves the memory of the maps.
 
-    @return result dict{int: str}: Dictionary with hours as key and filenames within that hour as value
+    @return table array[float]: Rain intensity per pixel value 0-255.
     '''
-    # Init empty dict with hours as key
-    result = {h: [] for h in range(0,24)}
-    
-    # Loop over files in list
-    for file in filelist:
-        # Retrieve its hour
-        hour = int(file[8:10])
-        # Store in dict
-        result[hour] = result[hour] + [file]
+    # All possible pixel values
+    data_radar = np.arange(256, dtype=np.uint8)
+
+    # Filter noise and hail
+    data_radar[data_radar < noise_threshold] = 0
+    data_radar[data_radar > hail_threshold] = hail_threshold
 
-    return result
+    # Convert from dBZ to Z
+    data_radar = 10**(data_radar/10)
+    data_radar[data_radar == 1] = 0
 
+    # Convert to rain intensity
+    return ((data_radar/a)**(1/b)).astype(dtype)
 
-def generate_percipitation_maps(radar_data_path, year, a, b, save_path, months=None, days=None, resolution=800, measurements_per_hour=10, noise_threshold=15, hail_threshold=53):
+
+def hourly_rain_map(block, table):
     '''
-    Method to generate percipitation maps from radar data.
+    Method to convert a block of radar scans to the mean rain intensity over the block.
 
-    @param radar_data_path str: Directory where the radar data is stored.
-    @param year int: Year to analyse the data from.
-    @param a float: Calibrated parameter a.
-    @param b float: Calibrated parameter a.
-    @param save_path: Directory where the rain csv's should be stored.
-    @param months list[str]: List of months to generate for.
-    @param days list[str]: List of days to generate for.
-    @param resolution int: Resolution of radar image.
+    @param block array[uint8]: Radar scans of shape (files, resolution, resolution).
+    @param table array[float]: Rain intensity per pixel value, see rain_lookup_table.
+
+    @return result_intensity array[float]: Mean rain intensity per pixel.
     '''
+    # Accumulate scan by scan, so only two maps are allocated
+    result_hour = table[block[0]]
+    for scan in block[1:]:
+        result_hour += table[scan]
 
-    # Set the root path of the year under investigation
-    radar_png_path = radar_data_path + '/radar_png/' + str(year)
-
-    # If months not specified, derive from directory
-    if months is None:
-        months = os.listdir(radar_png_path)
-
-    # Check if days specified
-    if days is None:
-        days_specified = False
-    else:
-        days_specified = True
-
-    # Loop over months
-    for month in months:
-        # Set path for this month
-        radar_png_month_path = radar_png_path + '/' + month
-        # Create save path if it does not exist yet
-        if not os.path.exists(save_path + '/' + month):
-            os.makedirs(save_path + '/' + month)
-
-        # If days not specified, derive from directory
-        if not days_specified:
-            days = os.listdir(radar_png_month_path)
-
-        # Loop over days
-        for day in days:
-            # Set path for this day
-            radar_png_day_path = radar_png_month_path + '/' + day
-            # Create save path if it does not exist yet
-            if not os.path.exists(save_path + '/' + month + '/' + day):
-                os.makedirs(save_path + '/' + month + '/' + day)
-
-            # Get list of files and sort
-            filelist = os.listdir(radar_png_day_path)
-            filelist.sort()
-
-            # Group files by hour
-            files_per_hour = group_files_by_hours(filelist)
-
-            # Loop over all hours in this day
-            for hour in range(0,24):
-                # Init empty array to store hourly result
-                result_hour = np.empty((resolution,resolution))
-                
-                # Count unopened files
-                num_unopened = 0
-
-                # If files missing in this hour, result is nan (assuming 6min measurement interval)
-                if len(files_per_hour[hour]) != measurements_per_hour:
-                    result_hour[:] = np.nan
-                else:
-                    # Loop over files in this hour
-                    for file in files_per_hour[hour]:
-                        # Try to open the png file, otherwise print that it gave issues and continue to next
-                        try:
-                            # Load radar data from file
-                            data_png = Image.open(radar_png_day_path + '/' + file)
-                            data_radar = np.array(data_png)
-
-                            # Filter noise and hail
-                            data_radar[data_radar < noise_threshold] = 0
-                            data_radar[data_radar > hail_threshold] = hail_threshold
-
-                            # Convert from dBZ to Z
-                            data_radar = 10**(data_radar/10)
-                            data_radar[data_radar == 1] = 0
-
-                            # Convert to rain intensity
-                            data_rain = (data_radar/a)**(1/b)
-
-                            # Accumulate to hourly result
-                            result_hour += data_rain
-
-                        except:
-                            print("Unable to open: " + radar_png_day_path + '/' + file)
-                            num_unopened += 1
-                
-                # If all files unable to open, set to nan
-                if num_unopened > 0:
-                    result_hour[:] = np.nan
-
-                # Take avg of hour
-                result_intensity = result_hour / measurements_per_hour
-
-                # Write hourly result to csv file
-                df = pd.DataFrame(columns=np.arange(0,resolution), index=np.arange(0,resolution), data=result_intensity)
-                df.to_csv(save_path + '/' + month + '/' + day + '/' + str(year) + month + day + f"{hour:02}" + '00.csv')
+    # Take avg of hour
+    result_hour /= len(block)
 
+    return result_hour
 
-def get_coords(radar_data_path):
+
+@profile_stage('compute_day_maps')
+def compute_day_maps(archive, day, a, b, resolution=800, measurements_per_hour=10, noise_threshold=15, hail_threshold=53, dtype=np.float64):
     '''
-    Method to get the horizontal and vertical coordinates from a .tif file.
+    Method to compute the hourly percipitation maps of one day.
+
+    @param archive RadarArchive: Radar scans, at least those of the day.
+    @param day datetime: Day to compute the maps of.
+    @param a float: Calibrated parameter a.
+    @param b float: Calibrated parameter b.
+    @param resolution int: Resolution of radar image.
+    @param dtype type: Float type to compute the maps in.
+
+    @return maps array[float]: Rain intensity of shape (24, resolution, resolution), nan for incomplete hours.
     '''
-    # Open the file
-    all_coords = rasterio.open(radar_data_path + '/extract_radarpixel/raster_radar_sattahip.tif')
+    # Rain intensity per pixel value and block of scans, reused for every hour
+    table = rain_lookup_table(a, b, noise_threshold, hail_threshold, dtype)
+    block = np.empty((measurements_per_hour, resolution, resolution), dtype=np.uint8)
 
-    # Get horizontal and vertical coordinates
-    X = [all_coords.xy(0, y)[0] for y in range(all_coords.height)]
-    Y = [all_coords.xy(x, 0)[1] for x in range(all_coords.width)]
+    # Init maps of the day as nan
+    maps = np.full((24, resolution, resolution), np.nan, dtype=dtype)
 
-    return X, Y
+    # Loop over all hours in this day
+    start = pd.Timestamp(day).normalize()
+    for hour in range(0,24):
+        hour_scans = archive.time_slice(start + pd.Timedelta(hours=hour), start + pd.Timedelta(hours=hour+1))
+
+        # If files missing in this hour, result is nan (assuming 6min measurement interval)
+        if hour_scans.stop - hour_scans.start != measurements_per_hour:
+            continue
 
+        # Load the scans of this hour, if any file unable to open the result is nan
+        _, opened = archive.read(hour_scans, out=block)
+        if not np.all(opened):
+            continue
 
-def replace_indices(file_path, X, Y):
+        maps[hour] = hourly_rain_map(block, table)
+
+    return maps
+
+
+def create_percipitation_store(nc_path, X, Y, dtype=np.float64, chunk_hours=24, chunk_pixels=100, complevel=4):
     '''
-    Method to replace the indices in the excel files by coordinates.
+    Method to create a compressed, chunked NetCDF4 file to append hourly percipitation maps to.
+
+    @param nc_path str: Path of the .nc file, overwritten if it exists.
+    @param X array[float]: Horizontal coordinate per column, see get_coords.
+    @param Y array[float]: Vertical coordinate per row, see get_coords.
+    @param dtype type: Float type to store the maps in.
+    @param chunk_hours int: Number of hours per chunk.
+    @param chunk_pixels int: Number of rows and columns per chunk.
+    @param complevel int: Compression level (1-9).
+
+    @return dataset netCDF4.Dataset: Opened file, to be closed by the caller.
     '''
-    # Open the file
-    with open(file_path, 'r', newline='') as file:
-            # Read the CSV data
-            reader = csv.reader(file)
-            rows = list(reader)
+    dataset = netCDF4.Dataset(nc_path, 'w', format='NETCDF4')
 
-    # Replace the indices of the columns by the horizontal coordinates
-    rows[0][1:] = X
+    # Time can grow while appending
+    dataset.createDimension('time', None)
+    dataset.createDimension('y', len(Y))
+    dataset.createDimension('x', len(X))
 
-    # Replace the indices of the rows by the vertical coordinates
-    for i in range(len(rows)-1):
-        if i < len(Y):
-            rows[i+1][0] = Y[i]
+    # Coordinates
+    time = dataset.createVariable('time', 'f8', ('time',))
+    time.units = 'hours since 1970-01-01 00:00:00'
+    time.calendar = 'standard'
+    y = dataset.createVariable('y', 'f8', ('y',))
+    y[:] = Y
+    y.long_name = 'vertical coordinate of pixel centre'
+    x = dataset.createVariable('x', 'f8', ('x',))
+    x[:] = X
+    x.long_name = 'horizontal coordinate of pixel centre'
 
-    # Write the modified data back to the CSV file
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerows(rows)
+    # Rain intensity, compressed per chunk of hours and pixels
+    rain = dataset.createVariable('rain_intensity', dtype, ('time', 'y', 'x'), zlib=True, complevel=complevel, shuffle=True, \
+                                  chunksizes=(chunk_hours, min(chunk_pixels, len(Y)), min(chunk_pixels, len(X))), fill_value=np.nan)
+    rain.units = 'mm/h'
 
+    # Keep a full row of time chunks in cache, so appending hour by hour does not recompress them
+    rain.set_var_chunk_cache(size=int(1.2 * chunk_hours * len(Y) * len(X) * np.dtype(dtype).itemsize))
 
-def combine_csv_to_nc(radar_data_path, percip_path, save_path, months=None, days=None):
+    return dataset
+
+
+def append_percipitation_maps(dataset, times, maps):
+    '''
+    Method to append hourly percipitation maps to a file created by create_percipitation_store.
+
+    @param dataset netCDF4.Dataset: Opened file.
+    @param times list[datetime]: Start time of every hour.
+    @param maps array[float]: Rain intensity of shape (hours, rows, columns).
+    '''
+    start = len(dataset.dimensions['time'])
+    end = start + len(maps)
+
+    # Store time as hours since epoch
+    dataset.variables['time'][start:end] = (pd.DatetimeIndex(times) - pd.Timestamp('1970-01-01')) / pd.Timedelta(hours=1)
+    dataset.variables['rain_intensity'][start:end] = maps
+
+
+@profile_stage('generate_percipitation_maps')
+def generate_percipitation_maps(radar_data_path, year, a, b, save_path, months=None, days=None, resolution=800, measurements_per_hour=10, noise_threshold=15, hail_threshold=53, workers=1, dtype=np.float64, cache_path=None, cube_path=None):
     '''
-    Method to combine multiple .csv files into single .nc file
+    Method to generate percipitation maps from radar data.
+    The hourly maps are appended to save_path/percipitation_maps_<year>.nc day by day, so the year is never held in memory.
+
+    @param radar_data_path str: Directory where the radar data is stored.
+    @param year int: Year to analyse the data from.
+    @param a float: Calibrated parameter a.
+    @param b float: Calibrated parameter a.
+    @param save_path: Directory where the .nc file should be stored.
+    @param months list[str]: List of months to generate for.
+    @param days list[str]: List of days to generate for.
+    @param resolution int: Resolution of radar image.
+    @param workers int: Number of processes generating the days in parallel.
+    @param dtype type: Float type to compute and store the maps in, np.float32 halves the memory and file size.
+    @param cache_path str: Directory where the index of the radar files is stored (listed from scratch if None).
+    @param cube_path str: Directory of the uint8 cube of this year made by RadarArchive.to_cube, read instead of the png files if it matches them.
     '''
-    i = 0
-    # Init dataframe
-    dfs = []
+
+    # Index the scans of this year by time, stored in the cache if given
+    archive = RadarArchive(radar_data_path, years=[year], cube_path=cube_path, cache_path=cache_path)
+
+    # Get the days to generate, all days with files if months or days not specified
+    dates = archive.days(months, days)
+
+    # Select the scans of each day
+    day_archives = [archive.take(archive.time_slice(date, date + pd.Timedelta(days=1))) for date in dates]
+
+    # Create save path if it does not exist yet
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
 
     # Get coordinates
     X, Y = get_coords(radar_data_path)
-    print(len(X))
-    print(len(Y))
 
-    # If months not specified, derive from directory
-    if months is None:
-        months = os.listdir(percip_path)
+    dataset = create_percipitation_store(save_path + '/percipitation_maps_' + str(year) + '.nc', X, Y, dtype)
+    try:
+        # Generate the maps of all days, in parallel if requested, and append them in order
+        maps_per_day = ordered_map(compute_day_maps, day_archives, dates, repeat(a), repeat(b), repeat(resolution), \
+                                   repeat(measurements_per_hour), repeat(noise_threshold), repeat(hail_threshold), repeat(dtype), workers=workers)
+        for date, maps in zip(dates, maps_per_day):
+            append_percipitation_maps(dataset, pd.date_range(date, periods=24, freq='H'), maps)
+    finally:
+        dataset.close()
+
 
-    # Check if days specified
-    if days is None:
-        days_specified = False
-    else:
-        days_specified = True
+# Coordinates per raster file, with the modification time they were read at
+coords_cache = {}
 
-    # Loop over months
-    for month in months:
-        # Set path for this month
-        percip_month_path = percip_path + '/' + month
 
-        # If days not specified, derive from directory
-        if not days_specified:
-            days = os.listdir()
+def get_coords(radar_data_path):
+    '''
+    Method to get the horizontal and vertical coordinates of the pixel centres from a .tif file.
+    The coordinates are computed from the affine transform of the raster and cached until the file changes.
+
+    @param radar_data_path str: Directory where the radar data is stored.
+
+    @return X array[float]: Horizontal coordinate per column.
+    @return Y array[float]: Vertical coordinate per row.
+    '''
+    raster_path = radar_data_path + '/extract_radarpixel/raster_radar_sattahip.tif'
+
+    # Reuse coordinates if the file did not change
+    mtime = os.path.getmtime(raster_path)
+    if raster_path in coords_cache and coords_cache[raster_path][0] == mtime:
+        return coords_cache[raster_path][1:]
+
+    # Read transform and shape only
+    with rasterio.open(raster_path) as raster:
+        transform = raster.transform
+        width = raster.width
+        height = raster.height
 
-        # Loop over days
-        for day in days:
-            # Set path for this day
-            percip_day_path = percip_month_path + '/' + day
-            # Create save path if it does not exist yet
-            if not os.path.exists(save_path + '/' + month + '/' + day):
-                os.makedirs(save_path + '/' + month + '/' + day)
+    # Centres of the columns in the first row and of the rows in the first column
+    X = transform.c + transform.a * (np.arange(width) + 0.5) + transform.b * 0.5
+    Y = transform.f + transform.d * 0.5 + transform.e * (np.arange(height) + 0.5)
 
-            # Get list of files and sort
-            filelist = os.listdir(percip_day_path)
-            filelist.sort()
+    coords_cache[raster_path] = (mtime, X, Y)
 
-            # Loop over files
-            for file in filelist:
-                df_new = pd.read_csv(percip_day_path + '/' + file, index_col=0)
-                print(df_new)
-                dfs.append(df_new)
-                i += 1
-                if i == 2:
-                    break
+    return X, Y
 
-    print(dfs)
 
-    # Convert each DataFrame to a DataArray and concatenate them along a new dimension
-    data_arrays = [xr.DataArray(df) for df in dfs]
-    merged_data = xr.concat(data_arrays, dim='new_dimension_name')
-    
-    print(merged_data)
+def open_percipitation_maps(nc_path):
+    '''
+    Method to open a file of hourly percipitation maps lazily, with time, y and x as coordinates.
 
-    merged_data.to_netcdf(save_path + '/percipitation_maps.nc')
+    @param nc_path str: Path of the .nc file.
 
-    # for csv_file in csv_files:
-    #     df = pd.read_csv(csv_file)
-    #     dataframes.append(df)
+    @return maps DataArray: Rain intensity with dimensions (time, y, x).
+    '''
+    return xr.open_dataset(nc_path)['rain_intensity']
 
-    # # Merge DataFrames into a single DataFrame
-    # combined_df = pd.concat(dataframes, ignore_index=True)
 
-    # # Convert the combined DataFrame to an xarray Dataset
-    # ds = xr.Dataset.from_dataframe(combined_df)
+def combine_csv_to_nc(radar_data_path, percip_path, save_path, months=None, days=None):
+    '''
+    Method to combine hourly percipitation .csv files (YYYYMMDDHH00.csv) into a single .nc file.
+    '''
+    # Get coordinates
+    X, Y = get_coords(radar_data_path)
 
-    # # Save the xarray Dataset to a NetCDF file
-    # ds.to_netcdf(save_path, format="NETCDF4")
+    # Index the csv files by time
+    file_index = FileIndex(percip_path, extension='.csv')
 
-    # csv_directory = './01_radar_csv'
-    # save_path = './radar.nc'
+    # Create save path if it does not exist yet
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
 
-    # # Get coordinates
-    # X, Y = get_coords(radar_data_path)
+    dataset = None
+    try:
+        # Loop over days, all days with files if months or days not specified
+        for day in file_index.days(months, days):
+            day_files = file_index.between(day, day + pd.Timedelta(days=1))
 
-    # # Get list of csv files
-    # csv_files = [csv_directory + '/' + f for f in os.listdir(csv_directory) if os.path.isfile(os.path.join(csv_directory, f))]
+            # Append files one hour at a time
+            for time, path in zip(file_index.times[day_files], file_index.paths[day_files]):
+                data = pd.read_csv(path, index_col=0, float_precision='round_trip').to_numpy()
 
-    # # Replace indices of all csv files
-    # for csv_file in csv_files
-    #     replace_indices(csv_file, X, Y)
+                # Create file with the type of the first map
+                if dataset is None:
+                    dataset = create_percipitation_store(save_path + '/percipitation_maps.nc', X, Y, data.dtype)
 
-    # # Combine into .nc file
-    # combine_csv_to_nc(csv_files, save_path)
+                append_percipitation_maps(dataset, [time], data[np.newaxis])
+    finally:
+        if dataset is not None:
+            dataset.close()
 
 
-combine_csv_to_nc("./data/radar", "./results/rain_csv", "./results", months=['01'], days=['21'])
\ No newline at end of file
+if __name__ == '__main__':
+    combine_csv_to_nc("./data/radar", "./results/rain_csv", "./results", months=['01'], days=['21'])
\ No newline at end of file
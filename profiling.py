@@ -0,0 +1,214 @@
+import sys
+import time
+import json
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Profiling settings and measurements of this process, profiling is off until enable_profiling is called
+settings = {'enabled': False, 'cprofile_stage': None, 'cprofile_path': None, 'profiler': None, 'started': 0}
+open_stages = []
+
+# Measurements combined per stage path, in a fixed amount of memory however often a stage runs
+records = {}
+
+
+def enable_profiling(cprofile_stage=None, cprofile_path=None):
+    '''
+    Method to start recording the stages of this process.
+
+    @param cprofile_stage str: Name of a stage to run under cProfile (none if None).
+    @param cprofile_path str: Path to dump the cProfile statistics of that stage to.
+    '''
+    settings['enabled'] = True
+    settings['cprofile_stage'] = cprofile_stage
+    settings['cprofile_path'] = cprofile_path
+    settings['profiler'] = None
+    settings['started'] = 0
+    records.clear()
+
+    # Trace allocations to measure the peak memory per stage
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def peak_rss():
+    '''
+    Method to get the peak resident memory of this process so far.
+
+    @return rss float: Peak resident memory in MB, None if unknown on this platform.
+    '''
+    if resource is None:
+        return None
+
+    # Reported in kB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+@contextmanager
+def profile_stage(name):
+    '''
+    Method to measure wall time, CPU time and memory of a stage, nested stages are recorded under their parent.
+    Use as "with profile_stage('name'):" or as decorator "@profile_stage('name')", does nothing unless profiling is enabled.
+
+    @param name str: Name of the stage.
+    '''
+    if not settings['enabled']:
+        yield
+        return
+
+    # Pass the allocation peak so far on to the open stages, then measure this stage from here
+    current, peak = tracemalloc.get_traced_memory()
+    for stage in open_stages:
+        stage['peak'] = max(stage['peak'], peak)
+    tracemalloc.reset_peak()
+
+    stage = {'path': '/'.join([open_stage['name'] for open_stage in open_stages] + [name]), 'name': name, 'order': settings['started'], \
+             'start_memory': current, 'peak': current}
+    settings['started'] += 1
+    open_stages.append(stage)
+
+    # Run the chosen stage under cProfile, accumulating over its calls
+    profiler = None
+    if settings['cprofile_stage'] == name and settings['cprofile_path'] is not None:
+        if settings['profiler'] is None:
+            settings['profiler'] = cProfile.Profile()
+        profiler = settings['profiler']
+        profiler.enable()
+
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(settings['cprofile_path'])
+
+        # Peak of this stage, which also counts for its parents
+        _, peak = tracemalloc.get_traced_memory()
+        open_stages.pop()
+        stage['peak'] = max(stage['peak'], peak)
+        for open_stage in open_stages:
+            open_stage['peak'] = max(open_stage['peak'], stage['peak'])
+
+        add_record(stage['path'], stage['order'], {'calls': 1, 'wall_s': wall, 'wall_min_s': wall, 'wall_max_s': wall, \
+                                                    'cpu_s': cpu, 'cpu_min_s': cpu, 'cpu_max_s': cpu, \
+                                                    'traced_peak_mb': (stage['peak'] - stage['start_memory']) / 1024**2, 'rss_peak_mb': peak_rss()})
+
+
+def add_record(path, order, record):
+    '''
+    Method to combine the measurements of one or more calls of a stage with those recorded before.
+
+    @param path str: Path of the stage, the names of its parents and its own name separated by "/".
+    @param order int: Start order of the stage, only used if it was not recorded before.
+    @param record dict: Number of calls, total, minimum and maximum wall and CPU time and the largest peaks.
+    '''
+    if path not in records:
+        records[path] = {'order': order, **record}
+        return
+
+    total = records[path]
+    total['calls'] += record['calls']
+    for key in ['wall_s', 'cpu_s']:
+        total[key] += record[key]
+    for key in ['wall_min_s', 'cpu_min_s']:
+        total[key] = min(total[key], record[key])
+    for key in ['wall_max_s', 'cpu_max_s', 'traced_peak_mb', 'rss_peak_mb']:
+        known = [value for value in [total[key], record[key]] if value is not None]
+        total[key] = max(known) if len(known) > 0 else None
+
+
+def stage_path():
+    '''
+    Method to get the path of the innermost open stage.
+
+    @return path str: Names of the open stages separated by "/", empty if none open.
+    '''
+    return '/'.join([open_stage['name'] for open_stage in open_stages])
+
+
+def run_profiled(func, parent_path, *args):
+    '''
+    Method to run a task in a worker process with its stages recorded, to be sent back to the parent process.
+    cProfile is not run in the workers, the chosen stage is only profiled in the parent process.
+
+    @param func function: Module-level function of the task.
+    @param parent_path str: Path of the stage of the parent process the task runs in.
+    @param args any: Arguments of the function.
+
+    @return result any: Result of the function.
+    @return stages dict: Measurements per stage path of this task, under the parent path.
+    '''
+    # Record only this task, workers are reused between tasks
+    enable_profiling()
+    open_stages.clear()
+
+    result = func(*args)
+
+    prefix = parent_path + '/' if parent_path else ''
+    stages = {prefix + path: record for path, record in records.items()}
+    records.clear()
+
+    return result, stages
+
+
+def collect_profiled(output):
+    '''
+    Method to add the stages recorded in a worker process by run_profiled to the measurements of this process.
+
+    @param output tuple: Result and measurements per stage path returned by run_profiled.
+
+    @return result any: Result of the task.
+    '''
+    result, stages = output
+    for path, record in sorted(stages.items(), key=lambda item: item[1]['order']):
+        # Order stages first seen in a worker by when they are collected
+        add_record(path, settings['started'], {key: value for key, value in record.items() if key != 'order'})
+        settings['started'] += 1
+
+    return result
+
+
+def profile_report():
+    '''
+    Method to summarize the recorded stages, including those run in worker processes by ordered_map.
+    The CPU time and peaks of a stage only count its own process, not the workers it waits for.
+
+    @return report DataFrame: Number of calls, total, minimum and maximum wall and CPU time, largest traced peak and peak RSS per stage, in order of first start.
+    '''
+    columns = ['stage', 'calls', 'wall_s', 'wall_min_s', 'wall_max_s', 'cpu_s', 'cpu_min_s', 'cpu_max_s', 'traced_peak_mb', 'rss_peak_mb']
+    if len(records) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Stages are recorded when they end, so order them by their start
+    report = pd.DataFrame([{'stage': path, **record} for path, record in records.items()]).sort_values('order', kind='stable')
+
+    return report.reset_index(drop=True)[columns]
+
+
+def write_profile_report(save_path, run_info=None):
+    '''
+    Method to write the summary of the recorded stages to a .json or .csv file.
+
+    @param save_path str: Path of the report, written as csv unless it ends with .json.
+    @param run_info dict: Settings of the run to store with a json report.
+    '''
+    report = profile_report()
+
+    if save_path.endswith('.json'):
+        with open(save_path, 'w') as file:
+            json.dump({'run': run_info or {}, 'stages': report.to_dict(orient='records')}, file, indent=2, default=str)
+    else:
+        report.to_csv(save_path, index=False)
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.synthetic_data import calibration_pairs
+from calibration import minimize_objective, objective, objective_and_gradient, calibrate, calibrate_streaming, save_calibration_data
+
+
+def pairs_with_dry_scans(n_pairs=2000, seed=3):
+    '''
+    Method to simulate pairs of Z and R where a fifth of the scans saw no rain (Z = 0).
+    '''
+    Z, R = calibration_pairs(n_pairs, seed=seed)
+    Z[np.random.default_rng(seed).random(Z.shape) < 0.2] = 0
+
+    return Z, R
+
+
+def test_gradient_with_zero_reflectivity_is_finite():
+    Z, R = pairs_with_dry_scans()
+    with np.errstate(divide='ignore'):
+        MSE, gradient = objective_and_gradient((200, 1.6), np.log(Z), R)
+
+    assert np.isclose(MSE, objective((200, 1.6), Z, R))
+    assert np.all(np.isfinite(gradient))
+
+
+@pytest.mark.parametrize('b_lb, b_ub', [(1.5, 1.6), (1.2, 2.0)])
+def test_gradient_matches_finite_difference_with_zero_reflectivity(b_lb, b_ub):
+    Z, R = pairs_with_dry_scans()
+    a_reference, b_reference, _ = minimize_objective(Z, R, b_lb=b_lb, b_ub=b_ub, method='finite_difference')
+    a, b, _ = minimize_objective(Z, R, b_lb=b_lb, b_ub=b_ub, method='gradient')
+
+    # Not the initial guess
+    assert not np.isclose(a, 400)
+    np.testing.assert_allclose([a, b], [a_reference, b_reference], rtol=1e-4)
+
+
+def streaming_source(kind, Z, R, tmp_path):
+    '''
+    Method to store Z and R as the given kind of streaming source.
+    '''
+    if kind == 'tuple':
+        return Z, R
+
+    save_calibration_data(str(tmp_path / 'calibration_data'), Z, R)
+    if kind == 'memmap':
+        return np.load(str(tmp_path / 'calibration_data' / 'Z.npy'), mmap_mode='r'), np.load(str(tmp_path / 'calibration_data' / 'R.npy'), mmap_mode='r')
+    if kind == 'directory':
+        return str(tmp_path / 'calibration_data')
+
+    pytest.importorskip('pyarrow')
+    df = pd.DataFrame(Z, columns=['Z' + str(k) for k in range(Z.shape[1])])
+    df['R'] = R
+    df.to_parquet(str(tmp_path / 'calibration_data.parquet'))
+    return str(tmp_path / 'calibration_data.parquet')
+
+
+@pytest.mark.parametrize('method', ['gradient', 'profile', 'finite_difference'])
+@pytest.mark.parametrize('kind', ['tuple', 'memmap', 'directory', 'parquet'])
+def test_streaming_matches_in_memory(kind, method, tmp_path):
+    Z, R = pairs_with_dry_scans()
+    a_reference, b_reference = calibrate(Z, R, b_lb=1.2, b_ub=2.0, method=method)
+    a, b = calibrate_streaming(streaming_source(kind, Z, R, tmp_path), chunk_size=300, b_lb=1.2, b_ub=2.0, method=method)
+
+    np.testing.assert_allclose([a, b], [a_reference, b_reference], rtol=1e-4)
+
+
+@pytest.mark.parametrize('method', ['gradient', 'profile', 'finite_difference'])
+def test_streaming_without_pairs_is_nan(method):
+    a, b = calibrate_streaming((np.empty((0, 10)), np.empty(0)), method=method)
+
+    assert np.isnan(a) and np.isnan(b)
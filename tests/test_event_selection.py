@@ -0,0 +1,169 @@
+import math
+from statistics import mean
+import numpy as np
+import pandas as pd
+import pytest
+from event_selection import select_events_single_station, select_events_all_stations
+
+
+def reference_select_events_single_station(station, vals, datetime, radar_df, max_no_rain, min_rain_threshold=0.1):
+    '''
+    Copy of the original per-element loop of select_events_single_station, the reference the vectorized version must match.
+
+    @return events list[tuple]: Start time, end time, reflectivity (min, avg, max) and rain intensity (min, avg, max) per event.
+    @return Z list[float]: List of reflectivity values per hour within events at this station
+    @return R list[float]: List of rainfall values per hour within events at this station
+    '''
+    events = []
+    Z = []
+    R = []
+
+    i = 0
+    while i < len(vals):
+        # Check if value is above threshold
+        if vals.iloc[i] >= min_rain_threshold:
+            # Init statistics for event
+            candidate_event = []
+            consecutive_hours_no_rain = 0
+
+            # Loop over remaining values
+            for j in range(i, len(vals)):
+                # Retrieve value
+                val = vals.iloc[j]
+                # Add to event
+                candidate_event.append(val)
+
+                # Check if value is above threshold
+                if val >= min_rain_threshold:
+                    # Reset statistic
+                    consecutive_hours_no_rain = 0
+                else:
+                    # Update statistic
+                    consecutive_hours_no_rain += 1
+                    # Check if max hours without rain is exceeded
+                    if consecutive_hours_no_rain > max_no_rain:
+                        # Set event time
+                        start_time = datetime[i]
+                        end_time = datetime[j - max_no_rain]
+
+                        # Set event reflectivity
+                        reflect_vals = list(radar_df.loc[start_time:end_time][station].values)[:-1]
+                        if len(reflect_vals) == 0:
+                            reflect_min = float('nan')
+                            reflect_avg = float('nan')
+                            reflect_max = float('nan')
+                        else:
+                            reflect_min = min(reflect_vals)
+                            reflect_avg = mean(reflect_vals)
+                            reflect_max = max(reflect_vals)
+
+                        # Set event rain
+                        rain_vals = candidate_event[:-consecutive_hours_no_rain]
+                        if len(rain_vals) == 0:
+                            rain_intens_min = float('nan')
+                            rain_intens_avg = float('nan')
+                            rain_intens_max = float('nan')
+                        else:
+                            rain_intens_min = min(rain_vals)
+                            rain_intens_avg = mean(rain_vals)
+                            rain_intens_max = max(rain_vals)
+
+                        # Check if no nan values in event, otherwise event is discarded
+                        if not math.isnan(rain_intens_avg):
+                            # Add to events list
+                            events.append((start_time, end_time, reflect_min, reflect_avg, reflect_max, rain_intens_min, rain_intens_avg, rain_intens_max))
+
+                            # Store rain intensity values
+                            R += rain_vals
+
+                            # Store reflectivity values
+                            Z += reflect_vals
+
+                        # Continue events selection after end of new event
+                        i = j + 1
+                        break
+
+        # Go to next timestep
+        i += 1
+
+    return events, Z, R
+
+
+def synthetic_series(max_no_rain, n_stations=6, n_runs=60, seed=0):
+    '''
+    Method to build hourly rain of several stations as alternating wet runs and dry gaps, with missing values,
+    where many gaps are exactly max_no_rain + 1 hours, and radar data per 6min on the same period.
+    '''
+    rng = np.random.default_rng(seed)
+    columns = []
+    for _ in range(n_stations):
+        values = []
+        for _ in range(n_runs):
+            # Wet run of 1 to 3 hours, sometimes with a missing value
+            run = list(np.round(rng.uniform(0.1, 5, rng.integers(1, 4)), 1))
+            if rng.random() < 0.1:
+                run[rng.integers(len(run))] = np.nan
+            values += run
+
+            # Dry gap, shorter than, exactly or longer than max_no_rain + 1 hours
+            gap = rng.choice([max_no_rain + 1, max_no_rain + 1, rng.integers(0, max_no_rain + 3)])
+            values += list(rng.choice([0.0, 0.05, np.nan], gap, p=[0.8, 0.1, 0.1]))
+        columns.append(values)
+
+    # Pad all stations to the same length with dry hours
+    n_hours = max(len(values) for values in columns) + max_no_rain + 2
+    rain = np.zeros((n_hours, n_stations))
+    for k, values in enumerate(columns):
+        rain[:len(values), k] = values
+
+    stations = ['ST%02d' % k for k in range(n_stations)]
+    hours = pd.date_range('2022-01-01', periods=n_hours, freq='H')
+    rain_df = pd.DataFrame(rain, index=hours, columns=stations)
+    scans = pd.date_range('2022-01-01', periods=10 * n_hours, freq='6min')
+    radar_df = pd.DataFrame(rng.uniform(1, 1e5, (len(scans), n_stations)), index=scans, columns=stations)
+
+    return rain_df, radar_df
+
+
+def assert_events_equal(events, reference):
+    assert len(events) == len(reference)
+    for event, (start_time, end_time, *statistics) in zip(events, reference):
+        assert event.start_time == start_time
+        assert event.end_time == end_time
+        np.testing.assert_allclose([event.reflect_min, event.reflect_avg, event.reflect_max, \
+                                    event.rain_intens_min, event.rain_intens_avg, event.rain_intens_max], statistics, rtol=1e-12)
+
+
+@pytest.mark.parametrize('max_no_rain', [0, 1, 2, 3])
+def test_single_station_matches_reference(max_no_rain):
+    rain_df, radar_df = synthetic_series(max_no_rain, seed=max_no_rain)
+
+    for station in rain_df.columns:
+        reference, Z_reference, R_reference = reference_select_events_single_station(station, rain_df[station], rain_df.index, radar_df, max_no_rain)
+        events, Z, R = select_events_single_station(station, rain_df[station], rain_df.index, radar_df, max_no_rain)
+
+        assert len(reference) > 0
+        assert_events_equal(events, reference)
+        np.testing.assert_array_equal(Z, Z_reference)
+        np.testing.assert_array_equal(R, R_reference)
+
+
+@pytest.mark.parametrize('max_no_rain', [0, 1, 2, 3])
+def test_all_stations_match_reference(max_no_rain):
+    rain_df, radar_df = synthetic_series(max_no_rain, seed=10 + max_no_rain)
+
+    # The reference per station, concatenated in the order of the columns
+    reference, stations, Z_reference, R_reference = [], [], [], []
+    for station in rain_df.columns:
+        station_events, station_Z, station_R = reference_select_events_single_station(station, rain_df[station], rain_df.index, radar_df, max_no_rain)
+        reference += station_events
+        stations += [[station]] * len(station_events)
+        Z_reference += station_Z
+        R_reference += station_R
+
+    events, Z, R = select_events_all_stations(rain_df, radar_df, max_no_rain)
+
+    assert_events_equal(list(events), reference)
+    assert [event.stations for event in events] == stations
+    np.testing.assert_array_equal(Z, Z_reference)
+    np.testing.assert_array_equal(R, R_reference)
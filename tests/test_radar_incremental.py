@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import pandas as pd
+from PIL import Image
+from benchmarks.synthetic_data import generate_dataset
+from data_preparation.radar import prepare_radar_data
+
+
+def synthetic_radar(tmp_path):
+    '''
+    Method to write two days of synthetic radar data and return its directory.
+    '''
+    dataset = generate_dataset(str(tmp_path / 'data'), years=[2022], months=['09'], days=['01', '02'], n_stations=10, resolution=100, seed=1)
+    return dataset['radar_data_path']
+
+
+def overwrite_scan(radar_data_path, day, value):
+    '''
+    Method to overwrite one scan of a day with a constant value.
+    '''
+    day_path = radar_data_path + '/radar_png/2022/09/' + day
+    path = day_path + '/' + sorted(os.listdir(day_path))[5]
+    scan = np.asarray(Image.open(path)).copy()
+    scan[:] = value
+    Image.fromarray(scan).save(path)
+
+    # Make sure the modification time differs from the processed file
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def read_csv(path):
+    with open(path) as file:
+        return file.read()
+
+
+def test_incremental_update_of_some_days_keeps_other_days(tmp_path):
+    radar_data_path = synthetic_radar(tmp_path)
+    save_path = str(tmp_path / 'radar.csv')
+    cache_path = str(tmp_path / 'cache')
+    prepare_radar_data(radar_data_path, 2022, 15, 53, save_path=save_path, cache_path=cache_path, incremental=True)
+
+    # Change a scan of the first day and update only that day
+    overwrite_scan(radar_data_path, '01', 40)
+    prepare_radar_data(radar_data_path, 2022, 15, 53, save_path=save_path, cache_path=cache_path, incremental=True, days=['01'])
+
+    # The file equals a fresh run over all days
+    prepare_radar_data(radar_data_path, 2022, 15, 53, save_path=str(tmp_path / 'fresh.csv'))
+    assert read_csv(save_path) == read_csv(str(tmp_path / 'fresh.csv'))
+
+
+def test_incremental_update_with_new_columns_keeps_other_days(tmp_path):
+    radar_data_path = synthetic_radar(tmp_path)
+    save_path = str(tmp_path / 'radar.csv')
+    cache_path = str(tmp_path / 'cache')
+    prepare_radar_data(radar_data_path, 2022, 15, 53, save_path=save_path, cache_path=cache_path, incremental=True)
+    before = pd.read_csv(save_path, index_col=0, parse_dates=True)
+
+    # Drop a station and update only the second day
+    coordinates_path = radar_data_path + '/extract_radarpixel/raingauge_coordinate.xlsx'
+    station_loc = pd.read_excel(coordinates_path, sheet_name='Sheet1')
+    station_loc.iloc[1:].to_excel(coordinates_path, sheet_name='Sheet1', index=False)
+    radar_df = prepare_radar_data(radar_data_path, 2022, 15, 53, save_path=save_path, cache_path=cache_path, incremental=True, days=['02'])
+
+    # The header has the new columns and the first day is kept
+    after = pd.read_csv(save_path, index_col=0, parse_dates=True)
+    assert list(after.columns) == [str(column) for column in radar_df.columns]
+    pd.testing.assert_frame_equal(after.loc['2022-09-01'], before.loc['2022-09-01', after.columns])
+    pd.testing.assert_frame_equal(after.loc['2022-09-02'], radar_df, check_freq=False, check_names=False)
+
+
+def test_cached_day_with_changed_files_is_processed_again(tmp_path):
+    radar_data_path = synthetic_radar(tmp_path)
+    save_path = str(tmp_path / 'radar.csv')
+    cache_path = str(tmp_path / 'cache')
+    prepare_radar_data(radar_data_path, 2022, 15, 53, save_path=save_path, cache_path=cache_path)
+
+    # Change a scan after it was cached, then run again with the cache but not incremental
+    overwrite_scan(radar_data_path, '02', 40)
+    prepare_radar_data(radar_data_path, 2022, 15, 53, save_path=save_path, cache_path=cache_path)
+
+    # The file equals a fresh run without cache
+    prepare_radar_data(radar_data_path, 2022, 15, 53, save_path=str(tmp_path / 'fresh.csv'))
+    assert read_csv(save_path) == read_csv(str(tmp_path / 'fresh.csv'))